@@ -0,0 +1,56 @@
+import numpy as np
+import timeit
+from qchat.ecc import BACKENDS, ECC_Golay, pack_bits
+
+"""
+Compares the per-codeword and batch Golay reconciliation cost of the matrix and packed syndrome backends
+"""
+
+CODEWORDS = 4096
+SCALAR_CODEWORDS = 256
+BATCH_ITERATIONS = 10
+MAX_ERRORS = 3
+
+
+def make_batch(ecc, rng):
+    X = rng.integers(0, 2, (CODEWORDS, ecc.codeword_length), dtype=np.uint8)
+    E = np.zeros_like(X)
+    for e in E:
+        e[rng.choice(ecc.codeword_length, rng.integers(0, MAX_ERRORS + 1), replace=False)] = 1
+    return X, X ^ E
+
+
+def per_codeword(func):
+    return timeit.timeit(func, number=BATCH_ITERATIONS) / (BATCH_ITERATIONS * CODEWORDS) * 1e6
+
+
+def main():
+    X, Y = make_batch(ECC_Golay(), np.random.default_rng(0))
+    codewords = [tuple(x) for x in X[:SCALAR_CODEWORDS]]
+    received = [tuple(y) for y in Y[:SCALAR_CODEWORDS]]
+
+    print("{:<10}{:<10}{:>14}{:>14}".format("backend", "path", "encode us", "decode us"))
+    for backend in BACKENDS:
+        ecc = ECC_Golay(backend=backend)
+        S = ecc.encode_batch(X)
+        syndromes = [tuple(s) for s in S[:SCALAR_CODEWORDS]]
+        ecc.decode_batch(Y, S)
+
+        scalar_encode = timeit.timeit(lambda: [ecc.encode(x) for x in codewords], number=1) / SCALAR_CODEWORDS
+        scalar_decode = timeit.timeit(lambda: [ecc.decode(y, s) for y, s in zip(received, syndromes)],
+                                      number=1) / SCALAR_CODEWORDS
+        print("{:<10}{:<10}{:>14.2f}{:>14.2f}".format(backend, "scalar", scalar_encode * 1e6, scalar_decode * 1e6))
+        print("{:<10}{:<10}{:>14.2f}{:>14.2f}".format(backend, "batch", per_codeword(lambda: ecc.encode_batch(X)),
+                                                      per_codeword(lambda: ecc.decode_batch(Y, S))))
+
+    # Codewords that are kept packed skip the conversion from 0/1 arrays
+    ecc = ECC_Golay(backend="packed")
+    words, received_words = pack_bits(X), pack_bits(Y)
+    packed_syndromes = ecc.encode_packed(words)
+    print("{:<10}{:<10}{:>14.2f}{:>14.2f}".format("packed", "words", per_codeword(lambda: ecc.encode_packed(words)),
+                                                  per_codeword(lambda: ecc.decode_packed(received_words,
+                                                                                         packed_syndromes))))
+
+
+if __name__ == "__main__":
+    main()
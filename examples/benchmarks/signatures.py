@@ -0,0 +1,33 @@
+import timeit
+from qchat.cryptobox import SIGNERS, create_signer, create_verifier
+
+"""
+Compares key generation, signing and verification cost along with the signature size of the supported
+signature algorithms
+"""
+
+ITERATIONS = 500
+KEYGEN_ITERATIONS = 20
+DATA = b"\x00" * 256
+
+
+def measure(alg):
+    keygen = timeit.timeit(lambda: create_signer(alg), number=KEYGEN_ITERATIONS) / KEYGEN_ITERATIONS
+    signer = create_signer(alg)
+    verifier = create_verifier(signer.get_pub(), alg)
+    sig = signer.sign(DATA)
+
+    sign = timeit.timeit(lambda: signer.sign(DATA), number=ITERATIONS) / ITERATIONS
+    verify = timeit.timeit(lambda: verifier.verify(DATA, sig), number=ITERATIONS) / ITERATIONS
+    return len(sig), keygen * 1e3, sign * 1e6, verify * 1e6
+
+
+def main():
+    print("{:<10}{:>10}{:>14}{:>12}{:>12}".format("alg", "sig bytes", "keygen ms", "sign us", "verify us"))
+    for alg in SIGNERS:
+        size, keygen, sign, verify = measure(alg)
+        print("{:<10}{:>10}{:>14.1f}{:>12.1f}{:>12.1f}".format(alg, size, keygen, sign, verify))
+
+
+if __name__ == "__main__":
+    main()
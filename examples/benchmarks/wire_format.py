@@ -0,0 +1,55 @@
+import os
+import random
+import timeit
+from qchat.cryptobox import QChatSigner
+from qchat.messages import BINARY_ENCODING, JSON_ENCODING, BB84Message, MessageFactory, PUTUMessage, QCHTMessage
+
+"""
+Compares the size and encode/decode cost of the JSON and binary payload encodings for typical messages
+"""
+
+ITERATIONS = 2000
+
+
+def sample_messages():
+    signer = QChatSigner()
+    sig = signer.sign(b"sample")
+    bits = [random.randint(0, 1) for _ in range(100)]
+    messages = {
+        "BB84 ack": BB84Message("Alice", {"ack": True}),
+        "BB84 theta": BB84Message("Alice", {"theta": bits}),
+        "BB84 indices": BB84Message("Alice", {"test_indices": random.sample(range(100), 25)}),
+        "QCHT": QCHTMessage("Alice", {"nonce": os.urandom(16), "ciphertext": os.urandom(64), "tag": os.urandom(16)}),
+        "PUTU": PUTUMessage("Root", {"user": "Alice", "pub": signer.get_pub().decode("ISO-8859-1"),
+                                     "connection": {"host": "localhost", "port": 8000}})
+    }
+    for message in messages.values():
+        message.signature = sig
+    return messages
+
+
+def measure(message, encoding):
+    message.encoding = encoding
+    frame = message.encode_message()
+    payload = frame[24:]
+
+    def roundtrip():
+        # Reset the cached encoding so that every iteration pays for encoding the data
+        message.data = message.data
+        MessageFactory().create_message(message.header, message.sender, message.encode_message()[24:],
+                                        encoding=encoding, signed=True)
+
+    seconds = timeit.timeit(roundtrip, number=ITERATIONS) / ITERATIONS
+    return len(payload), seconds * 1e6
+
+
+def main():
+    print("{:<14}{:>12}{:>14}{:>12}{:>14}".format("message", "json bytes", "json us", "bin bytes", "bin us"))
+    for name, message in sample_messages().items():
+        json_size, json_time = measure(message, JSON_ENCODING)
+        binary_size, binary_time = measure(message, BINARY_ENCODING)
+        print("{:<14}{:>12}{:>14.1f}{:>12}{:>14.1f}".format(name, json_size, json_time, binary_size, binary_time))
+
+
+if __name__ == "__main__":
+    main()
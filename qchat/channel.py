@@ -0,0 +1,254 @@
+import threading
+import time
+from collections import defaultdict, deque
+
+
+class ChannelFull(Exception):
+    pass
+
+
+class MessageChannel:
+    """
+    Implements a thread safe FIFO of messages that wakes waiting consumers as soon as a message arrives.  The channel
+    may be bounded in total depth, per message type and per sender.  When a bound is reached droppable messages are
+    shed while other messages make their producer wait for space.
+    """
+    def __init__(self, max_depth=None, type_limits=None, sender_limit=None):
+        """
+        Initializes an empty channel
+        :param max_depth: int
+            The maximum number of messages stored in the channel, None for no limit
+        :param type_limits: dict
+            The maximum number of stored messages keyed by message header
+        :param sender_limit: int
+            The maximum number of stored messages from a single sender, None for no limit
+        """
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.messages = deque()
+
+        # Channel bounds
+        self.max_depth = max_depth
+        self.type_limits = type_limits or {}
+        self.sender_limit = sender_limit
+        self.type_counts = defaultdict(int)
+        self.sender_counts = defaultdict(int)
+
+        # Queue depth statistics
+        self.enqueued = 0
+        self.dequeued = 0
+        self.peak_depth = 0
+        self.total_depth = 0
+        self.blocked = 0
+        self.dropped = defaultdict(int)
+
+    def __len__(self):
+        """
+        Returns the number of messages currently stored in the channel
+        :return: int
+            The current queue depth
+        """
+        return len(self.messages)
+
+    def _has_room(self, message):
+        """
+        Checks whether storing the message would exceed any of the channel bounds
+        :param message: obj
+            The message to store
+        :return: bool
+            Whether the message fits in the channel
+        """
+        header = getattr(message, "header", None)
+        sender = getattr(message, "sender", None)
+        if self.max_depth is not None and len(self.messages) >= self.max_depth:
+            return False
+        if header in self.type_limits and self.type_counts[header] >= self.type_limits[header]:
+            return False
+        if self.sender_limit is not None and self.sender_counts[sender] >= self.sender_limit:
+            return False
+        return True
+
+    def _remove(self, index):
+        """
+        Removes the message at the specified position, must be called with the lock held
+        :param index: int
+            Position of the message in the channel
+        :return: obj
+            The removed message
+        """
+        if index == 0:
+            message = self.messages.popleft()
+        else:
+            message = self.messages[index]
+            del self.messages[index]
+
+        self.type_counts[getattr(message, "header", None)] -= 1
+        self.sender_counts[getattr(message, "sender", None)] -= 1
+        self.not_full.notify_all()
+        return message
+
+    def _shed_for(self, message):
+        """
+        Drops the oldest droppable message that occupies the space the specified message needs, must be called with
+        the lock held
+        :param message: obj
+            The message that needs space in the channel
+        :return: bool
+            Whether a message was dropped
+        """
+        sender = getattr(message, "sender", None)
+        depth_full = self.max_depth is not None and len(self.messages) >= self.max_depth
+        sender_full = self.sender_limit is not None and self.sender_counts[sender] >= self.sender_limit
+        if not depth_full and not sender_full:
+            return False
+
+        for index, queued in enumerate(self.messages):
+            if getattr(queued, "droppable", False) and (not sender_full or queued.sender == sender):
+                self._remove(index)
+                self.dropped[queued.header] += 1
+                return True
+        return False
+
+    def put(self, message, block=True, timeout=None):
+        """
+        Stores a message into the channel and wakes a waiting consumer.  If the channel is full a droppable message
+        is dropped, otherwise queued droppable messages are shed or the producer waits for space.
+        :param message: obj
+            The message to store
+        :param block: bool
+            Whether to wait for space if the channel is full, raises ChannelFull otherwise
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely.  The message is dropped on timeout.
+        :return: bool
+            Whether the message was stored
+        """
+        header = getattr(message, "header", None)
+        with self.lock:
+            if not self._has_room(message):
+                if getattr(message, "droppable", False):
+                    self.dropped[header] += 1
+                    return False
+
+                while self._shed_for(message) and not self._has_room(message):
+                    pass
+
+                if not self._has_room(message):
+                    if not block:
+                        raise ChannelFull
+
+                    self.blocked += 1
+                    if not self.not_full.wait_for(lambda: self._has_room(message), timeout):
+                        self.dropped[header] += 1
+                        return False
+
+            self.messages.append(message)
+            self.type_counts[header] += 1
+            self.sender_counts[getattr(message, "sender", None)] += 1
+
+            depth = len(self.messages)
+            self.enqueued += 1
+            self.total_depth += depth
+            self.peak_depth = max(self.peak_depth, depth)
+            self.not_empty.notify_all()
+            return True
+
+    def wait_for_room(self, message, timeout=None):
+        """
+        Waits until a consumer makes room for the message without storing it
+        :param message: obj
+            The message that needs space in the channel
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
+        :return: bool
+            Whether the channel has room for the message
+        """
+        with self.lock:
+            return self.not_full.wait_for(lambda: self._has_room(message), timeout)
+
+    def _wait(self, block, timeout, match=None):
+        """
+        Waits until the channel holds a message, must be called with the lock held
+        :param block: bool
+            Whether to wait for a message to arrive
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
+        :param match: func
+            Predicate the message must satisfy, None accepts any message
+        :return: int
+            Position of the oldest accepted message, None if there is none
+        """
+        deadline = None if (timeout is None or not block) else time.monotonic() + timeout
+        while True:
+            if match is None:
+                if self.messages:
+                    return 0
+            else:
+                for index, message in enumerate(self.messages):
+                    if match(message):
+                        return index
+
+            if not block:
+                return None
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.not_empty.wait(remaining)
+
+    def get(self, block=False, timeout=None, match=None):
+        """
+        Removes the oldest message from the channel
+        :param block: bool
+            Whether to wait for a message if the channel is empty
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
+        :param match: func
+            Predicate the message must satisfy, messages that do not satisfy it are left in the channel
+        :return: obj
+            The oldest message, None if no message arrived
+        """
+        with self.lock:
+            index = self._wait(block, timeout, match)
+            if index is None:
+                return None
+            self.dequeued += 1
+            return self._remove(index)
+
+    def drain(self, max_messages=None, block=False, timeout=None):
+        """
+        Removes a batch of the oldest messages from the channel
+        :param max_messages: int
+            The maximum number of messages to remove, None removes all of them
+        :param block: bool
+            Whether to wait for a message if the channel is empty
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
+        :return: list
+            The removed messages in arrival order
+        """
+        with self.lock:
+            if self._wait(block, timeout) is None:
+                return []
+            count = len(self.messages) if max_messages is None else min(max_messages, len(self.messages))
+            batch = [self._remove(0) for _ in range(count)]
+            self.dequeued += count
+            return batch
+
+    def get_stats(self):
+        """
+        Returns the queue depth and load shedding statistics of the channel
+        :return: dict
+            Current/peak/average depth, the number of enqueued/dequeued messages, the number of times a producer had
+            to wait for space and the number of dropped messages keyed by message header
+        """
+        with self.lock:
+            return {
+                "depth": len(self.messages),
+                "max_depth": self.peak_depth,
+                "mean_depth": self.total_depth / self.enqueued if self.enqueued else 0,
+                "enqueued": self.enqueued,
+                "dequeued": self.dequeued,
+                "blocked": self.blocked,
+                "dropped": dict(self.dropped)
+            }
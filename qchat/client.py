@@ -1,13 +1,16 @@
+import threading
 import time
 from collections import defaultdict
 from functools import partial
 from queue import Queue
-from qchat.core import QChatCore, DaemonThread, GLOBAL_SLEEP_TIME
+from qchat.core import QChatCore, DaemonThread, GLOBAL_SLEEP_TIME, DEFAULT_SESSION_MAC
 from qchat.cryptobox import QChatCipher
 from qchat.mailbox import QChatMailbox
-from qchat.messages import QCHTMessage, SPDSMessage, GETUMessage, PUTUMessage, PTCLMessage
+from qchat.messages import QCHTMessage, SPDSMessage, GETUMessage, PUTUMessage, PTCLMessage, NACKMessage, EPRDMessage, \
+                           as_bytes
 from qchat.protocols import ProtocolFactory, QChatKeyProtocol, QChatMessageProtocol, BB84_Purified, \
-                            SuperDenseCoding, LEADER_ROLE, FOLLOW_ROLE
+                            SuperDenseCoding, LEADER_ROLE, FOLLOW_ROLE, DEFAULT_BATCH_RECONCILIATION, DEFAULT_ECC, \
+                            DEFAULT_EPR_WINDOW
 
 
 class QChatClient(QChatCore):
@@ -37,21 +40,32 @@ class QChatClient(QChatCore):
             QCHTMessage.header: self.mailbox.storeMessage,
             GETUMessage.header: partial(self._pass_message_data, handler=self.sendUserInfo),
             PUTUMessage.header: partial(self._pass_message_data, handler=self.addUserInfo),
-            PTCLMessage.header: self._follow_protocol
+            PTCLMessage.header: self._follow_protocol,
+            NACKMessage.header: self._handle_nack,
+            EPRDMessage.header: self._handle_epr_report
         }
 
+        # Completion reports of our batch EPR requests
+        self.epr_reports = {"completed": 0, "failed": 0, "pairs": 0}
+
+        # Measurement devices of running protocols keyed by peer, aborted when the source fails to serve the pair
+        self.epr_devices_lock = threading.Lock()
+        self.epr_devices = defaultdict(set)
+
         super(QChatClient, self).__init__(name=name, cqc_connection=cqc_connection, configFile=configFile,
                                           allow_invalid_signatures=allow_invalid_signatures)
 
     def send_outbound_messages(self):
         """
-        Method for daemon thread, empties the outbound queue
+        Method for daemon thread, empties the outbound queue and sends the queued messages as a batch
         :return: None
         """
         while not time.sleep(GLOBAL_SLEEP_TIME):
+            batch = []
             while not self.outbound_queue.empty():
-                user, message = self.outbound_queue.get()
-                self.sendMessage(user, message)
+                batch.append(self.outbound_queue.get())
+            if batch:
+                self.sendMessages(batch)
 
     def _follow_protocol(self, message):
         """
@@ -67,27 +81,118 @@ class QChatClient(QChatCore):
         }
         peer_info.update(self.getConnectionInfo(message.sender))
 
-        # Construct the protocol object
+        # Construct the protocol object, control messages of the protocol session are demultiplexed into their own
+        # queue
         protocol_class = ProtocolFactory().createProtocol(name=message.data.pop('name'))
         self.logger.debug("Following {} protocol with user {}".format(protocol_class.name, message.sender))
 
-        p = protocol_class(**message.data, peer_info=peer_info, connection=self.connection,
-                           ctrl_msg_q=self.control_message_queue[message.sender],
-                           outbound_q=self.outbound_queue, role=FOLLOW_ROLE, relay_info=self.root_config)
+        session_id = message.data.get("session_id")
+        try:
+            p = protocol_class(**message.data, peer_info=peer_info, connection=self.connection,
+                               ctrl_msg_q=self._open_control_queue(message.sender, session_id),
+                               outbound_q=self.outbound_queue, role=FOLLOW_ROLE, relay_info=self.root_config,
+                               sessions=self.sessions)
+
+            # Establish a key with our peer
+            if isinstance(p, QChatKeyProtocol):
+                key = self._execute_key_protocol(message.sender, p)
+                self.userDB.changeUserInfo(message.sender, message_key=key)
+
+            # Exchange a message with our peer
+            elif isinstance(p, QChatMessageProtocol):
+                received_message = p.receive_message()
+                received_data = {
+                    "plaintext": received_message
+                }
+                mailbox_message = SPDSMessage(sender=message.sender, message_data=received_data)
+                self.mailbox.storeMessage(mailbox_message)
+
+        finally:
+            if session_id is not None:
+                self._close_control_queue(message.sender, session_id)
+                self._close_session(message.sender, session_id)
+
+    def _execute_key_protocol(self, user, protocol):
+        """
+        Internal method for executing a key protocol while its measurement device can be aborted by EPR reports
+        :param user: str
+            The peer of the protocol
+        :param protocol: `~qchat.protocols.QChatKeyProtocol`
+            The protocol to execute
+        :return: bytes
+            The established key
+        """
+        with self.epr_devices_lock:
+            self.epr_devices[user].add(protocol.device)
+        try:
+            return protocol.execute()
+        finally:
+            with self.epr_devices_lock:
+                self.epr_devices[user].discard(protocol.device)
+                if not self.epr_devices[user]:
+                    del self.epr_devices[user]
+
+    def _handle_epr_report(self, message):
+        """
+        Internal method for handling the report of an EPR request, protocols waiting for the pairs of a failed
+        or rejected request with the same user are aborted
+        :param message: `~qchat.messages.EPRDMessage`
+            The report
+        :return: None
+        """
+        # Only our EPR source may report on our requests or abort our protocols
+        if message.sender != self.config.get("root"):
+            self.logger.warning("Ignored EPR report from {}, not our EPR source".format(message.sender))
+            return
+
+        report = message.data
+        if report["error"] is not None:
+            self.logger.warning("EPR request {} with {} failed after {}/{} pairs: {}".format(
+                report["request_id"], report["user"], report["distributed"], report["requested"], report["error"]))
+            with self.epr_devices_lock:
+                devices = list(self.epr_devices.get(report["user"], []))
+            for device in devices:
+                device.abort(report["error"])
+        else:
+            self.logger.debug("EPR request {} with {} completed".format(report["request_id"], report["user"]))
 
-        # Establish a key with our peer
-        if isinstance(p, QChatKeyProtocol):
-            key = p.execute()
-            self.userDB.changeUserInfo(message.sender, message_key=key)
+        # Only requests we sent count towards our statistics, sources predating peer reports only report to us
+        if report.get("requester", self.name) != self.name:
+            return
+        self.epr_reports["pairs"] += report["distributed"]
+        self.epr_reports["failed" if report["error"] is not None else "completed"] += 1
 
-        # Exchange a message with our peer
-        elif isinstance(p, QChatMessageProtocol):
-            received_message = p.receive_message()
-            received_data = {
-                "plaintext": received_message
-            }
-            mailbox_message = SPDSMessage(sender=message.sender, message_data=received_data)
-            self.mailbox.storeMessage(mailbox_message)
+    def getEPRStats(self):
+        """
+        Returns the statistics of our EPR requests reported by the source, failed single pair requests included
+        :return: dict
+            The number of completed and failed requests along with the number of distributed pairs
+        """
+        return dict(self.epr_reports)
+
+    def _get_sessions(self):
+        """
+        Internal method for obtaining the session table handed to protocols we lead, protocols only agree on MAC
+        sessions when they are enabled in our configuration
+        :return: dict
+            The session table, None if session MACs are disabled
+        """
+        return self.sessions if self.config.get("session_mac", DEFAULT_SESSION_MAC) else None
+
+    def _get_protocol_options(self, peer_info):
+        """
+        Internal method for constructing the options of a protocol we lead, protocols with peers that do not
+        support options run without a protocol session and are authenticated with signatures
+        :param peer_info: dict
+            The user and connection information of our peer
+        :return: tuple
+            The protocol session and MAC session options, the identifier of the protocol session
+        """
+        if not self._negotiate_protocol_options(peer_info):
+            return {}, None
+
+        session_id = self._new_session_id()
+        return {"sessions": self._get_sessions(), "session_id": session_id}, session_id
 
     def _establish_key(self, user, key_size, protocol_class=BB84_Purified):
         """
@@ -108,14 +213,27 @@ class QChatClient(QChatCore):
             }
             peer_info.update(self.getConnectionInfo(user))
 
-            # Construct the protocol object
-            p = protocol_class(peer_info=peer_info, connection=self.connection, key_size=key_size,
-                               ctrl_msg_q=self.control_message_queue[user], outbound_q=self.outbound_queue,
-                               role=LEADER_ROLE, relay_info=self.root_config)
-
-            # Execute the protocol and store the derived key in the user database
-            key = p.execute()
-            self.userDB.changeUserInfo(user, message_key=key)
+            # Construct the protocol object within a new protocol session, peers without support for protocol
+            # options follow the baseline protocol
+            options, session_id = self._get_protocol_options(peer_info)
+            if options:
+                options.update(window=self.config.get("epr_window", DEFAULT_EPR_WINDOW),
+                               batch_reconciliation=self.config.get("batch_reconciliation",
+                                                                    DEFAULT_BATCH_RECONCILIATION),
+                               ecc=self.config.get("ecc", DEFAULT_ECC))
+            try:
+                p = protocol_class(peer_info=peer_info, connection=self.connection, key_size=key_size,
+                                   ctrl_msg_q=self._open_control_queue(user, session_id),
+                                   outbound_q=self.outbound_queue, role=LEADER_ROLE, relay_info=self.root_config,
+                                   **options)
+
+                # Execute the protocol and store the derived key in the user database
+                key = self._execute_key_protocol(user, p)
+                self.userDB.changeUserInfo(user, message_key=key)
+            finally:
+                if session_id is not None:
+                    self._close_control_queue(user, session_id)
+                    self._close_session(user, session_id)
 
         else:
             raise Exception("No known user {}".format(user))
@@ -141,9 +259,9 @@ class QChatClient(QChatCore):
 
         # Construct the QChat Message data
         message_data = {
-            "nonce": nonce.decode("ISO-8859-1"),
-            "ciphertext": ciphertext.decode("ISO-8859-1"),
-            "tag": tag.decode("ISO-8859-1")
+            "nonce": nonce,
+            "ciphertext": ciphertext,
+            "tag": tag
         }
         message = QCHTMessage(sender=self.name, message_data=message_data)
         self.logger.debug("Created QChat message")
@@ -159,8 +277,7 @@ class QChatClient(QChatCore):
         :return: None
         """
         # Ensure we have a route to the user
-        if not self.userDB.hasUser(user):
-            self.requestUserInfo(user)
+        self.resolveUser(user)
 
         # Create message object
         message = self.createQChatMessage(user, plaintext)
@@ -177,8 +294,7 @@ class QChatClient(QChatCore):
         :return: None
         """
         # Get user information if we don't have it
-        if not self.userDB.hasUser(user):
-            self.requestUserInfo(user)
+        self.resolveUser(user)
 
         # Construct peer info for the protocol
         peer_info = {
@@ -186,13 +302,20 @@ class QChatClient(QChatCore):
         }
         peer_info.update(self.getConnectionInfo(user))
 
-        # Prepare the protocol
-        p = SuperDenseCoding(peer_info=peer_info, connection=self.connection,
-                             ctrl_msg_q=self.control_message_queue[user], outbound_q=self.outbound_queue,
-                             role=LEADER_ROLE, relay_info=self.root_config)
-
-        # Send the message using the protocol
-        p.send_message(plaintext.encode("ISO-8859-1"))
+        # Prepare the protocol within a new protocol session
+        options, session_id = self._get_protocol_options(peer_info)
+        try:
+            p = SuperDenseCoding(peer_info=peer_info, connection=self.connection,
+                                 ctrl_msg_q=self._open_control_queue(user, session_id),
+                                 outbound_q=self.outbound_queue, role=LEADER_ROLE, relay_info=self.root_config,
+                                 **options)
+
+            # Send the message using the protocol
+            p.send_message(plaintext.encode("ISO-8859-1"))
+        finally:
+            if session_id is not None:
+                self._close_control_queue(user, session_id)
+                self._close_session(user, session_id)
         self.logger.info("Sent superdense message to {}".format(user))
 
     def getMessageHistory(self):
@@ -209,9 +332,9 @@ class QChatClient(QChatCore):
             if qm.header == QCHTMessage.header:
                 user_key = self.userDB.getMessageKey(sender)
                 # Obtain cipher data
-                nonce = qm.data['nonce'].encode("ISO-8859-1")
-                ciphertext = qm.data['ciphertext'].encode("ISO-8859-1")
-                tag = qm.data['tag'].encode("ISO-8859-1")
+                nonce = as_bytes(qm.data['nonce'])
+                ciphertext = as_bytes(qm.data['ciphertext'])
+                tag = as_bytes(qm.data['tag'])
 
                 # Decrypt the essage
                 message = QChatCipher(user_key).decrypt((nonce, ciphertext, tag))
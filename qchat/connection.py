@@ -1,7 +1,26 @@
+import asyncio
+import select
 import socket
 import threading
+import time
+from collections import defaultdict
+from qchat.channel import ChannelFull, MessageChannel
 from qchat.log import QChatLogger
-from qchat.messages import HEADER_LENGTH, PAYLOAD_SIZE, MAX_SENDER_LENGTH, MessageFactory
+from qchat.messages import HEADER_LENGTH, PAYLOAD_SIZE, MAX_SENDER_LENGTH, ENCODINGS, MalformedMessage, \
+                           MessageFactory, decode_size
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_IDLE_TIMEOUT = 30
+MIN_EVICTION_INTERVAL = 0.1
+DEFAULT_BACKLOG = 128
+DEFAULT_MAX_FRAME_SIZE = 2 ** 22
+DEFAULT_MAX_QUEUE_DEPTH = 4096
+DEFAULT_SENDER_QUEUE_LIMIT = 1024
+DEFAULT_TYPE_QUEUE_LIMITS = {"RGST": 256, "GETU": 256}
+BACKPRESSURE_WAIT_TIME = 1
+FRAME_PREFIX_LENGTH = HEADER_LENGTH + MAX_SENDER_LENGTH + PAYLOAD_SIZE
+THREADED_TRANSPORT = "threaded"
+ASYNCIO_TRANSPORT = "asyncio"
 
 
 class ConnectionError(Exception):
@@ -18,6 +37,167 @@ class DaemonThread(threading.Thread):
         self.start()
 
 
+def eviction_interval(idle_timeout):
+    """
+    Returns the interval at which idle connections are evicted, bounded below so that a zero idle timeout does not
+    make eviction spin
+    :param idle_timeout: float
+        The number of seconds an idle connection is retained
+    :return: float
+        The number of seconds between evictions
+    """
+    return max(idle_timeout / 2, MIN_EVICTION_INTERVAL)
+
+
+class PeerConnectionPool:
+    """
+    Keeps long-lived outbound sockets to peers so that many frames can be sent over a single connection
+    """
+    def __init__(self, max_connections=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT):
+        """
+        Initializes an empty pool of peer connections
+        :param max_connections: int
+            The maximum number of idle connections retained per peer
+        :param idle_timeout: int
+            The number of seconds an idle connection is retained before it is closed
+        """
+        self.lock = threading.Lock()
+        self.logger = QChatLogger(__name__)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+
+        # Idle connections keyed by (host, port), each stored with the time it was last used
+        self.idle = defaultdict(list)
+
+        # Daemon thread that closes connections that have been idle for too long until the pool is closed
+        self.closed = threading.Event()
+        self.reaper = DaemonThread(target=self._reap_idle_connections)
+
+    def _reap_idle_connections(self):
+        """
+        A daemon for periodically evicting idle connections
+        :return: None
+        """
+        while not self.closed.wait(eviction_interval(self.idle_timeout)):
+            self.evict_idle()
+
+    def _connect(self, peer):
+        """
+        Opens a new connection to the peer
+        :param peer: tuple
+            Host/port of the peer
+        :return: `~socket.socket`
+            The connected socket
+        """
+        s = socket.create_connection(peer)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.logger.debug("Opened pooled connection to {}:{}".format(*peer))
+        return s
+
+    @staticmethod
+    def _is_alive(s):
+        """
+        Checks whether an idle connection is still usable.  Peers never write on these connections so a readable
+        socket means that the peer has closed it or that it is in an error state.
+        :param s: `~socket.socket`
+            The socket to check
+        :return: bool
+            Whether the socket can still be used for sending
+        """
+        try:
+            readable, _, _ = select.select([s], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, peer):
+        """
+        Retrieves a connection to the peer, reusing an idle one if possible
+        :param peer: tuple
+            Host/port of the peer
+        :return: tuple
+            The socket and whether it was reused from the pool
+        """
+        with self.lock:
+            idle = self.idle[peer]
+            while idle:
+                s, _ = idle.pop()
+                if self._is_alive(s):
+                    return s, True
+                s.close()
+
+        return self._connect(peer), False
+
+    def release(self, peer, s):
+        """
+        Returns a connection to the pool after use
+        :param peer: tuple
+            Host/port of the peer
+        :param s: `~socket.socket`
+            The socket to return
+        :return: None
+        """
+        with self.lock:
+            idle = self.idle[peer]
+            if len(idle) < self.max_connections:
+                idle.append((s, time.time()))
+                return
+        s.close()
+
+    def send(self, host, port, message):
+        """
+        Sends a message to the peer over a pooled connection.  A reused connection that turns out to be broken is
+        discarded and the message is sent over a freshly opened one instead.
+        :param host: str
+            Hostname to send to
+        :param port: int
+            Port to send to
+        :param message: bytes
+            Bytes object message
+        :return: None
+        """
+        peer = (host, port)
+        while True:
+            s, reused = self.acquire(peer)
+            try:
+                s.sendall(message)
+            except OSError:
+                s.close()
+                if not reused:
+                    raise
+                self.logger.debug("Pooled connection to {}:{} broken, reconnecting".format(host, port))
+                continue
+
+            self.release(peer, s)
+            return
+
+    def evict_idle(self):
+        """
+        Closes all connections that have been idle for longer than the idle timeout
+        :return: None
+        """
+        now = time.time()
+        with self.lock:
+            for peer, idle in self.idle.items():
+                expired = [s for s, last_used in idle if now - last_used > self.idle_timeout]
+                idle[:] = [(s, last_used) for s, last_used in idle if now - last_used <= self.idle_timeout]
+                for s in expired:
+                    self.logger.debug("Evicting idle connection to {}:{}".format(*peer))
+                    s.close()
+
+    def close(self):
+        """
+        Closes all pooled connections and stops evicting idle connections
+        :return: None
+        """
+        self.closed.set()
+        with self.lock:
+            for idle in self.idle.values():
+                for s, _ in idle:
+                    s.close()
+            self.idle.clear()
+
+
 class QChatConnection:
     def __init__(self, name, cqc_connection, config):
         """
@@ -41,34 +221,62 @@ class QChatConnection:
         # Listening configuration
         self.host = config['host']
         self.port = config['port']
+        self.backlog = config.get("backlog", DEFAULT_BACKLOG)
+        self.max_frame_size = config.get("max_frame_size", DEFAULT_MAX_FRAME_SIZE)
 
-        # Inbound message queue
-        self.message_queue = []
+        # Outbound connection configuration
+        self.pool_size = config.get("pool_size", DEFAULT_POOL_SIZE)
+        self.pool_idle_timeout = config.get("pool_idle_timeout", DEFAULT_POOL_IDLE_TIMEOUT)
+
+        # Inbound message queue, bounded in total, per message type and per sender
+        queue_limits = config.get("queue_limits", {})
+        type_limits = dict(DEFAULT_TYPE_QUEUE_LIMITS, **queue_limits.get("types", {}))
+        self.message_queue = MessageChannel(
+            max_depth=queue_limits.get("max_depth", DEFAULT_MAX_QUEUE_DEPTH),
+            type_limits={bytes(header, 'utf-8'): limit for header, limit in type_limits.items()},
+            sender_limit=queue_limits.get("per_sender", DEFAULT_SENDER_QUEUE_LIMIT)
+        )
 
         # Daemon threads
         self.cqc = cqc_connection
+        self._start_transport()
+
+    def _start_transport(self):
+        """
+        Sets up the outbound connection pool and the listening socket served by a daemon thread
+        :return: None
+        """
+        # Pool of outbound connections to peers
+        self.pool = PeerConnectionPool(max_connections=self.pool_size, idle_timeout=self.pool_idle_timeout)
+
         self.listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.classical_thread = DaemonThread(target=self.listen_for_classical)
 
     def __del__(self):
         """
-        Makes sure to close the socket used for classical communications.
+        Makes sure to close the sockets used for classical communications.
         :return: None
         """
         if self.listening_socket:
             self.listening_socket.close()
+        self.pool.close()
 
     def get_connection_info(self):
         """
-        Returns a dictionary containing host/port information for the socket used in classical communication.
+        Returns a dictionary containing host/port information for the socket used in classical communication
+        along with the payload encodings this connection can receive, whether it accepts signature trailers and
+        whether it follows protocols with options.
         :return: dict
             Dictionary containing info.
         """
         info = {
             "connection": {
                 "host": self.host,
-                "port": self.port
+                "port": self.port,
+                "encodings": list(ENCODINGS.keys()),
+                "signature_trailer": True,
+                "protocol_options": True
             }
         }
         return info
@@ -79,9 +287,9 @@ class QChatConnection:
         :return: None
         """
         self.listening_socket.bind((self.host, self.port))
+        self.listening_socket.listen(self.backlog)
         while True:
             self.logger.debug("Listening for incoming connection")
-            self.listening_socket.listen(1)
             conn, addr = self.listening_socket.accept()
             self.logger.debug("Got connection from {}".format(addr))
             self.start_handler(conn, addr)
@@ -98,19 +306,118 @@ class QChatConnection:
 
     def _handle_connection(self, conn, addr):
         """
-        Receives incoming QChat Messages and verifies their structure before storing them
-        so that they can be retrieved.
+        Receives a stream of incoming QChat Messages and verifies their structure before storing them
+        so that they can be retrieved.  The stream is read until the peer closes the connection.
         :param conn: Connection information from sockets
         :param addr: Address information from sockets
         :return: None
         """
+        try:
+            while True:
+                message = self._read_message(conn)
+                if message is None:
+                    break
+
+                # Pass the message up
+                self.logger.debug("Inserting message into queue")
+                self._append_message_to_queue(message)
+        finally:
+            conn.close()
+
+        self.logger.debug("Connection from {} closed".format(addr))
+
+    @staticmethod
+    def _recv_into(conn, view):
+        """
+        Fills the buffer behind the memoryview with data from the connection, looping over short reads
+        :param conn: Connection information from sockets
+        :param view: memoryview
+            Writable view of the buffer to fill
+        :return: int
+            The number of bytes received, less than the length of the view if the peer closed the connection
+        """
+        received = 0
+        while received < len(view):
+            count = conn.recv_into(view[received:])
+            if not count:
+                break
+            received += count
+        return received
+
+    def _read_message(self, conn):
+        """
+        Reads a single length-prefixed QChat Message from the connection
+        :param conn: Connection information from sockets
+        :return: `~qchat.messages.Message`
+            The received message, None if the peer closed the connection before sending another message
+        """
+        prefix = bytearray(FRAME_PREFIX_LENGTH)
+        view = memoryview(prefix)
+
         # Verify the header structure
-        header = conn.recv(HEADER_LENGTH)
+        received = self._recv_into(conn, view[:HEADER_LENGTH])
+        if received == 0:
+            return None
+
+        header = bytes(view[:HEADER_LENGTH])
+        self._verify_header(header)
+
+        # Verify the sender structe
+        received = self._recv_into(conn, view[HEADER_LENGTH:HEADER_LENGTH + MAX_SENDER_LENGTH])
+        sender = self._verify_sender(prefix[HEADER_LENGTH:HEADER_LENGTH + received])
+
+        # Get the message size
+        if self._recv_into(conn, view[-PAYLOAD_SIZE:]) != PAYLOAD_SIZE:
+            raise ConnectionError("Incorrect payload size")
+
+        data_length, encoding, signed = self._verify_size(view[-PAYLOAD_SIZE:])
+
+        # Retrieve the message data directly into a buffer of the advertised size
+        message_data = bytearray(data_length)
+        if self._recv_into(conn, memoryview(message_data)) != data_length:
+            raise ConnectionError("Message data too short")
+
+        return MessageFactory().create_message(header, sender, message_data, encoding=encoding, signed=signed)
+
+    def _verify_size(self, size):
+        """
+        Verifies the flags of the payload size field and that the advertised payload size does not exceed the
+        maximum frame size
+        :param size: bytes
+            The payload size field
+        :return: tuple
+            The payload length, payload encoding, the flag of the trailer carried by the payload
+        """
+        try:
+            data_length, encoding, signed = decode_size(size)
+        except MalformedMessage:
+            raise ConnectionError("Unsupported frame flags")
+
+        if data_length > self.max_frame_size:
+            raise ConnectionError("Message data too long")
+
+        return data_length, encoding, signed
+
+    @staticmethod
+    def _verify_header(header):
+        """
+        Verifies that the header belongs to a known message type
+        :param header: bytes
+            The header read from the connection
+        :return: None
+        """
         if header not in MessageFactory().message_mapping.keys():
             raise ConnectionError("Incorrect message header")
 
-        # Verify the sender structe
-        padded_sender = conn.recv(MAX_SENDER_LENGTH)
+    @staticmethod
+    def _verify_sender(padded_sender):
+        """
+        Verifies the padded sender structure and extracts the sender's name
+        :param padded_sender: bytes
+            The padded sender read from the connection
+        :return: str
+            The name of the sender
+        """
         if len(padded_sender) != MAX_SENDER_LENGTH:
             raise ConnectionError("Incorrect sender length")
 
@@ -119,60 +426,68 @@ class QChatConnection:
         if len(sender) == 0:
             raise ConnectionError("Invalid sender")
 
-        # Get the message size
-        size = conn.recv(PAYLOAD_SIZE)
-        if len(size) != PAYLOAD_SIZE:
-            raise ConnectionError("Incorrect payload size")
-
-        # Retrieve the message data
-        data_length = int.from_bytes(size, 'big')
-        message_data = b''
-        while len(message_data) < data_length:
-            data = conn.recv(1024)
-            if not data:
-                raise ConnectionError("Message data too short")
-            message_data += data
-
-        # Verify the length of the sent data
-        if len(message_data) > data_length or conn.recv(1):
-            raise ConnectionError("Message data too long")
-
-        # Pass the message up
-        self.logger.debug("Inserting message into queue")
-        m = MessageFactory().create_message(header, sender, message_data)
-        self._append_message_to_queue(m)
-        conn.close()
+        return sender
 
     def _append_message_to_queue(self, message):
         """
-        Appends message to the inbound message queue.
+        Appends message to the inbound message queue.  When the queue is full droppable messages are dropped while
+        others block the calling connection handler, which stops reading from the sender's socket until space frees.
         :param message: bytes
             The message to be added to the queue.
         :return: None
         """
-        with self.lock:
-            self.message_queue.append(message)
+        if not self.message_queue.put(message):
+            self.logger.debug("Dropped {} message from {}".format(message.header, message.sender))
 
-    def _pop_message_from_queue(self):
+    def _pop_message_from_queue(self, block=False, timeout=None):
         """
         Removes the oldest message from the head of the queue.
+        :param block: bool
+            Whether to wait for a message if the queue is empty
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
         :return: bytes
             The oldest message stored in the queue.
         """
-        with self.lock:
-            return self.message_queue.pop(0)
+        return self.message_queue.get(block=block, timeout=timeout)
 
-    def recv_message(self):
+    def recv_message(self, block=False, timeout=None):
         """
         Method that receives a message if one exists in the queue.
+        :param block: bool
+            Whether to wait for a message to arrive
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
         :return: bytes
             The message if one exists.  Otherwise None.
         """
-        return self._pop_message_from_queue() if self.message_queue else None
+        return self._pop_message_from_queue(block=block, timeout=timeout)
+
+    def recv_messages(self, max_messages=None, block=False, timeout=None):
+        """
+        Method that receives a batch of the messages stored in the queue.
+        :param max_messages: int
+            The maximum number of messages to receive, None receives all of them
+        :param block: bool
+            Whether to wait for a message to arrive
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
+        :return: list
+            The received messages in arrival order
+        """
+        return self.message_queue.drain(max_messages=max_messages, block=block, timeout=timeout)
+
+    def get_queue_stats(self):
+        """
+        Returns the depth statistics of the inbound message queue.
+        :return: dict
+            Dictionary containing the statistics.
+        """
+        return self.message_queue.get_stats()
 
     def send_message(self, host, port, message):
         """
-        Connects and sends a message to the specified host:port
+        Sends a message to the specified host:port over a pooled connection
         :param host: str
             Hostname to send to
         :param port: int
@@ -181,8 +496,216 @@ class QChatConnection:
             Bytes object message
         :return: None
         """
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((host, port))
-        s.sendall(message)
-        s.close()
+        self.pool.send(host, port, message)
+        self.logger.debug("Sent message to {}:{}".format(host, port))
+
+
+class QChatAsyncConnection(QChatConnection):
+    """
+    Connection that serves all classical communications from a single asyncio event loop instead of a thread per
+    inbound connection.  Exposes the same send_message/recv_message interface as QChatConnection.
+    """
+    def _start_transport(self):
+        """
+        Starts the event loop in a daemon thread and waits for the listening server to come up
+        :return: None
+        """
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+        # Outbound streams keyed by (host, port), each stored with the time it was last used
+        self.streams = {}
+        self.stream_locks = defaultdict(asyncio.Lock)
+
+        self.ready = threading.Event()
+        self.classical_thread = DaemonThread(target=self.listen_for_classical)
+        self.ready.wait()
+        if self.server is None:
+            raise ConnectionError("Failed to listen on {}:{}".format(self.host, self.port))
+
+    def __del__(self):
+        """
+        Makes sure to stop the event loop serving classical communications.
+        :return: None
+        """
+        if self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def listen_for_classical(self):
+        """
+        A daemon running the event loop that accepts and serves incoming connections.
+        :return: None
+        """
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._handle_stream, self.host, self.port, backlog=self.backlog,
+                                     reuse_address=True)
+            )
+        except OSError:
+            self.logger.exception("Failed to start listening on {}:{}".format(self.host, self.port))
+            return
+        finally:
+            self.ready.set()
+
+        self.loop.call_later(eviction_interval(self.pool_idle_timeout), self._evict_idle_streams)
+        self.logger.debug("Listening for incoming connections")
+        self.loop.run_forever()
+
+    async def _handle_stream(self, reader, writer):
+        """
+        Receives a stream of incoming QChat Messages and stores them so that they can be retrieved.
+        :param reader: `~asyncio.StreamReader`
+            Reader for the inbound connection
+        :param writer: `~asyncio.StreamWriter`
+            Writer for the inbound connection
+        :return: None
+        """
+        addr = writer.get_extra_info("peername")
+        self.logger.debug("Got connection from {}".format(addr))
+        try:
+            while True:
+                message = await self._read_message_async(reader)
+                if message is None:
+                    break
+
+                self.logger.debug("Inserting message into queue")
+                await self._append_message_to_queue_async(message)
+        except Exception:
+            self.logger.exception("Dropping connection from {}".format(addr))
+        finally:
+            writer.close()
+
+        self.logger.debug("Connection from {} closed".format(addr))
+
+    async def _append_message_to_queue_async(self, message):
+        """
+        Appends message to the inbound message queue without blocking the event loop.  While the queue is full this
+        stream is not read any further so that the sender is slowed down, an executor thread waits for a consumer
+        to make room and wakes the stream.
+        :param message: `~qchat.messages.Message`
+            The message to be added to the queue.
+        :return: None
+        """
+        while True:
+            try:
+                if not self.message_queue.put(message, block=False):
+                    self.logger.debug("Dropped {} message from {}".format(message.header, message.sender))
+                return
+            except ChannelFull:
+                # Waits are bounded so that executor threads are released when the loop stops
+                await self.loop.run_in_executor(None, self.message_queue.wait_for_room, message,
+                                                BACKPRESSURE_WAIT_TIME)
+
+    async def _read_message_async(self, reader):
+        """
+        Reads a single length-prefixed QChat Message from the stream
+        :param reader: `~asyncio.StreamReader`
+            Reader for the inbound connection
+        :return: `~qchat.messages.Message`
+            The received message, None if the peer closed the connection before sending another message
+        """
+        try:
+            prefix = await reader.readexactly(FRAME_PREFIX_LENGTH)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise ConnectionError("Incomplete message prefix")
+
+        header = prefix[:HEADER_LENGTH]
+        self._verify_header(header)
+        sender = self._verify_sender(prefix[HEADER_LENGTH:HEADER_LENGTH + MAX_SENDER_LENGTH])
+        data_length, encoding, signed = self._verify_size(prefix[-PAYLOAD_SIZE:])
+
+        try:
+            message_data = await reader.readexactly(data_length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Message data too short")
+
+        return MessageFactory().create_message(header, sender, message_data, encoding=encoding, signed=signed)
+
+    async def _send(self, peer, message):
+        """
+        Sends a message over a persistent stream to the peer, reconnecting if the stream was closed
+        :param peer: tuple
+            Host/port of the peer
+        :param message: bytes
+            Bytes object message
+        :return: None
+        """
+        async with self.stream_locks[peer]:
+            while True:
+                reused = peer in self.streams
+                if reused:
+                    reader, writer, _ = self.streams.pop(peer)
+                    # Peers never write on these streams so any data or EOF means the stream is unusable
+                    if reader.at_eof() or writer.is_closing():
+                        writer.close()
+                        continue
+                else:
+                    reader, writer = await asyncio.open_connection(*peer)
+                    self.logger.debug("Opened stream to {}:{}".format(*peer))
+
+                try:
+                    writer.write(message)
+                    await writer.drain()
+                except OSError:
+                    writer.close()
+                    if not reused:
+                        raise
+                    self.logger.debug("Stream to {}:{} broken, reconnecting".format(*peer))
+                    continue
+
+                self.streams[peer] = (reader, writer, time.time())
+                return
+
+    def _evict_idle_streams(self):
+        """
+        Periodically closes outbound streams that have been idle for longer than the idle timeout
+        :return: None
+        """
+        now = time.time()
+        for peer, (_, writer, last_used) in list(self.streams.items()):
+            if now - last_used > self.pool_idle_timeout and not self.stream_locks[peer].locked():
+                self.logger.debug("Evicting idle stream to {}:{}".format(*peer))
+                self.streams.pop(peer)
+                writer.close()
+        self.loop.call_later(eviction_interval(self.pool_idle_timeout), self._evict_idle_streams)
+
+    def send_message(self, host, port, message):
+        """
+        Sends a message to the specified host:port over a persistent stream
+        :param host: str
+            Hostname to send to
+        :param port: int
+            Port to send to
+        :param message: bytes
+            Bytes object message
+        :return: None
+        """
+        asyncio.run_coroutine_threadsafe(self._send((host, port), message), self.loop).result()
         self.logger.debug("Sent message to {}:{}".format(host, port))
+
+
+TRANSPORTS = {
+    THREADED_TRANSPORT: QChatConnection,
+    ASYNCIO_TRANSPORT: QChatAsyncConnection
+}
+
+
+def create_connection(name, cqc_connection, config):
+    """
+    Constructs the connection for the transport engine selected in the configuration
+    :param name: str
+        Name of the host (Must be one available by SimulaQron CQC).
+    :param cqc_connection: `cqc.pythonLib.CQCConnection`
+        The Classical Quantum Combiner Connection over which quantum communication occurs.
+    :param config: dict
+        JSON configuration for the connection, the "transport" key selects the engine.
+    :return: `~qchat.connection.QChatConnection`
+        The constructed connection
+    """
+    transport = config.get("transport", THREADED_TRANSPORT)
+    if transport not in TRANSPORTS:
+        raise ConnectionError("Unknown transport {}".format(transport))
+    return TRANSPORTS[transport](name=name, cqc_connection=cqc_connection, config=config)
@@ -2,14 +2,33 @@ import threading
 import time
 import json
 import os
+import random
 from collections import defaultdict
-from qchat.connection import QChatConnection
-from qchat.cryptobox import QChatSigner, QChatVerifier
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from functools import partial
+from qchat.channel import MessageChannel
+from qchat.connection import create_connection
+from qchat.cryptobox import RSA_ALGORITHM, VerifierCache, create_signer, init_process_signer, sign_batch, \
+                            verify_signature, verify_signatures
 from qchat.db import UserDB
 from qchat.log import QChatLogger
-from qchat.messages import GETUMessage, PUTUMessage, RGSTMessage
+from qchat.messages import ENCODINGS, JSON_ENCODING, GETUMessage, NACKMessage, PUTUMessage, RGSTMessage, as_bytes
+from qchat.sequencing import NACK_DELAY, ReorderBuffer, RetransmitBuffer
+from qchat.workers import DEFAULT_MAX_PENDING, DEFAULT_MAX_WORKERS, DEFAULT_TYPE_LIMITS, MessageWorkerPool, \
+                          map_batches
 
 GLOBAL_SLEEP_TIME = 0.001
+DEFAULT_CONTROL_QUEUE_DEPTH = 1024
+CONTROL_QUEUE_TIMEOUT = 60
+DEFAULT_WIRE_ENCODING = "binary"
+DEFAULT_SESSION_MAC = False
+DEFAULT_SIGNATURE_ALGORITHM = RSA_ALGORITHM
+USER_REQUEST_TIMEOUT = 10
+DEFAULT_UNKNOWN_USER_TTL = 30
+
+
+class ResolutionException(Exception):
+    pass
 
 
 class DaemonThread(threading.Thread):
@@ -44,22 +63,68 @@ class QChatCore:
         # This is information for the root registry server
         self.root_config = self._load_server_config(self.config.get("root"))
 
-        # RSA Signer for handling unauthenticated classical channels
-        self.signer = QChatSigner()
+        # Signer for handling unauthenticated classical channels
+        self.signer = create_signer(self.config.get("signature_algorithm", DEFAULT_SIGNATURE_ALGORITHM))
 
         self._allow_invalid_signatures = allow_invalid_signatures
 
         # Connection to other applications
-        self.connection = QChatConnection(name=name, cqc_connection=cqc_connection, config=self.config)
+        self.connection = create_connection(name=name, cqc_connection=cqc_connection, config=self.config)
 
         # Storage of user/network information
         self.userDB = UserDB()
 
+        # In flight user information requests and users the registry failed to resolve
+        self.user_requests_lock = threading.Lock()
+        self.user_requests = {}
+        self.unknown_users = {}
+        self.unknown_user_ttl = self.config.get("unknown_user_ttl", DEFAULT_UNKNOWN_USER_TTL)
+
+        # Parsed verifiers of known users, dropped when a user's public key is replaced
+        self.verifiers = VerifierCache()
+        self.userDB.addListener(self._invalidate_verifier)
+
         # Load ourselves into our DB
-        self.userDB.addUser(user=self.name, pub=self.signer.get_pub(), **self.connection.get_connection_info())
+        self.userDB.addUser(user=self.name, pub=self.signer.get_pub(), alg=self.signer.alg,
+                            **self.connection.get_connection_info())
+
+        # MAC sessions agreed on by protocols, keyed by peer and protocol session
+        self.sessions = {}
+
+        # Inbound control messages for protocols, bounded per sender and protocol session
+        control_depth = self.config.get("queue_limits", {}).get("control", DEFAULT_CONTROL_QUEUE_DEPTH)
+        self.control_message_queue = defaultdict(partial(MessageChannel, max_depth=control_depth))
+
+        # Per peer sequencing of control messages so that they are delivered in order and can be retransmitted
+        self.sequence_epoch = random.getrandbits(32)
+        self.sequencing_lock = threading.Lock()
+        self.reorder_buffers = {}
+        self.retransmit_buffers = {}
+
+        # Bounded worker pools for processing inbound messages and optional processes for verifying signatures
+        worker_config = self.config.get("workers", {})
+        type_limits = dict(DEFAULT_TYPE_LIMITS, **worker_config.get("type_limits", {}))
+        self.workers = MessageWorkerPool(
+            handler=self.process_message,
+            max_workers=worker_config.get("max_workers", DEFAULT_MAX_WORKERS),
+            max_pending=worker_config.get("max_pending", DEFAULT_MAX_PENDING),
+            type_limits={bytes(header, 'utf-8'): limit for header, limit in type_limits.items()}
+        )
+        self.signature_processes = worker_config.get("signature_processes", 0)
+        self.signature_executor = None
+        if self.signature_processes:
+            self.signature_executor = ProcessPoolExecutor(self.signature_processes)
+
+        # Optional processes holding our private key for signing batches of outbound messages
+        self.signing_processes = worker_config.get("signing_processes", 0)
+        self.signing_executor = None
+        if self.signing_processes:
+            self.signing_executor = ProcessPoolExecutor(self.signing_processes, initializer=init_process_signer,
+                                                        initargs=(self.signer.alg, self.signer.export_key()))
 
         # Start our inbound/outbound message handlers
         self.message_processor = DaemonThread(target=self.read_from_connection)
+        self.retransmission_requester = DaemonThread(target=self.request_retransmissions)
 
         # Register with the root registry
         self._register_with_root_server()
@@ -67,9 +132,6 @@ class QChatCore:
         # Storage of distributed qubit information
         self.qubit_history = defaultdict(list)
 
-        # Inbound control messages for protocols
-        self.control_message_queue = defaultdict(list)
-
     def _load_server_config(self, name):
         """
         Obtains the hosts server configuration from the config file
@@ -117,39 +179,83 @@ class QChatCore:
         Processes inbound messages from the application connection
         :return: None
         """
-        while not time.sleep(GLOBAL_SLEEP_TIME):
-            message = self.connection.recv_message()
-            if message:
-                self.start_process_thread(message)
-
-    def start_process_thread(self, message):
-        """
-        Forks off a thread for handling messages so that they can be processed in parallel
+        while True:
+            for message, verified in self._verify_batch(self.connection.recv_messages(block=True)):
+                self.start_process_thread(message, verified=verified)
+
+    def _verify_batch(self, messages):
+        """
+        Internal method for verifying the signatures of a batch of inbound messages in the signature process pool.
+        Messages with incorrect signatures are dropped, the order of the remaining messages is preserved.
+        :param messages: list
+            The inbound messages in arrival order
+        :return: list
+            Tuples of each remaining message and whether its signature was verified
+        """
+        if self.signature_executor is None or self._allow_invalid_signatures:
+            return [(message, False) for message in messages]
+
+        # Messages from unknown users or without a signature are left to process_message
+        pending = [message for message in messages if message.verify and message.signature is not None and
+                   message.mac is None and self.userDB.hasUser(message.sender)]
+        tasks = [(self.userDB.getPublicKey(m.sender), m.get_signed_data(), m.signature,
+                  self.userDB.getPublicKeyAlgorithm(m.sender)) for m in pending]
+        results = dict(zip(map(id, pending), map_batches(self.signature_executor, verify_signatures, tasks,
+                                                         self.signature_processes)))
+
+        verified_messages = []
+        for message in messages:
+            verified = results.get(id(message))
+            if verified is False:
+                self.logger.warning("Dropped {} message from {}, incorrect signature".format(message.header,
+                                                                                             message.sender))
+                continue
+            verified_messages.append((message, bool(verified)))
+        return verified_messages
+
+    def start_process_thread(self, message, verified=False):
+        """
+        Passes a message to the bounded worker pool so that messages can be processed in parallel
         :param message: `~qchat.messages.Message`
             The message we obtained from the application connection
+        :param verified: bool
+            Whether the signature of the message was already verified
         :return: None
         """
-        t = threading.Thread(target=self.process_message, args=(message,))
-        t.start()
+        self.workers.submit(message, verified=verified)
 
-    def process_message(self, message):
+    def process_message(self, message, verified=False):
         """
         The primary message handling entrypoint, performs signature verification/stripping before passing the
         message to a specific handler
         :param message: `~qchat.messages.Message`
             The inbound message from the application connection
+        :param verified: bool
+            Whether the signature of the message was already verified
         :return: None
         """
         self.logger.debug("Processing {} message from {}: {}".format(message.header, message.sender, message.data))
 
         # Verify the signature on the message for key message types
         if message.verify:
+            # Messages from unknown senders are processed again once the registry answered, without holding a worker
             if not self.userDB.hasUser(message.sender):
-                self.requestUserInfo(message.sender)
+                future = self.requestUserInfo(message.sender)
+                if not future.done():
+                    self.logger.debug("Deferred {} message from {}".format(message.header, message.sender))
+                    future.add_done_callback(partial(self._resume_message, message, verified))
+                    return
+                if future.exception() is not None:
+                    raise ResolutionException("Failed to get {} info from registry".format(message.sender))
 
             message, signature = self._strip_signature(message)
-            if not self._allow_invalid_signatures:
-                self._verify_message(message, signature)
+            if verified:
+                self.logger.debug("Signature verified in batch")
+            elif not self._allow_invalid_signatures:
+                if message.mac is not None:
+                    self._verify_session_mac(message)
+                else:
+                    self._verify_message(message, signature)
             else:
                 self.logger.warning("Will not verify message signature")
 
@@ -157,21 +263,70 @@ class QChatCore:
         elif message.strip:
             message, _ = self._strip_signature(message)
 
-        handler = self.proc_map.get(message.header, self._store_control_message)
+        handler = self.proc_map.get(message.header, self._deliver_control_message)
         handler(message)
 
         self.logger.debug("Completed processing message")
 
-    def _sign_message(self, message):
+    def _resume_message(self, message, verified, future):
+        """
+        Internal callback that processes a deferred message again once its sender's information was requested,
+        messages of senders that could not be resolved are dropped
+        :param message: `~qchat.messages.Message`
+            The deferred message
+        :param verified: bool
+            Whether the signature of the message was already verified
+        :param future: `~concurrent.futures.Future`
+            The completed request for the sender's information
+        :return: None
+        """
+        reason = future.exception()
+        if reason is not None:
+            self.logger.warning("Dropped {} message from {}, {}".format(message.header, message.sender, reason))
+            return
+        self.start_process_thread(message, verified=verified)
+
+    def _sign_message(self, message, trailer=True):
         """
         Internal method for signing outbound messages to assure authentication
         :param message: `~qchat.messages.Message`
             The message to be signed
+        :param trailer: bool
+            Whether the receiver accepts the signature as a trailer, otherwise it is carried in the message data
         :return: `~qchat.messages.Message`
             The message with a signature attached
         """
-        sig = self.signer.sign(message.encode_message())
-        message.data["sig"] = sig.decode("ISO-8859-1")
+        return self._attach_signature(message, self.signer.sign(message.get_signed_data()), trailer)
+
+    def _attach_signature(self, message, signature, trailer):
+        """
+        Internal method for attaching the signature of a message in the form the receiver understands.  Peers that
+        do not accept signature trailers expect the signature in the "sig" field of the message data.
+        :param message: `~qchat.messages.Message`
+            The signed message
+        :param signature: bytes
+            The signature over the message's signed data
+        :param trailer: bool
+            Whether the receiver accepts the signature as a trailer
+        :return: `~qchat.messages.Message`
+            The message with a signature attached
+        """
+        if trailer:
+            message.signature = signature
+        else:
+            message.data["sig"] = signature
+        return message
+
+    def _mac_message(self, message):
+        """
+        Internal method for authenticating outbound messages with the MAC session they were attached to
+        :param message: `~qchat.messages.Message`
+            The message to authenticate
+        :return: `~qchat.messages.Message`
+            The message with a sequence number and MAC attached
+        """
+        message.sequence = message.session.next_sequence()
+        message.mac = message.session.mac(message.get_mac_data())
         return message
 
     def _strip_signature(self, message):
@@ -182,28 +337,109 @@ class QChatCore:
         :return: tuple
             A tuple of the message without the signature data, signature
         """
-        signature = message.data.pop("sig").encode("ISO-8859-1")
+        signature = message.signature
+        message.signature = None
+
+        # Peers that do not send signature trailers carry the signature in the message data
+        if signature is None and isinstance(message.data, dict) and "sig" in message.data:
+            signature = as_bytes(message.data.pop("sig"))
         return message, signature
 
     def _verify_message(self, message, signature):
         """
-        Internal method for verifying the signature provided with a message
+        Internal method for verifying the signature provided with a message.  The signed data is rebuilt from the
+        message data received on the wire rather than by encoding the message again.
         :param message: `~qchat.messages.Message`
             The message we want to verify
         :param signature: bytes
             The signature we want to verify
         :return: None
         """
-        data = message.encode_message()
+        if signature is None:
+            raise Exception("Obtained message without signature")
+
+        data = message.get_signed_data()
 
         # Use the stored public key for verification
         pub = self.userDB.getPublicKey(message.sender)
+        alg = self.userDB.getPublicKeyAlgorithm(message.sender)
+
+        if self.signature_executor:
+            verified = self.signature_executor.submit(verify_signature, pub, data, signature, alg).result()
+        else:
+            verified = self.verifiers.get_verifier(message.sender, pub, alg).verify(data, signature)
 
-        if not QChatVerifier(pub).verify(data, signature):
+        if not verified:
             raise Exception("Obtained message with incorrect signature")
 
         self.logger.debug("Successfully verified signature")
 
+    def _verify_session_mac(self, message):
+        """
+        Internal method for verifying the session MAC provided with a message
+        :param message: `~qchat.messages.Message`
+            The message we want to verify
+        :return: None
+        """
+        session = self.sessions.get((message.sender, message.data.get("session_id")))
+        if session is None:
+            raise Exception("Obtained message for unknown session")
+
+        if not session.verify(message.sequence, message.get_mac_data(), message.mac):
+            raise Exception("Obtained message with incorrect MAC")
+
+        message.mac = None
+        self.logger.debug("Successfully verified session MAC")
+
+    def _invalidate_verifier(self, user, fields):
+        """
+        Internal listener for user database changes that drops the cached verifier of a user whose key changed
+        :param user: str
+            The name of the user
+        :param fields: list
+            The names of the changed fields
+        :return: None
+        """
+        if "pub" in fields or "alg" in fields:
+            self.verifiers.invalidate(user)
+
+    def _negotiate_trailer(self, connection):
+        """
+        Internal method for deciding whether signatures of messages sent to a peer are appended as trailers.  Peers
+        that do not advertise support for signature trailers receive the signature in the message data.
+        :param connection: dict
+            The connection information of the peer
+        :return: bool
+            Whether to use a signature trailer
+        """
+        return bool(connection.get("signature_trailer", False))
+
+    def _negotiate_protocol_options(self, connection):
+        """
+        Internal method for deciding whether protocols led with a peer may use options such as EPR windows, batch
+        reconciliation, other error correcting codes and sessions.  Peers that do not advertise support for them
+        only follow the baseline protocols.
+        :param connection: dict
+            The connection information of the peer
+        :return: bool
+            Whether to use protocol options
+        """
+        return bool(connection.get("protocol_options", False))
+
+    def _negotiate_encoding(self, connection):
+        """
+        Internal method for selecting the payload encoding of messages sent to a peer.  Our configured encoding is
+        used when the peer advertises support for it, otherwise we fall back to JSON.
+        :param connection: dict
+            The connection information of the peer
+        :return: int
+            The payload encoding to use
+        """
+        preferred = self.config.get("wire_encoding", DEFAULT_WIRE_ENCODING)
+        if preferred in connection.get("encodings", []):
+            return ENCODINGS[preferred]
+        return JSON_ENCODING
+
     def _pass_message_data(self, message, handler):
         """
         Internal method for passing the message data as arguments to the message handlers
@@ -215,16 +451,164 @@ class QChatCore:
         """
         handler(**message.data)
 
+    def _get_reorder_buffer(self, user):
+        """
+        Internal method for obtaining the buffer restoring the order of a peer's sequenced messages
+        :param user: str
+            The peer
+        :return: `~qchat.sequencing.ReorderBuffer`
+            The reorder buffer of the peer
+        """
+        with self.sequencing_lock:
+            if user not in self.reorder_buffers:
+                self.reorder_buffers[user] = ReorderBuffer(deliver=self._store_control_message)
+            return self.reorder_buffers[user]
+
+    def _get_retransmit_buffer(self, user):
+        """
+        Internal method for obtaining the buffer retaining the sequenced messages sent to a peer
+        :param user: str
+            The peer
+        :return: `~qchat.sequencing.RetransmitBuffer`
+            The retransmit buffer of the peer
+        """
+        with self.sequencing_lock:
+            if user not in self.retransmit_buffers:
+                self.retransmit_buffers[user] = RetransmitBuffer()
+            return self.retransmit_buffers[user]
+
+    def _deliver_control_message(self, message):
+        """
+        Internal method for handling messages that do not have specific handlers.  Sequenced messages pass through
+        the sender's reorder buffer so that they are stored in the order they were sent.
+        :param message: `~qchat.messages.Message`
+            The message to deliver
+        :return: None
+        """
+        if not message.ordered or "seq" not in message.data:
+            self._store_control_message(message)
+            return
+
+        epoch, sequence = message.data.pop("epoch"), message.data.pop("seq")
+        if not self._get_reorder_buffer(message.sender).push(epoch, sequence, message):
+            self.logger.debug("Dropped {} message {} from {}".format(message.header, sequence, message.sender))
+
+    def request_retransmissions(self):
+        """
+        Requests the retransmission of sequenced messages that peers have been missing for longer than the NACK
+        delay
+        :return: None
+        """
+        while not time.sleep(NACK_DELAY / 2):
+            for user, buffer in list(self.reorder_buffers.items()):
+                epoch, missing = buffer.get_missing()
+                if missing:
+                    self.logger.debug("Requesting retransmission of {} from {}".format(missing, user))
+                    self._send_nack(user, {"epoch": epoch, "missing": missing})
+
+    def _send_nack(self, user, message_data):
+        """
+        Internal method for sending a NACK message
+        :param user: str
+            The user to send the message to
+        :param message_data: dict
+            The epoch along with the missing or lost sequence numbers
+        :return: None
+        """
+        try:
+            self.sendMessage(user, NACKMessage(sender=self.name, message_data=message_data))
+        except Exception:
+            self.logger.exception("Failed to send NACK to {}".format(user))
+
+    def _handle_nack(self, message):
+        """
+        Internal method for handling NACK messages.  Retained messages the peer is missing are retransmitted and
+        the peer is told which messages can no longer be retransmitted, messages our peer reports lost are skipped.
+        :param message: `~qchat.messages.NACKMessage`
+            The NACK message
+        :return: None
+        """
+        epoch = message.data["epoch"]
+        if "lost" in message.data:
+            self._get_reorder_buffer(message.sender).skip(epoch, message.data["lost"])
+            return
+
+        if epoch != self.sequence_epoch:
+            return
+
+        frames, lost = self._get_retransmit_buffer(message.sender).lookup(message.data["missing"])
+        for host, port, frame in frames:
+            self.connection.send_message(host, port, frame)
+        if lost:
+            self._send_nack(message.sender, {"epoch": epoch, "lost": lost})
+
     def _store_control_message(self, message):
         """
-        Internal method for handling messages that do not have specific handlers
+        Internal method for storing a control message into the queue of the protocol session it belongs to.  Waits
+        for space when the queue is full so that the sender is slowed down.
         :param message: `~qchat.messages.Message`
             The message to store
         :return: None
         """
-        self.control_message_queue[message.sender].append(message)
+        key = (message.sender, message.data.get("session_id"))
+        queue = self.control_message_queue.get(key)
+        if queue is None:
+            # Messages without a session are kept for protocols of peers that do not use sessions
+            if key[1] is not None:
+                self.logger.warning("Dropped {} message from {}, unknown session".format(message.header,
+                                                                                         message.sender))
+                return
+            queue = self.control_message_queue[key]
+
+        if not queue.put(message, timeout=CONTROL_QUEUE_TIMEOUT):
+            self.logger.warning("Dropped {} message from {}, control queue full".format(message.header, message.sender))
+            return
         self.logger.debug("Stored message into control queue")
 
+    def _new_session_id(self):
+        """
+        Internal method for generating the identifier of a protocol session we lead
+        :return: int
+            The session identifier
+        """
+        return random.getrandbits(63)
+
+    def _open_control_queue(self, user, session_id):
+        """
+        Internal method for creating the control queue of a protocol session
+        :param user: str
+            The peer of the protocol
+        :param session_id: int
+            The identifier of the protocol session
+        :return: `~qchat.channel.MessageChannel`
+            The control queue of the session
+        """
+        return self.control_message_queue[(user, session_id)]
+
+    def _close_control_queue(self, user, session_id):
+        """
+        Internal method for removing the control queue of a finished protocol session, later messages of the
+        session are dropped
+        :param user: str
+            The peer of the protocol
+        :param session_id: int
+            The identifier of the protocol session
+        :return: None
+        """
+        self.control_message_queue.pop((user, session_id), None)
+
+    def _close_session(self, user, session_id):
+        """
+        Internal method for removing the MAC session of a protocol session, protocols that fail before concluding
+        leave their session in the table
+        :param user: str
+            The peer of the protocol
+        :param session_id: int
+            The identifier of the protocol session
+        :return: None
+        """
+        self.sessions.pop((user, session_id), None)
+
     def _get_registration_data(self):
         """
         Internal method for constructing this server's registration data
@@ -233,7 +617,8 @@ class QChatCore:
         """
         reg_data = {
             "user": self.name,
-            "pub": self.getPublicKey().decode("ISO-8859-1")
+            "pub": self.getPublicKey().decode("ISO-8859-1"),
+            "alg": self.signer.alg
         }
         reg_data.update(self.connection.get_connection_info())
 
@@ -241,6 +626,44 @@ class QChatCore:
 
         return reg_data
 
+    def getQueueStats(self):
+        """
+        Returns the depth and load shedding statistics of the inbound and control message queues
+        :return: dict
+            Statistics of the inbound queue and of the control queue of each peer and protocol session
+        """
+        return {
+            "inbound": self.connection.get_queue_stats(),
+            "control": {key: queue.get_stats() for key, queue in list(self.control_message_queue.items())}
+        }
+
+    def getDeliveryStats(self):
+        """
+        Returns the statistics of sequenced control message delivery
+        :return: dict
+            Per peer reorder statistics and the number of messages retransmitted to each peer
+        """
+        return {
+            "reorder": {user: buffer.get_stats() for user, buffer in list(self.reorder_buffers.items())},
+            "retransmitted": {user: buffer.retransmitted for user, buffer in list(self.retransmit_buffers.items())}
+        }
+
+    def getWorkerStats(self):
+        """
+        Returns the metrics of the worker pools processing inbound messages
+        :return: dict
+            Per message type counts and the time messages waited for a worker
+        """
+        return self.workers.get_stats()
+
+    def getVerifierStats(self):
+        """
+        Returns the statistics of the signature verifier cache
+        :return: dict
+            The number of cached verifiers along with the cache hits and misses
+        """
+        return self.verifiers.get_stats()
+
     def hasUser(self, user):
         """
         Interface to the user database for checking if a user exists
@@ -260,22 +683,42 @@ class QChatCore:
             The key=value pairs we want to store in the database
         :return: None
         """
-        if user == "*":
+        if kwargs.get("unknown"):
+            self.logger.debug("Registry does not know user {}".format(user))
+            self._complete_user_request(user, exception=ResolutionException("Unknown user {}".format(user)))
+
+        elif user == "*":
             self.logger.debug("Get bulk user info!")
             for info in kwargs["info"]:
                 user_name = info.pop("user")
                 if not self.userDB.hasUser(user_name):
                     self.logger.debug("Adding to user {} info {}".format(user_name, info))
-                    self.userDB.addUser(user_name, **info)
+                    self.userDB.addUser(user_name, **self._normalize_user_info(info))
+                self._complete_user_request(user_name)
+            self._complete_user_request(user)
 
         else:
             self.logger.debug("Adding to user {} info {}".format(user, kwargs))
-            self.userDB.addUser(user, **kwargs)
+            self.userDB.addUser(user, **self._normalize_user_info(kwargs))
+            self._complete_user_request(user)
+
+    def _normalize_user_info(self, info):
+        """
+        Internal method for converting the binary fields of received user information back to bytes, JSON encoded
+        messages carry public keys as ISO-8859-1 strings
+        :param info: dict
+            The user information
+        :return: dict
+            The user information with the public key as bytes
+        """
+        if info.get("pub") is not None:
+            info["pub"] = as_bytes(info["pub"])
+        return info
 
     def getPublicInfo(self, user):
         """
         Returns the relevant public information for the application that is necessary for establishing
-        RSA authenticated classical communication
+        signature authenticated classical communication
         :param user: str
             The user we want the public information for
         :return: dict
@@ -315,32 +758,158 @@ class QChatCore:
         self.connection.send_message(host, port, message.encode_message())
         self.logger.debug("Sent registration to {}:{}".format(host, port))
 
+    def sendMessages(self, messages):
+        """
+        Interface for sending a batch of preconstructed message objects in order.  Signatures are computed in the
+        signing process pool when one is configured, messages that fail to be prepared or signed are dropped.
+        :param messages: list
+            Tuples of the user to send to and the Message object to send
+        :return: None
+        """
+        routes = []
+        for user, message in messages:
+            try:
+                routes.append((user, self._prepare_message(user, message), message))
+            except Exception:
+                self.logger.exception("Failed to send {} message to {}".format(message.header, user))
+
+        unsigned = [(message, trailer) for _, (_, _, trailer), message in routes if message.session is None]
+        signatures = self._sign_batch([message.get_signed_data() for message, _ in unsigned])
+        for (message, trailer), signature in zip(unsigned, signatures):
+            if signature is not None:
+                self._attach_signature(message, signature, trailer)
+
+        for user, (host, port, _), message in routes:
+            if message.session is not None:
+                message = self._mac_message(message)
+            elif message.signature is None and "sig" not in message.data:
+                self.logger.warning("Dropped {} message to {}, failed to sign".format(message.header, user))
+                continue
+            self._transmit(user, host, port, message)
+
+    def _sign_batch(self, data):
+        """
+        Internal method for signing a batch of data, in the signing process pool when one is configured
+        :param data: list
+            The pieces of data to sign
+        :return: list
+            The signature of each piece of data, None where signing failed
+        """
+        if self.signing_executor is None or len(data) < 2:
+            return sign_batch(data, signer=self.signer)
+        return map_batches(self.signing_executor, sign_batch, data, self.signing_processes)
+
     def requestUserInfo(self, user):
         """
-        Requests the specified user's information from the root registry in the network
+        Requests the specified user's information from the root registry in the network.  Concurrent requests for
+        the same user share a single request and users the registry does not know are not requested again until
+        their negative cache entry expires.
         :param user: str
             User we want to obtain information for
-        :return: None
-        """
+        :return: `~concurrent.futures.Future`
+            Completed once the user's information is stored, fails if the registry does not know the user or does
+            not answer in time
+        """
+        with self.user_requests_lock:
+            future = Future()
+            if user != "*" and self.userDB.hasUser(user):
+                future.set_result(None)
+                return future
+
+            # Fail immediately for users the registry recently reported unknown
+            expiry = self.unknown_users.get(user)
+            if expiry is not None and expiry > time.monotonic():
+                future.set_exception(ResolutionException("Unknown user {}".format(user)))
+                return future
+            self.unknown_users.pop(user, None)
+
+            # Share an in flight request for the user
+            if user in self.user_requests:
+                return self.user_requests[user]
+            self.user_requests[user] = future
+
+        # Fail the request if the registry does not answer, without caching the user as unknown
+        timer = threading.Timer(USER_REQUEST_TIMEOUT, self._expire_user_request, args=(user, future))
+        timer.daemon = True
+        timer.start()
+
         # Construct the request message
         request_message_data = {
             "user": user,
         }
         request_message_data.update(self.connection.get_connection_info())
 
-        # Create the messag eobject and sign it
+        # Create the messag eobject and sign it, the signature is carried in the message data as we do not know
+        # whether the registry accepts signature trailers
         m = GETUMessage(sender=self.name, message_data=request_message_data)
-        m = self._sign_message(m)
+        m = self._sign_message(m, trailer=False)
 
         # Send the request to the root registry
-        self.connection.send_message(self.root_config["host"], self.root_config["port"], m.encode_message())
+        try:
+            self.connection.send_message(self.root_config["host"], self.root_config["port"], m.encode_message())
+        except Exception as e:
+            self._complete_user_request(user, exception=e, cache=False)
+
+        return future
+
+    def resolveUser(self, user, timeout=USER_REQUEST_TIMEOUT):
+        """
+        Ensures the specified user's information is stored, waiting for the root registry if it must be requested
+        :param user: str
+            User we want to obtain information for
+        :param timeout: float
+            The number of seconds to wait for the registry
+        :return: None
+        """
+        if self.userDB.hasUser(user):
+            return
+
+        try:
+            self.requestUserInfo(user).result(timeout)
+        except (TimeoutError, ResolutionException):
+            raise ResolutionException("Failed to get {} info from registry".format(user))
+
+    def _expire_user_request(self, user, future):
+        """
+        Internal method for failing a request for a user's information that the registry did not answer, so that
+        the user is requested again by the next lookup
+        :param user: str
+            The user that was requested
+        :param future: `~concurrent.futures.Future`
+            The request to expire
+        :return: None
+        """
+        with self.user_requests_lock:
+            if self.user_requests.get(user) is not future:
+                return
+            self.user_requests.pop(user)
 
-        # Wait for a response from the root registry
-        if user != "*":
-            wait_start = time.time()
-            while not self.userDB.hasUser(user):
-                if time.time() - wait_start > 10:
-                    raise Exception("Failed to get {} info from registry".format(user))
+        if not future.done():
+            future.set_exception(ResolutionException("Registry did not answer for {}".format(user)))
+
+    def _complete_user_request(self, user, exception=None, cache=True):
+        """
+        Internal method for completing the in flight request for a user's information
+        :param user: str
+            The user that was requested
+        :param exception: Exception
+            The reason the request failed, None if the user's information was stored
+        :param cache: bool
+            Whether a failed request is cached so that the user is not requested again until the entry expires
+        :return: None
+        """
+        with self.user_requests_lock:
+            future = self.user_requests.pop(user, None)
+            if exception is None:
+                self.unknown_users.pop(user, None)
+            elif cache:
+                self.unknown_users[user] = time.monotonic() + self.unknown_user_ttl
+
+        if future is not None and not future.done():
+            if exception is None:
+                future.set_result(None)
+            else:
+                future.set_exception(exception)
 
     def sendUserInfo(self, user, connection):
         """
@@ -353,29 +922,75 @@ class QChatCore:
         """
         self.logger.debug("Sending {} info to {}".format(user, connection))
 
-        # Construct and sign the message containing the requested information
-        message = PUTUMessage(sender=self.name, message_data=self.getPublicInfo(user))
-        message = self._sign_message(message)
+        # Construct and sign the message containing the requested information, peers are told explicitly when we do
+        # not know the user so that they do not wait for information that will not come
+        if user == "*" or self.userDB.hasUser(user):
+            message_data = self.getPublicInfo(user)
+        else:
+            message_data = {"user": user, "unknown": True}
+        message = PUTUMessage(sender=self.name, message_data=message_data,
+                              encoding=self._negotiate_encoding(connection))
+        message = self._sign_message(message, trailer=self._negotiate_trailer(connection))
         self.connection.send_message(host=connection["host"], port=connection["port"], message=message.encode_message())
 
-    def sendMessage(self, user, message):
+    def _prepare_message(self, user, message):
         """
-        Interface for sending a preconstructed message object to a user
+        Internal method for resolving the route to a user and selecting the encoding of a message to them
         :param user: str
             The user to send the message to
         :param message: `~qchat.messages.Message`
             The Message object we want to send
-        :return: None
+        :return: tuple
+            The host and port of the user, whether the user accepts signature trailers
         """
         # Ensure we know how to contact the user, if not resolve the information
-        if not self.userDB.hasUser(user):
-            self.requestUserInfo(user)
+        self.resolveUser(user)
 
-        # Get the connection information
+        # Get the connection information and use an encoding the user supports
         connection_info = self.userDB.getConnectionInfo(user)
-        host = connection_info['host']
-        port = connection_info['port']
+        message.encoding = self._negotiate_encoding(connection_info)
 
-        # Sign the message and send it via the connection
-        message = self._sign_message(message)
-        self.connection.send_message(host, port, message.encode_message())
+        # Number sequenced messages, the sequence number is authenticated along with the message data
+        if message.ordered:
+            message.data["epoch"] = self.sequence_epoch
+            message.data["seq"] = self._get_retransmit_buffer(user).assign()
+
+        return connection_info['host'], connection_info['port'], self._negotiate_trailer(connection_info)
+
+    def _transmit(self, user, host, port, message):
+        """
+        Internal method for sending an authenticated message, frames of sequenced messages are retained for
+        retransmission
+        :param user: str
+            The user the message is sent to
+        :param host: str
+            The host of the user
+        :param port: int
+            The port of the user
+        :param message: `~qchat.messages.Message`
+            The authenticated message
+        :return: None
+        """
+        frame = message.encode_message()
+        if message.ordered:
+            self._get_retransmit_buffer(user).store(message.data["seq"], host, port, frame)
+        self.connection.send_message(host, port, frame)
+
+    def sendMessage(self, user, message):
+        """
+        Interface for sending a preconstructed message object to a user
+        :param user: str
+            The user to send the message to
+        :param message: `~qchat.messages.Message`
+            The Message object we want to send
+        :return: None
+        """
+        host, port, trailer = self._prepare_message(user, message)
+
+        # Authenticate the message and send it via the connection, messages of an established session carry a MAC
+        # instead of a signature
+        if message.session is not None:
+            message = self._mac_message(message)
+        else:
+            message = self._sign_message(message, trailer=trailer)
+        self._transmit(user, host, port, message)
@@ -1,7 +1,22 @@
+import hashlib
+import hmac
+import threading
+from functools import lru_cache
 from Crypto.Cipher import AES
-from Crypto.PublicKey import RSA
-from Crypto.Hash import SHA384
-from Crypto.Signature import pkcs1_15
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Hash import SHA256, SHA384
+from Crypto.Protocol.DH import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Signature import eddsa, pkcs1_15
+from qchat.messages import as_bytes
+
+SESSION_KEY_SIZE = 32
+REPLAY_WINDOW_SIZE = 64
+PROCESS_VERIFIER_CACHE_SIZE = 256
+
+# Signature algorithm identifiers carried in registration data
+RSA_ALGORITHM = "rsa"
+ED25519_ALGORITHM = "ed25519"
 
 
 class QChatCipher:
@@ -44,6 +59,8 @@ class QChatSigner:
     Class that implements a simple message signing interface that can
     be retained
     """
+    alg = RSA_ALGORITHM
+
     def __init__(self, key=None):
         self.key = RSA.generate(1024) if not key else key
 
@@ -55,6 +72,25 @@ class QChatSigner:
         """
         return self.key.publickey().exportKey()
 
+    def export_key(self):
+        """
+        Returns the private key of the signing instance so that it can be loaded by worker processes
+        :return: bytes
+            The private key
+        """
+        return self.key.export_key()
+
+    @classmethod
+    def import_key(cls, exported_key):
+        """
+        Constructs a signer from an exported private key
+        :param exported_key: bytes
+            The private key
+        :return: `~qchat.cryptobox.QChatSigner`
+            The signer
+        """
+        return cls(RSA.import_key(exported_key))
+
     def sign(self, data):
         """
         Signs a piece of data using the stored key
@@ -73,6 +109,8 @@ class QChatVerifier:
     """
     Class that implements a message verification interface
     """
+    alg = RSA_ALGORITHM
+
     def __init__(self, pubkey):
         self.pubkey = RSA.import_key(pubkey)
 
@@ -93,3 +131,362 @@ class QChatVerifier:
             return True
         except Exception:
             return False
+
+
+class QChatEd25519Signer(QChatSigner):
+    """
+    Class that implements the message signing interface with Ed25519, keys are generated quickly and signatures
+    are 64 bytes
+    """
+    alg = ED25519_ALGORITHM
+
+    def __init__(self, key=None):
+        self.key = ECC.generate(curve='ed25519') if not key else key
+
+    def get_pub(self):
+        """
+        Returns the public key of the signing instance
+        :return: bytes
+            The public key
+        """
+        return self.key.public_key().export_key(format='PEM').encode('utf-8')
+
+    def export_key(self):
+        """
+        Returns the private key of the signing instance so that it can be loaded by worker processes
+        :return: bytes
+            The private key
+        """
+        return self.key.export_key(format='PEM').encode('utf-8')
+
+    @classmethod
+    def import_key(cls, exported_key):
+        """
+        Constructs a signer from an exported private key
+        :param exported_key: bytes
+            The private key
+        :return: `~qchat.cryptobox.QChatEd25519Signer`
+            The signer
+        """
+        return cls(ECC.import_key(exported_key))
+
+    def sign(self, data):
+        """
+        Signs a piece of data using the stored key
+        :param data: bytes
+            Data to be signed
+        :return: bytes
+            Signature of the data
+        """
+        return eddsa.new(self.key, 'rfc8032').sign(data)
+
+
+class QChatEd25519Verifier(QChatVerifier):
+    """
+    Class that implements the message verification interface for Ed25519 signatures
+    """
+    alg = ED25519_ALGORITHM
+
+    def __init__(self, pubkey):
+        self.pubkey = ECC.import_key(pubkey)
+
+    def verify(self, data, sig):
+        """
+        Verifies the signature against the provided piece of data
+        :param data: bytes
+            The data that was signed
+        :param sig: bytes
+            The signature associated with the data
+        :return: bool
+            Whether verification passed or not
+        """
+        verifier = eddsa.new(self.pubkey, 'rfc8032')
+        try:
+            verifier.verify(data, sig)
+            return True
+        except Exception:
+            return False
+
+
+SIGNERS = {
+    RSA_ALGORITHM: QChatSigner,
+    ED25519_ALGORITHM: QChatEd25519Signer
+}
+
+VERIFIERS = {
+    RSA_ALGORITHM: QChatVerifier,
+    ED25519_ALGORITHM: QChatEd25519Verifier
+}
+
+
+def create_signer(alg=RSA_ALGORITHM, key=None):
+    """
+    Creates a signer for the specified signature algorithm
+    :param alg: str
+        The signature algorithm identifier
+    :param key: obj
+        An existing private key, a key is generated if none is provided
+    :return: `~qchat.cryptobox.QChatSigner`
+        The signer
+    """
+    if alg not in SIGNERS:
+        raise ValueError("Unsupported signature algorithm {}".format(alg))
+    return SIGNERS[alg](key)
+
+
+def create_verifier(pubkey, alg=RSA_ALGORITHM):
+    """
+    Creates a verifier for a public key of the specified signature algorithm
+    :param pubkey: bytes
+        The public key of the signer
+    :param alg: str
+        The signature algorithm identifier
+    :return: `~qchat.cryptobox.QChatVerifier`
+        The verifier
+    """
+    if alg not in VERIFIERS:
+        raise ValueError("Unsupported signature algorithm {}".format(alg))
+    return VERIFIERS[alg](pubkey)
+
+
+class VerifierCache:
+    """
+    Class that retains parsed verifiers of users so that public keys are not imported for every verified message
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.verifiers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_verifier(self, user, pubkey, alg=RSA_ALGORITHM):
+        """
+        Returns the verifier for the user's public key, a new verifier is constructed when the key has changed
+        :param user: str
+            The name of the user
+        :param pubkey: bytes/str
+            The public key of the user
+        :param alg: str
+            The signature algorithm of the public key
+        :return: `~qchat.cryptobox.QChatVerifier`
+            The verifier of the public key
+        """
+        pubkey = as_bytes(pubkey)
+        fingerprint = SHA256.new(bytes(alg, 'utf-8') + b':' + pubkey).digest()
+        with self.lock:
+            entry = self.verifiers.get(user)
+            if entry and entry[0] == fingerprint:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        verifier = create_verifier(pubkey, alg)
+        with self.lock:
+            self.verifiers[user] = (fingerprint, verifier)
+        return verifier
+
+    def invalidate(self, user):
+        """
+        Removes the cached verifier of a user
+        :param user: str
+            The name of the user
+        :return: None
+        """
+        with self.lock:
+            self.verifiers.pop(user, None)
+
+    def get_stats(self):
+        """
+        Returns the cache statistics
+        :return: dict
+            The number of cached verifiers along with the cache hits and misses
+        """
+        with self.lock:
+            return {"size": len(self.verifiers), "hits": self.hits, "misses": self.misses}
+
+
+class QChatKeyAgreement:
+    """
+    Class that implements an ephemeral ECDH key agreement for deriving session MAC keys.  The public keys must be
+    exchanged over signed messages so that the agreement is authenticated.
+    """
+    def __init__(self):
+        self.key = ECC.generate(curve='P-256')
+
+    def get_pub(self):
+        """
+        Returns the ephemeral public key to send to our peer
+        :return: bytes
+            The DER encoded public key
+        """
+        return self.key.public_key().export_key(format='DER')
+
+    def derive_session(self, peer_pub, leader_pub, follower_pub, context, leader):
+        """
+        Derives a MAC session from our peer's ephemeral public key.  Each direction of the session uses its own key.
+        :param peer_pub: bytes
+            The DER encoded ephemeral public key of our peer
+        :param leader_pub: bytes
+            The ephemeral public key of the protocol leader
+        :param follower_pub: bytes
+            The ephemeral public key of the protocol follower
+        :param context: bytes
+            Data binding the keys to the session, such as the names of the participants
+        :param leader: bool
+            Whether we are the leader of the protocol
+        :return: `~qchat.cryptobox.QChatMACSession`
+            The MAC session shared with our peer
+        """
+        def kdf(secret):
+            return HKDF(secret, 2 * SESSION_KEY_SIZE, leader_pub + follower_pub, SHA256, context=context)
+
+        keys = key_agreement(eph_priv=self.key, eph_pub=ECC.import_key(peer_pub), kdf=kdf)
+        leader_key, follower_key = keys[:SESSION_KEY_SIZE], keys[SESSION_KEY_SIZE:]
+        if leader:
+            return QChatMACSession(send_key=leader_key, recv_key=follower_key)
+        return QChatMACSession(send_key=follower_key, recv_key=leader_key)
+
+
+class QChatMACSession:
+    """
+    Class that implements HMAC-SHA256 authentication of messages within a session.  Outbound messages are numbered
+    and inbound sequence numbers are checked against a sliding window to reject replays.
+    """
+    def __init__(self, send_key, recv_key):
+        self.send_key = send_key
+        self.recv_key = recv_key
+        self.lock = threading.Lock()
+        self.send_sequence = 0
+        self.recv_highest = -1
+        self.recv_window = 0
+
+    def next_sequence(self):
+        """
+        Reserves the sequence number of the next outbound message
+        :return: int
+            The sequence number
+        """
+        with self.lock:
+            sequence = self.send_sequence
+            self.send_sequence += 1
+            return sequence
+
+    def mac(self, data):
+        """
+        Computes the MAC of outbound data
+        :param data: bytes
+            The data to authenticate, including its sequence number
+        :return: bytes
+            The MAC of the data
+        """
+        return hmac.new(self.send_key, data, hashlib.sha256).digest()
+
+    def verify(self, sequence, data, mac):
+        """
+        Verifies the MAC of inbound data and that its sequence number was not seen before
+        :param sequence: int
+            The sequence number of the message
+        :param data: bytes
+            The authenticated data, including the sequence number
+        :param mac: bytes
+            The MAC provided with the data
+        :return: bool
+            Whether verification passed or not
+        """
+        if not hmac.compare_digest(hmac.new(self.recv_key, data, hashlib.sha256).digest(), mac):
+            return False
+
+        with self.lock:
+            if sequence > self.recv_highest:
+                shift = sequence - self.recv_highest
+                self.recv_window = ((self.recv_window << shift) | 1) & ((1 << REPLAY_WINDOW_SIZE) - 1)
+                self.recv_highest = sequence
+                return True
+
+            offset = self.recv_highest - sequence
+            if offset >= REPLAY_WINDOW_SIZE or self.recv_window & (1 << offset):
+                return False
+            self.recv_window |= 1 << offset
+            return True
+
+
+@lru_cache(maxsize=PROCESS_VERIFIER_CACHE_SIZE)
+def _process_verifier(pubkey, alg):
+    """
+    Returns a verifier for the public key, verifiers are retained per process so that worker processes import
+    each key once
+    :param pubkey: bytes
+        The public key of the signer
+    :param alg: str
+        The signature algorithm of the public key
+    :return: `~qchat.cryptobox.QChatVerifier`
+        The verifier
+    """
+    return create_verifier(pubkey, alg)
+
+
+def verify_signature(pubkey, data, sig, alg=RSA_ALGORITHM):
+    """
+    Verifies a signature, usable as a task for process pools
+    :param pubkey: bytes
+        The public key of the signer
+    :param data: bytes
+        The data that was signed
+    :param sig: bytes
+        The signature associated with the data
+    :param alg: str
+        The signature algorithm of the public key
+    :return: bool
+        Whether verification passed or not
+    """
+    try:
+        return _process_verifier(pubkey, alg).verify(data, sig)
+    except Exception:
+        return False
+
+
+def verify_signatures(tasks):
+    """
+    Verifies a batch of signatures, usable as a task for process pools
+    :param tasks: list
+        Tuples of the public key, signed data, signature and signature algorithm
+    :return: list
+        Whether verification passed for each task
+    """
+    return [verify_signature(*task) for task in tasks]
+
+
+_process_signer = None
+
+
+def init_process_signer(alg, exported_key):
+    """
+    Loads the signer used by sign_batch, usable as the initializer of process pools
+    :param alg: str
+        The signature algorithm of the key
+    :param exported_key: bytes
+        The exported private key
+    :return: None
+    """
+    global _process_signer
+    _process_signer = SIGNERS[alg].import_key(exported_key)
+
+
+def sign_batch(data, signer=None):
+    """
+    Signs a batch of data, usable as a task for process pools initialized with init_process_signer
+    :param data: list
+        The pieces of data to sign
+    :param signer: `~qchat.cryptobox.QChatSigner`
+        The signer to use, defaults to the signer loaded by init_process_signer
+    :return: list
+        The signature of each piece of data, None where signing failed
+    """
+    signer = signer or _process_signer
+    signatures = []
+    for d in data:
+        try:
+            signatures.append(signer.sign(d))
+        except Exception:
+            signatures.append(None)
+    return signatures
@@ -1,5 +1,6 @@
 import threading
 from collections import defaultdict
+from qchat.cryptobox import RSA_ALGORITHM
 from qchat.log import QChatLogger
 
 
@@ -15,6 +16,7 @@ class UserDB:
         self.lock = threading.Lock()
         self.logger = QChatLogger(__name__)
         self.db = defaultdict(dict)
+        self.listeners = []
 
     def _get_user(self, user):
         """
@@ -26,6 +28,27 @@ class UserDB:
         """
         return self.db.get(user)
 
+    def addListener(self, listener):
+        """
+        Registers a function that is called whenever a user's data is replaced or removed
+        :param listener: func
+            Called with the name of the user and the names of the changed fields
+        :return: None
+        """
+        self.listeners.append(listener)
+
+    def _notify(self, user, fields):
+        """
+        Notifies the registered listeners of changed user data
+        :param user: str
+            The name of the user
+        :param fields: list
+            The names of the changed fields
+        :return: None
+        """
+        for listener in self.listeners:
+            listener(user, fields)
+
     def hasUser(self, user):
         """
         Checks if the database has the specified user
@@ -49,6 +72,19 @@ class UserDB:
             raise DBException("User {} does not exist in the database!")
         return info.get('pub')
 
+    def getPublicKeyAlgorithm(self, user):
+        """
+        Returns the signature algorithm of the specified user's public key
+        :param user: str
+            The name of the user
+        :return: str
+            The signature algorithm identifier, RSA for users registered without one
+        """
+        info = self._get_user(user)
+        if not info:
+            raise DBException("User {} does not exist in the database!")
+        return info.get('alg', RSA_ALGORITHM)
+
     def getMessageKey(self, user):
         """
         Retrieves the key used for encrypting/decrypting messages
@@ -90,6 +126,7 @@ class UserDB:
             raise DBException("User {} does not exist in the database!")
         for field in fields:
             info.pop(field)
+        self._notify(user, fields)
 
     def deleteUser(self, user):
         """
@@ -99,7 +136,8 @@ class UserDB:
         :return: None
         """
         self.logger.debug("Deleting user {}".format(user))
-        self.db.pop(user)
+        info = self.db.pop(user)
+        self._notify(user, list(info.keys()))
 
     def changeUserInfo(self, user, **kwargs):
         """
@@ -113,6 +151,7 @@ class UserDB:
         self.logger.debug("Changing user {} with data {}".format(user, kwargs))
         if self.hasUser(user):
             self.db[user].update(kwargs)
+            self._notify(user, list(kwargs.keys()))
 
     def addUser(self, user, **kwargs):
         """
@@ -125,6 +164,7 @@ class UserDB:
         """
         self.logger.debug("Adding user {} with data {}".format(user, kwargs))
         self.db[user].update(kwargs)
+        self._notify(user, list(kwargs.keys()))
 
     def getPublicUserInfo(self, user):
         """
@@ -139,7 +179,8 @@ class UserDB:
             for user in self.db:
                 info = {
                     "connection": self.getConnectionInfo(user),
-                    "pub": self.getPublicKey(user)
+                    "pub": self.getPublicKey(user),
+                    "alg": self.getPublicKeyAlgorithm(user)
                 }
 
                 info["pub"] = info["pub"].decode("ISO-8859-1")
@@ -152,7 +193,8 @@ class UserDB:
         else:
             public_info = {
                 "connection": self.getConnectionInfo(user),
-                "pub": self.getPublicKey(user)
+                "pub": self.getPublicKey(user),
+                "alg": self.getPublicKeyAlgorithm(user)
             }
 
             public_info["pub"] = public_info["pub"].decode("ISO-8859-1")
@@ -1,6 +1,7 @@
+import random
 import time
 from qchat.core import GLOBAL_SLEEP_TIME
-from qchat.messages import RQQBMessage
+from qchat.messages import RQBTMessage, RQQBMessage
 from qchat.log import QChatLogger
 
 
@@ -21,15 +22,47 @@ class MeasurementDevice:
         self.relay_host = relay_info["host"]
         self.relay_port = relay_info["port"]
 
-    def requestEPR(self, user):
+        # Reason the source will not distribute the pairs we are waiting for
+        self.error = None
+
+    def abort(self, reason):
+        """
+        Stops waiting for EPR pairs that the source reported it will not distribute
+        :param reason: str
+            The reason the source gave
+        :return: None
+        """
+        self.logger.warning("Aborting EPR retrieval: {}".format(reason))
+        self.error = reason
+
+    def _check_aborted(self):
         """
-        Method used for sending a request for EPR pairs from the source
+        Internal method for failing EPR retrieval once the source reported it will not distribute our pairs
+        :return: None
+        """
+        if self.error is not None:
+            raise Exception("EPR source failed to distribute pairs: {}".format(self.error))
+
+    def requestEPR(self, user, count=1):
+        """
+        Method used for sending a request for EPR pairs from the source, multiple pairs are requested with a single
+        batch request whose completion the source reports back
         :param user: str
             The user we want to share an EPR pair with
-        :return: None
+        :param count: int
+            The number of EPR pairs to distribute
+        :return: int
+            The identifier of the batch request, None for a single pair
         """
-        m = RQQBMessage(sender=self.connection.name, message_data={"user": user})
+        if count == 1:
+            request_id = None
+            m = RQQBMessage(sender=self.connection.name, message_data={"user": user})
+        else:
+            request_id = random.getrandbits(63)
+            m = RQBTMessage(sender=self.connection.name,
+                            message_data={"user": user, "count": count, "request_id": request_id})
         self.connection.send_message(host=self.relay_host, port=self.relay_port, message=m.encode_message())
+        return request_id
 
 
 class LeadDevice(MeasurementDevice):
@@ -61,6 +94,7 @@ class LeadDevice(MeasurementDevice):
         """
         start = time.time()
         while not time.sleep(GLOBAL_SLEEP_TIME) and time.time() - start < timeout:
+            self._check_aborted()
             try:
                 # The leader will be responsible for requesting distribution from the source, so here we
                 # follow CQC's implementation and use recvEPR to obtain the qubit
@@ -103,6 +137,7 @@ class FollowDevice(MeasurementDevice):
         """
         start = time.time()
         while not time.sleep(GLOBAL_SLEEP_TIME) and time.time() - start < timeout:
+            self._check_aborted()
             try:
                 # As the follower we will be getting our qubit via a sendQubit call so we need
                 # to use the appropriate CQC command to retrieve it
@@ -1,5 +1,9 @@
 import abc
+import math
+import threading
 import numpy as np
+from functools import lru_cache
+from itertools import combinations
 
 # Golay Matrix for error correction
 H_Golay = np.matrix([[1, 0, 0, 1, 1, 1, 0, 0, 0, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
@@ -19,6 +23,27 @@ H_Hamming = np.matrix([[1, 0, 1, 0, 1, 0, 1],
                        [0, 1, 1, 0, 0, 1, 1],
                        [0, 0, 0, 1, 1, 1, 1]])
 
+# Guards the lazy construction of the shared syndrome tables
+_error_table_lock = threading.RLock()
+
+# Backends for computing syndromes
+MATRIX_BACKEND = "matrix"
+PACKED_BACKEND = "packed"
+BACKENDS = (MATRIX_BACKEND, PACKED_BACKEND)
+
+# LDPC code parameters
+DEFAULT_LDPC_LENGTH = 1024
+DEFAULT_LDPC_COLUMN_WEIGHT = 3
+DEFAULT_LDPC_ERROR_RATE = 0.05
+DEFAULT_LDPC_EFFICIENCY = 1.1
+DEFAULT_LDPC_MARGIN = 0.13
+DEFAULT_LDPC_ITERATIONS = 50
+DEFAULT_LDPC_SEED = 0
+MIN_LDPC_ERROR_RATE = 0.01
+MAX_LDPC_ERROR_RATE = 0.11
+MIN_SUM_SCALE = 0.75
+LDPC_CACHE_SIZE = 32
+
 
 def getSyndrome(H, v):
     """
@@ -49,6 +74,61 @@ def eVect(length, position):
     return np.matrix(vec)
 
 
+def binary_entropy(p):
+    """
+    Computes the binary entropy of a probability, the minimum fraction of a string that has to be disclosed to
+    correct errors occurring with that probability
+    :param p: float
+        The probability
+    :return: float
+        The binary entropy in bits
+    """
+    if p <= 0 or p >= 1:
+        return 0.0
+    return -p * math.log2(p) - (1 - p) * math.log2(1 - p)
+
+
+def pack_bits(X):
+    """
+    Packs rows of 0/1's into integers with the first bit of a row as the most significant bit
+    :param X: `~numpy.ndarray`
+        (N x length) array of 0/1's, length may be at most 64
+    :return: `~numpy.ndarray`
+        Length N uint64 array of the packed rows
+    """
+    X = np.asarray(X, dtype=np.uint64)
+    weights = np.uint64(1) << np.arange(X.shape[-1] - 1, -1, -1, dtype=np.uint64)
+    return (X * weights).sum(axis=-1, dtype=np.uint64)
+
+
+def unpack_bits(words, length):
+    """
+    Unpacks integers into rows of 0/1's, the inverse of pack_bits
+    :param words: `~numpy.ndarray`
+        Length N array of packed rows
+    :param length: int
+        The number of bits in a row
+    :return: `~numpy.ndarray`
+        (N x length) uint8 array of 0/1's
+    """
+    shifts = np.arange(length - 1, -1, -1, dtype=np.uint64)
+    return ((np.asarray(words, dtype=np.uint64)[:, None] >> shifts) & np.uint64(1)).astype(np.uint8)
+
+
+def parity(words):
+    """
+    Computes the parity of every integer by folding its bits onto the lowest bit with XOR
+    :param words: `~numpy.ndarray`
+        Array of uint64 integers
+    :return: `~numpy.ndarray`
+        uint64 array of the 0/1 parities
+    """
+    words = words.copy()
+    for shift in (32, 16, 8, 4, 2, 1):
+        words ^= words >> np.uint64(shift)
+    return words & np.uint64(1)
+
+
 class ECC(metaclass=abc.ABCMeta):
     """
     Base class that implements linear code encoding/decoding interface
@@ -66,6 +146,83 @@ class ECC(metaclass=abc.ABCMeta):
         """
         return [x[i:i+self.codeword_length] for i in range(0, len(x), self.codeword_length)]
 
+    def adapt(self, error_rate):
+        """
+        Returns the code suited to the specified error rate, fixed rate codes return themselves
+        :param error_rate: float
+            The estimated error rate of the codewords
+        :return: `~qchat.ecc.ECC`
+            The adapted code
+        """
+        return self
+
+    def chunk_batch(self, x):
+        """
+        Chunks a list of 0/1's into a batch of complete codewords for use with the batch methods
+        :param x: list
+            List of integers 0/1
+        :return: tuple
+            (N x codeword_length) uint8 array of the complete codewords, list of the remaining bits
+        """
+        n = len(x) - len(x) % self.codeword_length
+        X = np.array(x[:n], dtype=np.uint8).reshape(-1, self.codeword_length)
+        return X, list(x[n:])
+
+    @property
+    def error_table(self):
+        """
+        Returns the array mapping the integer value of a syndrome to the most likely error string, the table is
+        built on first use and shared by all instances of the code
+        :return: `~numpy.ndarray`
+            (2^syndrome_length x codeword_length) uint8 array of error strings
+        """
+        return self._get_shared_table("_error_table", self._build_error_table)
+
+    @property
+    def packed_error_table(self):
+        """
+        Returns the error table with every error string packed into an integer for use with the packed backend
+        :return: `~numpy.ndarray`
+            Length 2^syndrome_length uint64 array of packed error strings
+        """
+        return self._get_shared_table("_packed_error_table", lambda: pack_bits(self.error_table))
+
+    def _get_shared_table(self, name, build):
+        """
+        Returns a table shared by all instances of the code, building it on first use
+        :param name: str
+            The class attribute holding the table
+        :param build: func
+            Constructs the table
+        :return: `~numpy.ndarray`
+            The table
+        """
+        cls = type(self)
+        if getattr(cls, name) is None:
+            with _error_table_lock:
+                if getattr(cls, name) is None:
+                    setattr(cls, name, build())
+        return getattr(cls, name)
+
+    def _build_error_table(self):
+        """
+        Constructs the syndrome -> error string table from every error string of at most max_errors bits
+        :return: `~numpy.ndarray`
+            (2^syndrome_length x codeword_length) uint8 array of error strings
+        """
+        positions = [c for w in range(self.max_errors + 1) for c in combinations(range(self.codeword_length), w)]
+        rows = np.repeat(np.arange(len(positions)), [len(c) for c in positions])
+        columns = np.fromiter((i for c in positions for i in c), dtype=np.intp, count=len(rows))
+
+        errors = np.zeros((len(positions), self.codeword_length), dtype=np.uint8)
+        errors[rows, columns] = 1
+
+        # Error strings are ordered by weight so the lightest one is kept when several share a syndrome
+        table = np.zeros((2 ** len(self.syndrome_weights), self.codeword_length), dtype=np.uint8)
+        syndromes, first = np.unique(self.encode_batch(errors) @ self.syndrome_weights, return_index=True)
+        table[syndromes] = errors[first]
+        return table
+
     def encode(self, x):
         """
         Encodes a specified codeword into a JSON-able syndrome string
@@ -74,6 +231,10 @@ class ECC(metaclass=abc.ABCMeta):
         :return: tuple
             An encoding of the codeword
         """
+        if self.backend == PACKED_BACKEND:
+            word = self._pack_word(x)
+            return tuple(self._syndrome_bits(word))
+
         s = getSyndrome(self.H, np.matrix(x).reshape(self.codeword_length, 1))
         return tuple(s.tolist()[0])
 
@@ -87,49 +248,343 @@ class ECC(metaclass=abc.ABCMeta):
         :return: list
             A corrected version of the codeword
         """
-        xm = np.matrix(x).reshape(self.codeword_length, 1)
-        sm = np.matrix(s)
-        s_hat = getSyndrome(self.H, xm)
-        cs = (sm + s_hat) % 2
-        em = self.dict_H[tuple(cs.tolist()[0])]
-        xm = (xm.reshape(1, self.codeword_length) + em) % 2
-        return xm.tolist()[0]
+        if self.backend == PACKED_BACKEND:
+            word = self._pack_word(x)
+            syndrome = self._pack_word(s) ^ self._pack_word(self._syndrome_bits(word))
+            word ^= int(self.packed_error_table[syndrome])
+            return [(word >> i) & 1 for i in range(self.codeword_length - 1, -1, -1)]
+
+        return self.decode_batch(x, s)[0].tolist()
+
+    @staticmethod
+    def _pack_word(x):
+        """
+        Packs a single codeword into an integer with the first bit as the most significant bit
+        :param x: tuple
+            The codeword (0/1)
+        :return: int
+            The packed codeword
+        """
+        word = 0
+        for b in x:
+            word = (word << 1) | int(b)
+        return word
+
+    def _syndrome_bits(self, word):
+        """
+        Computes the syndrome of a single codeword packed into an integer
+        :param word: int
+            The packed codeword
+        :return: list
+            The syndrome bits
+        """
+        return [bin(word & mask).count("1") & 1 for mask in self.int_row_masks]
+
+    def encode_batch(self, X):
+        """
+        Encodes a batch of codewords into their syndromes with a single matrix product
+        :param X: `~numpy.ndarray`
+            (N x codeword_length) array of 0/1 codewords
+        :return: `~numpy.ndarray`
+            (N x syndrome_length) uint8 array of the syndromes
+        """
+        X = np.asarray(X, dtype=np.uint8).reshape(-1, self.codeword_length)
+        if self.backend == PACKED_BACKEND:
+            return unpack_bits(self.encode_packed(pack_bits(X)), len(self.row_masks))
+
+        # Sums wrap modulo 256 which preserves their parity
+        return (X @ self.H_T) & 1
+
+    def decode_batch(self, X, S, return_failures=False):
+        """
+        Corrects errors in a batch of received codewords using the original codewords' syndromes
+        :param X: `~numpy.ndarray`
+            (N x codeword_length) array of 0/1 codewords we wish to correct
+        :param S: `~numpy.ndarray`
+            (N x syndrome_length) array of the original codewords' syndromes
+        :param return_failures: bool
+            Also returns which corrected codewords still do not match their syndromes
+        :return: `~numpy.ndarray`
+            (N x codeword_length) uint8 array of the corrected codewords, with a length N bool array of the failed
+            codewords if return_failures is set
+        """
+        X = np.asarray(X, dtype=np.uint8).reshape(-1, self.codeword_length)
+        S = np.asarray(S, dtype=np.uint8).reshape(len(X), -1)
+        if self.backend == PACKED_BACKEND:
+            words = self.decode_packed(pack_bits(X), S @ self.syndrome_weights)
+            corrected = unpack_bits(words, self.codeword_length)
+        else:
+            syndromes = (S ^ self.encode_batch(X)) @ self.syndrome_weights
+            corrected = X ^ self.error_table[syndromes]
+
+        if return_failures:
+            return corrected, (self.encode_batch(corrected) != S).any(axis=1)
+        return corrected
+
+    def encode_packed(self, words):
+        """
+        Encodes a batch of codewords packed into integers, every syndrome bit is the parity of the codeword masked
+        by a parity-check row
+        :param words: `~numpy.ndarray`
+            Length N uint64 array of packed codewords
+        :return: `~numpy.ndarray`
+            Length N int64 array of the integer values of the syndromes
+        """
+        words = np.asarray(words, dtype=np.uint64)
+        syndromes = np.zeros(len(words), dtype=np.uint64)
+        for mask in self.row_masks:
+            syndromes = (syndromes << np.uint64(1)) | parity(words & mask)
+        return syndromes.astype(np.int64)
+
+    def decode_packed(self, words, syndromes):
+        """
+        Corrects errors in a batch of received codewords packed into integers
+        :param words: `~numpy.ndarray`
+            Length N uint64 array of packed codewords we wish to correct
+        :param syndromes: `~numpy.ndarray`
+            Length N array of the integer values of the original codewords' syndromes
+        :return: `~numpy.ndarray`
+            Length N uint64 array of the corrected packed codewords
+        """
+        words = np.asarray(words, dtype=np.uint64)
+        syndromes = np.asarray(syndromes, dtype=np.int64) ^ self.encode_packed(words)
+        return words ^ self.packed_error_table[syndromes]
 
 
 class ECC_Golay(ECC):
     codeword_length = 23
+    max_errors = 3
+    max_error_rate = 3 / 23
+    _error_table = None
+    _packed_error_table = None
 
-    def __init__(self):
+    def __init__(self, backend=MATRIX_BACKEND):
         """
         Initializes Golay error correcting code matrix for use with ECC
+        :param backend: str
+            Computes syndromes with dense 0/1 matrices or with codewords packed into integers
         """
+        if backend not in BACKENDS:
+            raise Exception("Unsupported ECC backend {}".format(backend))
+
+        self.backend = backend
         self.H = H_Golay
-        self.dict_H = {}
+        self.H_T = np.asarray(H_Golay, dtype=np.uint8).T
+        self.syndrome_weights = 1 << np.arange(self.H.shape[0] - 1, -1, -1, dtype=np.int64)
 
-        # Set the zero syndrome cases to the zero error string
-        s = (0,)*11
-        self.dict_H[s] = (0,)*23
+        # Parity-check rows packed into integers for the packed backend
+        self.row_masks = pack_bits(self.H_T.T)
+        self.int_row_masks = [int(mask) for mask in self.row_masks]
 
-        # Construct the syndrome -> error string mapping for 1, 2, and 3 bit errors
-        for i in range(1, 24):
-            # 1 bit errors
-            vi = eVect(23, i)
-            s = self.encode(vi)
-            self.dict_H[s] = tuple(vi.tolist())
 
-            for j in range(i+1, 24):
-                # 2 bit errors
-                vj = eVect(23, j)
-                v_ij = vi + vj
-                s = self.encode(v_ij)
-                self.dict_H[s] = tuple(v_ij.tolist())
+@lru_cache(maxsize=LDPC_CACHE_SIZE)
+def build_ldpc_code(codeword_length, syndrome_length, column_weight, seed):
+    """
+    Constructs a random parity-check matrix with a fixed number of ones per column spread evenly over the rows.
+    The construction only depends on its parameters so peers sharing them construct the same code.
+    :param codeword_length: int
+        The number of columns of the matrix
+    :param syndrome_length: int
+        The number of rows of the matrix
+    :param column_weight: int
+        The number of ones in every column
+    :param seed: int
+        Seed of the random construction
+    :return: tuple
+        (syndrome_length x codeword_length) uint8 parity-check matrix, the row of every edge ordered by column,
+        (syndrome_length x max row degree) array of the edges of every row padded with the number of edges
+    """
+    rng = np.random.RandomState(seed)
+    load = np.zeros(syndrome_length, dtype=np.int64)
+    rows = np.empty((codeword_length, column_weight), dtype=np.intp)
+
+    # Rows that already share a column, a column placed in two of them would close a cycle of length four
+    shared = np.zeros((syndrome_length, syndrome_length), dtype=bool)
+    for column in range(codeword_length):
+        # Place the column's ones in the least loaded rows breaking ties at random, avoiding short cycles
+        chosen = np.zeros(syndrome_length, dtype=bool)
+        blocked = np.zeros(syndrome_length, dtype=bool)
+        for k in range(column_weight):
+            candidates = ~(chosen | blocked)
+            if not candidates.any():
+                candidates = ~chosen
+            order = np.lexsort((rng.random_sample(syndrome_length), load, ~candidates))
+            rows[column, k] = order[0]
+            chosen[order[0]] = True
+            blocked |= shared[order[0]]
+
+        selected = rows[column]
+        load[selected] += 1
+        shared[np.ix_(selected, selected)] = True
+
+    H = np.zeros((syndrome_length, codeword_length), dtype=np.uint8)
+    H[rows, np.arange(codeword_length)[:, None]] = 1
+
+    # Lay the edges of every row out in a padded table for the check node updates
+    edge_rows = rows.ravel()
+    num_edges = len(edge_rows)
+    order = np.argsort(edge_rows, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(load)[:-1]))
+    check_edges = np.full((syndrome_length, load.max()), num_edges, dtype=np.intp)
+    check_edges[edge_rows[order], np.arange(num_edges) - starts[edge_rows[order]]] = order
+    return H, edge_rows, check_edges
+
+
+class ECC_LDPC(ECC):
+    """
+    Rate-adaptive low-density parity-check code.  The number of syndrome bits disclosed per frame is chosen from
+    the expected error rate and errors are corrected with a vectorized normalized min-sum decoder.
+    """
+    max_error_rate = MAX_LDPC_ERROR_RATE
+    backend = MATRIX_BACKEND
+
+    def __init__(self, codeword_length=DEFAULT_LDPC_LENGTH, error_rate=DEFAULT_LDPC_ERROR_RATE, syndrome_length=None,
+                 column_weight=DEFAULT_LDPC_COLUMN_WEIGHT, efficiency=DEFAULT_LDPC_EFFICIENCY,
+                 margin=DEFAULT_LDPC_MARGIN, iterations=DEFAULT_LDPC_ITERATIONS, seed=DEFAULT_LDPC_SEED):
+        """
+        Initializes an LDPC code for use with ECC
+        :param codeword_length: int
+            The number of bits in a frame
+        :param error_rate: float
+            The expected error rate of the frames
+        :param syndrome_length: int
+            The number of syndrome bits per frame, chosen from the error rate and efficiency if None
+        :param column_weight: int
+            The number of parity checks every bit takes part in
+        :param efficiency: float
+            The ratio of the disclosed syndrome bits to the minimum required for the error rate
+        :param margin: float
+            The fraction of the frame disclosed on top of the scaled minimum so that short frames decode reliably
+        :param iterations: int
+            The maximum number of decoding iterations
+        :param seed: int
+            Seed of the parity-check matrix construction, peers must use the same seed
+        """
+        self.codeword_length = codeword_length
+        self.error_rate = min(max(error_rate, MIN_LDPC_ERROR_RATE), MAX_LDPC_ERROR_RATE)
+        self.column_weight = column_weight
+        self.efficiency = efficiency
+        self.margin = margin
+        self.iterations = iterations
+        self.seed = seed
+
+        if syndrome_length is None:
+            syndrome_length = math.ceil((efficiency * binary_entropy(self.error_rate) + margin) * codeword_length)
+        syndrome_length = min(max(syndrome_length, column_weight), codeword_length - 1)
+
+        self.H, self.edge_rows, self.check_edges = build_ldpc_code(codeword_length, syndrome_length,
+                                                                   column_weight, seed)
+        self.H_T = self.H.T.copy()
+
+    def adapt(self, error_rate):
+        """
+        Returns the code of the same family whose rate suits the specified error rate
+        :param error_rate: float
+            The estimated error rate of the frames
+        :return: `~qchat.ecc.ECC_LDPC`
+            The adapted code
+        """
+        return ECC_LDPC(codeword_length=self.codeword_length, error_rate=error_rate,
+                        column_weight=self.column_weight, efficiency=self.efficiency, margin=self.margin,
+                        iterations=self.iterations, seed=self.seed)
+
+    def encode(self, x):
+        """
+        Encodes a specified codeword into a JSON-able syndrome string
+        :param x: tuple
+            The codeword to encode (0/1)
+        :return: tuple
+            An encoding of the codeword
+        """
+        return tuple(self.encode_batch(x)[0].tolist())
+
+    def decode(self, x, s):
+        """
+        Corrects errors in the received codeword x using the provided encoding information s
+        :param x: tuple
+            The codeword we wish to correct
+        :param s: tuple
+            The original codeword's syndrome information
+        :return: list
+            A corrected version of the codeword
+        """
+        return self.decode_batch(x, s)[0].tolist()
+
+    def decode_batch(self, X, S, return_failures=False):
+        """
+        Corrects errors in a batch of received codewords using the original codewords' syndromes, frames the
+        decoder fails on are returned with its best estimate
+        :param X: `~numpy.ndarray`
+            (N x codeword_length) array of 0/1 codewords we wish to correct
+        :param S: `~numpy.ndarray`
+            (N x syndrome_length) array of the original codewords' syndromes
+        :param return_failures: bool
+            Also returns which frames the decoder failed on
+        :return: `~numpy.ndarray`
+            (N x codeword_length) uint8 array of the corrected codewords, with a length N bool array of the failed
+            frames if return_failures is set
+        """
+        X = np.asarray(X, dtype=np.uint8).reshape(-1, self.codeword_length)
+        S = np.asarray(S, dtype=np.uint8).reshape(len(X), -1)
+        errors, decoded = self._decode_errors(S ^ self.encode_batch(X))
+        if return_failures:
+            return X ^ errors, ~decoded
+        return X ^ errors
+
+    def _decode_errors(self, target):
+        """
+        Finds the most likely error strings with the specified syndromes using normalized min-sum belief
+        propagation on all frames at once, frames are dropped from the computation as soon as they are decoded
+        :param target: `~numpy.ndarray`
+            (N x syndrome_length) uint8 array of the syndromes of the error strings
+        :return: tuple
+            (N x codeword_length) uint8 array of the error strings, length N bool array of the frames whose error
+            strings match their syndromes
+        """
+        num_edges = len(self.edge_rows)
+        prior = math.log((1 - self.error_rate) / self.error_rate)
+        errors = np.zeros((len(target), self.codeword_length), dtype=np.uint8)
+        converged = np.zeros(len(target), dtype=bool)
+
+        # Variable to check messages of the decoding frames, the extra edge pads the rows of the check table
+        active = np.arange(len(target))
+        q = np.full((len(target), num_edges + 1), prior)
+        q[:, num_edges] = np.inf
+        check_sign = 1 - 2 * target.astype(np.float64)
+
+        for _ in range(self.iterations):
+            # Check to variable messages exclude the receiving edge from the sign product and minimum
+            Q = q[:, self.check_edges]
+            magnitude = np.abs(Q)
+            sign = np.where(Q < 0, -1.0, 1.0)
+            sign_product = sign.prod(axis=-1) * check_sign
+            first = magnitude.argmin(axis=-1)[..., None]
+            min1 = np.take_along_axis(magnitude, first, axis=-1)
+            np.put_along_axis(magnitude, first, np.inf, axis=-1)
+            min2 = magnitude.min(axis=-1, keepdims=True)
+            excluded = np.where(np.arange(magnitude.shape[-1]) == first, min2, min1)
+
+            r = np.zeros_like(q)
+            r[:, self.check_edges] = MIN_SUM_SCALE * sign_product[..., None] * sign * excluded
+            r = r[:, :num_edges].reshape(len(q), self.codeword_length, self.column_weight)
+
+            # Variable beliefs and the hard decision on every bit
+            belief = prior + r.sum(axis=-1)
+            hard = (belief < 0).astype(np.uint8)
+            decoded = (((hard @ self.H_T) & 1) == target).all(axis=-1)
+            errors[active] = hard
+            converged[active] = decoded
 
-                for k in range(j+1, 24):
-                    # 3 bit errors
-                    vk = eVect(23, k)
-                    v_ijk = v_ij + vk
-                    s = self.encode(v_ijk)
-                    self.dict_H[s] = tuple(v_ijk.tolist())
+            if decoded.all():
+                break
+
+            # Continue with the frames that are not decoded yet
+            remaining = ~decoded
+            active, target, check_sign = active[remaining], target[remaining], check_sign[remaining]
+            q = q[remaining]
+            q[:, :num_edges] = (belief[remaining][..., None] - r[remaining]).reshape(len(q), num_edges)
+
+        return errors, converged
 
 
 class ECC_Hamming(ECC):
@@ -151,3 +606,24 @@ class ECC_Hamming(ECC):
             vi = eVect(23, i)
             s = getSyndrome(H_Golay, vi)
             self.dict_H[s] = vi
+
+
+ECCS = {
+    "golay": ECC_Golay,
+    "ldpc": ECC_LDPC
+}
+
+
+def create_ecc(name, **kwargs):
+    """
+    Creates an error correcting code by name
+    :param name: str
+        The name of the code
+    :param kwargs: dict
+        Parameters of the code
+    :return: `~qchat.ecc.ECC`
+        The error correcting code
+    """
+    if name not in ECCS:
+        raise Exception("Unsupported error correcting code {}".format(name))
+    return ECCS[name](**kwargs)
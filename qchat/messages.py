@@ -1,77 +1,503 @@
 import json
+import struct
 
 HEADER_LENGTH = 4
 PAYLOAD_SIZE = 4
 MAX_SENDER_LENGTH = 16
 
+# The top byte of the payload size field carries frame flags
+FRAME_FLAGS_MASK = 0xFF000000
+FRAME_SIZE_MASK = 0x00FFFFFF
+BINARY_FLAG = 0x80000000
+SIGNED_FLAG = 0x40000000
+MAC_FLAG = 0x20000000
+SIGNATURE_LENGTH_SIZE = 2
+
+# Session MAC trailers carry a sequence number and an HMAC-SHA256 tag
+SEQUENCE_SIZE = 8
+MAC_SIZE = 32
+
+# Payload encodings, the names are advertised in connection information so peers can negotiate
+JSON_ENCODING = 0
+BINARY_ENCODING = 1
+ENCODINGS = {
+    "json": JSON_ENCODING,
+    "binary": BINARY_ENCODING
+}
+
 
 class MalformedMessage(Exception):
     pass
 
 
+class BitVector:
+    """
+    Sequence of 0/1 integers that is carried packed into bytes on the wire instead of as a list of integers
+    """
+    __slots__ = ("bits",)
+
+    def __init__(self, bits):
+        """
+        Initializes a bit vector
+        :param bits: iterable
+            The 0/1 integers held by the vector
+        """
+        self.bits = list(bits)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def __iter__(self):
+        return iter(self.bits)
+
+    def __getitem__(self, index):
+        return self.bits[index]
+
+    def __eq__(self, other):
+        if isinstance(other, BitVector):
+            return self.bits == other.bits
+        return self.bits == other
+
+    def __repr__(self):
+        return "BitVector({})".format(self.bits)
+
+    def pack(self):
+        """
+        Packs the bits into a 4 byte big endian bit count followed by the bits, most significant bit first
+        :return: bytes
+            The packed bit vector
+        """
+        count = len(self.bits)
+        padding = -count % 8
+        try:
+            value = int(''.join(map(str, map(int, self.bits))) + '0' * padding or '0', 2)
+        except ValueError:
+            raise MalformedMessage("Bit vectors may only contain 0/1")
+        return count.to_bytes(4, 'big') + value.to_bytes((count + padding) // 8, 'big')
+
+    @classmethod
+    def unpack(cls, packed):
+        """
+        Unpacks a packed bit vector
+        :param packed: bytes
+            The packed bit vector
+        :return: `~qchat.messages.BitVector`
+            The unpacked bit vector
+        """
+        count = int.from_bytes(packed[:4], 'big')
+        data = packed[4:]
+        if len(data) != (count + 7) // 8:
+            raise MalformedMessage("Bit vector length mismatch")
+        bits = bin(int.from_bytes(data, 'big'))[2:].zfill(len(data) * 8)[:count]
+        return cls(map(int, bits))
+
+
+def as_bytes(value):
+    """
+    Returns a binary field as bytes, JSON encoded payloads carry binary fields as ISO-8859-1 strings
+    :param value: bytes/str
+        The binary field
+    :return: bytes
+        The field as bytes
+    """
+    return value if isinstance(value, (bytes, bytearray)) else value.encode("ISO-8859-1")
+
+
+def _json_default(value):
+    """
+    Serializes binary values nested in JSON payloads as ISO-8859-1 strings
+    :param value: obj
+        Value that the JSON encoder does not know how to serialize
+    :return: str
+        The serialized value
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode("ISO-8859-1")
+    elif isinstance(value, BitVector):
+        return {"__bits__": value.pack().decode("ISO-8859-1")}
+    raise TypeError("Cannot serialize {}".format(type(value)))
+
+
+def _json_object_hook(obj):
+    """
+    Restores bit vectors nested in JSON payloads
+    :param obj: dict
+        A decoded JSON object
+    :return: obj
+        The bit vector if the object encodes one, otherwise the object
+    """
+    if len(obj) == 1 and "__bits__" in obj:
+        return BitVector.unpack(obj["__bits__"].encode("ISO-8859-1"))
+    return obj
+
+
+def _pack_value(value, out):
+    """
+    Appends the binary encoding of a value to the output buffer.  Each value is a one byte tag followed by
+    N: None, T/F: booleans, B: uint8, q: int64, d: float64, s: utf-8 string, b: bytes, u: list of uint8,
+    v: packed bit vector, l: list and m: map with string keys.  Lengths are 4 byte big endian counts.
+    :param value: obj
+        The value to encode
+    :param out: bytearray
+        The output buffer
+    :return: None
+    """
+    if value is None:
+        out += b'N'
+    elif value is True:
+        out += b'T'
+    elif value is False:
+        out += b'F'
+    elif type(value) is int:
+        if 0 <= value < 256:
+            out += b'B'
+            out.append(value)
+        else:
+            out += b'q' + struct.pack('>q', value)
+    elif type(value) is float:
+        out += b'd' + struct.pack('>d', value)
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        out += b's' + struct.pack('>I', len(encoded)) + encoded
+    elif isinstance(value, (bytes, bytearray)):
+        out += b'b' + struct.pack('>I', len(value)) + value
+    elif isinstance(value, BitVector):
+        out += b'v' + value.pack()
+    elif isinstance(value, (list, tuple)):
+        if all(type(v) is int and 0 <= v < 256 for v in value):
+            out += b'u' + struct.pack('>I', len(value)) + bytes(value)
+        else:
+            out += b'l' + struct.pack('>I', len(value))
+            for v in value:
+                _pack_value(v, out)
+    elif isinstance(value, dict):
+        out += b'm' + struct.pack('>I', len(value))
+        for k, v in value.items():
+            key = k.encode('utf-8')
+            out += struct.pack('>I', len(key)) + key
+            _pack_value(v, out)
+    else:
+        raise MalformedMessage("Cannot encode {}".format(type(value)))
+
+
+def _unpack_value(buf, offset):
+    """
+    Decodes a single binary encoded value
+    :param buf: bytes/bytearray
+        Buffer holding the encoded payload
+    :param offset: int
+        Position of the value's tag
+    :return: tuple
+        The decoded value, position following the value
+    """
+    tag = buf[offset:offset + 1]
+    offset += 1
+    if tag == b'N':
+        return None, offset
+    elif tag == b'T':
+        return True, offset
+    elif tag == b'F':
+        return False, offset
+    elif tag == b'B':
+        return buf[offset], offset + 1
+    elif tag == b'q':
+        return struct.unpack_from('>q', buf, offset)[0], offset + 8
+    elif tag == b'd':
+        return struct.unpack_from('>d', buf, offset)[0], offset + 8
+    elif tag == b'v':
+        count, = struct.unpack_from('>I', buf, offset)
+        end = offset + 4 + (count + 7) // 8
+        return BitVector.unpack(bytes(buf[offset:end])), end
+
+    length, = struct.unpack_from('>I', buf, offset)
+    offset += 4
+    if tag == b's':
+        return str(buf[offset:offset + length], 'utf-8'), offset + length
+    elif tag == b'b':
+        return bytes(buf[offset:offset + length]), offset + length
+    elif tag == b'u':
+        return list(buf[offset:offset + length]), offset + length
+    elif tag == b'l':
+        items = []
+        for _ in range(length):
+            item, offset = _unpack_value(buf, offset)
+            items.append(item)
+        return items, offset
+    elif tag == b'm':
+        mapping = {}
+        for _ in range(length):
+            key_length, = struct.unpack_from('>I', buf, offset)
+            offset += 4
+            key = str(buf[offset:offset + key_length], 'utf-8')
+            mapping[key], offset = _unpack_value(buf, offset + key_length)
+        return mapping, offset
+
+    raise MalformedMessage("Unknown binary tag {}".format(tag))
+
+
+def pack_payload(data):
+    """
+    Encodes message data into the compact binary payload format
+    :param data: dict
+        The message data
+    :return: bytes
+        The encoded payload
+    """
+    out = bytearray()
+    _pack_value(data, out)
+    return bytes(out)
+
+
+def unpack_payload(buf):
+    """
+    Decodes a compact binary payload into message data
+    :param buf: bytes/bytearray
+        The encoded payload
+    :return: dict
+        The message data
+    """
+    data, offset = _unpack_value(buf, 0)
+    if offset != len(buf):
+        raise MalformedMessage("Trailing payload data")
+    return data
+
+
+def decode_size(size):
+    """
+    Splits the payload size field of a frame into the payload length and frame flags
+    :param size: bytes
+        The payload size field
+    :return: tuple
+        The payload length, payload encoding, the flag of the trailer carried by the payload (0, SIGNED_FLAG or
+        MAC_FLAG)
+    """
+    value = int.from_bytes(size, 'big')
+    flags = value & FRAME_FLAGS_MASK
+    if flags & ~(BINARY_FLAG | SIGNED_FLAG | MAC_FLAG) or flags & SIGNED_FLAG and flags & MAC_FLAG:
+        raise MalformedMessage("Unsupported frame flags")
+    encoding = BINARY_ENCODING if flags & BINARY_FLAG else JSON_ENCODING
+    return value & FRAME_SIZE_MASK, encoding, flags & (SIGNED_FLAG | MAC_FLAG)
+
+
+class MessageData(dict):
+    """
+    Message data dictionary that resets its owner's cached encoding whenever it is modified.  Modifications of
+    nested values are not tracked.
+    """
+    __slots__ = ("owner",)
+
+    def __init__(self, data, owner):
+        super().__init__(data)
+        self.owner = owner
+
+    def _changed(self):
+        self.owner._body = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def pop(self, *args):
+        self._changed()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._changed()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
+
 class Message:
     header = b'MSSG'
     verify = False
     strip = False
+    droppable = False
+    ordered = False
+    __slots__ = ("sender", "signature", "sequence", "mac", "session", "_padded_sender", "_encoding", "_data", "_body")
 
-    def __init__(self, sender, message_data):
+    def __init__(self, sender, message_data, encoding=JSON_ENCODING, signed=False):
         """
         Initializes application specific message structure for use with QChat
         :param sender: str
             Host sending the message
         :param message_data: dict
             Dictionary containing the message data to retain
+        :param encoding: int
+            The payload encoding used on the wire, JSON_ENCODING or BINARY_ENCODING
+        :param signed: bool/int
+            Whether the encoded message data ends with a signature trailer, MAC_FLAG if it ends with a session MAC
+            trailer instead
         """
         if len(sender) > MAX_SENDER_LENGTH:
             raise MalformedMessage("Length of sender too long")
         self.sender = sender
-        self.unpack_message_data(message_data)
-
-    def unpack_message_data(self, message_data):
+        self.signature = None
+        self.sequence = None
+        self.mac = None
+        self.session = None
+        self._padded_sender = (b'\x00'*MAX_SENDER_LENGTH + bytes(sender, 'utf-8'))[-16:]
+        self._encoding = encoding
+        self._body = None
+        self.unpack_message_data(message_data, signed=signed)
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = MessageData(data, owner=self) if isinstance(data, dict) else data
+        self._body = None
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    @encoding.setter
+    def encoding(self, encoding):
+        if encoding != self._encoding:
+            self._encoding = encoding
+            self._body = None
+
+    def unpack_message_data(self, message_data, signed=False):
         """
         Transforms the message data into JSON serializable format which can be encoded/decoded
-        into a byte string for communication through the sockets library
-        :param message_data: dict/str/bytes
+        into a byte string for communication through the sockets library.  Encoded message data is retained
+        so that it does not need to be encoded again.
+        :param message_data: dict/str/bytes/bytearray
             Data to construct the message out of
+        :param signed: bool/int
+            Whether the encoded message data ends with a signature trailer, MAC_FLAG if it ends with a session MAC
+            trailer instead
         :return: None
         """
         try:
-            if type(message_data) == dict:
+            if isinstance(message_data, dict):
                 self.data = message_data
-            elif type(message_data) == str:
-                self.data = json.loads(message_data)
-            elif type(message_data) == bytes:
-                self.data = json.loads(str(message_data, 'utf-8'))
-            else:
+                return
+
+            if isinstance(message_data, str):
+                message_data = bytes(message_data, 'utf-8')
+            elif not isinstance(message_data, (bytes, bytearray)):
                 raise MalformedMessage
+
+            if signed == MAC_FLAG:
+                end = len(message_data) - SEQUENCE_SIZE - MAC_SIZE
+                if end < 0:
+                    raise MalformedMessage
+                self.sequence = int.from_bytes(message_data[end:end + SEQUENCE_SIZE], 'big')
+                self.mac = bytes(message_data[end + SEQUENCE_SIZE:])
+                message_data = message_data[:end]
+            elif signed:
+                length = int.from_bytes(message_data[-SIGNATURE_LENGTH_SIZE:], 'big')
+                end = len(message_data) - SIGNATURE_LENGTH_SIZE - length
+                if end < 0:
+                    raise MalformedMessage
+                self.signature = bytes(message_data[end:-SIGNATURE_LENGTH_SIZE])
+                message_data = message_data[:end]
+
+            if self.encoding == BINARY_ENCODING:
+                self.data = unpack_payload(message_data)
+            else:
+                self.data = json.loads(message_data, object_hook=_json_object_hook)
+            self._body = message_data
         except Exception:
             raise MalformedMessage
 
+    def _encode_body(self):
+        """
+        Encodes the message data, the encoding is cached until the data or encoding changes
+        :return: bytes
+            The encoded message data
+        """
+        if self._body is None:
+            try:
+                if not isinstance(self.data, dict):
+                    raise MalformedMessage
+                elif self.encoding == BINARY_ENCODING:
+                    body = pack_payload(self.data)
+                else:
+                    body = bytes(json.dumps(self.data, default=_json_default), 'utf-8')
+            except Exception:
+                raise MalformedMessage
+
+            if len(body) > FRAME_SIZE_MASK:
+                raise MalformedMessage("Message data too long")
+            self._body = body
+
+        return self._body
+
+    def get_signed_data(self):
+        """
+        Returns the canonical encoding of the message that is covered by its signature
+        :return: bytes
+            Byte string encoding the message without a signature
+        """
+        body = self._encode_body()
+        flags = BINARY_FLAG if self.encoding == BINARY_ENCODING else 0
+        return self.header + self._padded_sender + (len(body) | flags).to_bytes(PAYLOAD_SIZE, 'big') + body
+
+    def get_mac_data(self):
+        """
+        Returns the encoding of the message that is covered by its session MAC, the sequence number is bound to the
+        message so that it cannot be replayed under another number
+        :return: bytes
+            Byte string encoding the sequence number and the message without a trailer
+        """
+        return self.sequence.to_bytes(SEQUENCE_SIZE, 'big') + self.get_signed_data()
+
     def encode_message(self):
         """
         Encodes the messages information into a byte string that can be unpacked into a Message
-        object on the recieving application's end
+        object on the recieving application's end.  A signature or session MAC is appended as a trailer to the
+        message data.
         :return: bytes
             Byte string encoding the message object's information
         """
-        padded_sender = (b'\x00'*MAX_SENDER_LENGTH + bytes(self.sender, 'utf-8'))[-16:]
-        try:
-            byte_data = bytes(json.dumps(self.data), 'utf-8')
-        except Exception:
-            raise MalformedMessage
+        if self.signature is not None:
+            trailer = self.signature + len(self.signature).to_bytes(SIGNATURE_LENGTH_SIZE, 'big')
+            flags = SIGNED_FLAG
+        elif self.mac is not None:
+            trailer = self.sequence.to_bytes(SEQUENCE_SIZE, 'big') + self.mac
+            flags = MAC_FLAG
+        else:
+            return self.get_signed_data()
+
+        body = self._encode_body()
+        if len(body) + len(trailer) > FRAME_SIZE_MASK:
+            raise MalformedMessage("Message data too long")
 
-        size = len(byte_data).to_bytes(PAYLOAD_SIZE, 'big')
-        return self.header + padded_sender + size + byte_data
+        flags |= BINARY_FLAG if self.encoding == BINARY_ENCODING else 0
+        size = ((len(body) + len(trailer)) | flags).to_bytes(PAYLOAD_SIZE, 'big')
+        return b''.join((self.header, self._padded_sender, size, body, trailer))
 
 
 class RGSTMessage(Message):
     """
     Registration message used for registering new users to the host's user database
     """
+    __slots__ = ()
     header = b'RGST'
+    droppable = True
 
 
 class AUTHMessage(Message):
+    __slots__ = ()
     header = b'AUTH'
 
 
@@ -79,6 +505,7 @@ class QCHTMessage(Message):
     """
     QChat message used for the primary chat's client interface
     """
+    __slots__ = ()
     header = b'QCHT'
     verify = True
     strip = True
@@ -89,8 +516,10 @@ class GETUMessage(Message):
     GET User message sent to hosts when requesting user information from other
     known hosts in the application network
     """
+    __slots__ = ()
     header = b'GETU'
     strip = True
+    droppable = True
 
 
 class PUTUMessage(Message):
@@ -98,6 +527,7 @@ class PUTUMessage(Message):
     PUT User message response to GET User when requesting user information from
     other known hosts in the application network
     """
+    __slots__ = ()
     header = b'PUTU'
     strip = True
 
@@ -107,6 +537,7 @@ class PTCLMessage(Message):
     Protocol initialization message that instructs the recieving host to assume the
     follower's role in the requested protocol
     """
+    __slots__ = ()
     header = b'PTCL'
     verify = True
     strip = True
@@ -117,17 +548,39 @@ class RQQBMessage(Message):
     ReQuest QuBit message that instructs a server to act as an EPR source between to applications
     in the network
     """
+    __slots__ = ()
     header = b'RQQB'
 
 
+class RQBTMessage(Message):
+    """
+    ReQuest quBiT baTch message that instructs a server to act as an EPR source for a number of pairs between
+    two applications in the network
+    """
+    __slots__ = ()
+    header = b'RQBT'
+
+
+class EPRDMessage(Message):
+    """
+    EPR Distributed message that reports the completion of a batch EPR request to the requesting application
+    """
+    __slots__ = ()
+    header = b'EPRD'
+    verify = True
+    strip = True
+
+
 class BB84Message(Message):
     """
     BB84 QKD Protocol control messages used for coordinating BB84 protocol specific
     classical messages between executing protocols
     """
+    __slots__ = ()
     header = b'BB84'
     verify = True
     strip = True
+    ordered = True
 
 
 class DQKDMessage(Message):
@@ -135,9 +588,11 @@ class DQKDMessage(Message):
     DIQKD Protocol control messages used for coordinating DIQKD protocol specific
     classical messages between executing protocols
     """
+    __slots__ = ()
     header = b'DQKD'
     verify = True
     strip = True
+    ordered = True
 
 
 class SPDSMessage(Message):
@@ -145,9 +600,23 @@ class SPDSMessage(Message):
     SuPerDenSe protocol control message used for coordinating SuperDense Coding protocol
     specific classical messages between executing protocols
     """
+    __slots__ = ()
     header = b'SPDS'
     verify = True
     strip = True
+    ordered = True
+
+
+class NACKMessage(Message):
+    """
+    Negative ACKnowledgement message that requests the retransmission of missing sequenced control messages, or
+    reports messages that can no longer be retransmitted
+    """
+    __slots__ = ()
+    header = b'NACK'
+    verify = True
+    strip = True
+    droppable = True
 
 
 class MessageFactory:
@@ -166,11 +635,14 @@ class MessageFactory:
             BB84Message.header: BB84Message,
             PTCLMessage.header: PTCLMessage,
             RQQBMessage.header: RQQBMessage,
+            RQBTMessage.header: RQBTMessage,
+            EPRDMessage.header: EPRDMessage,
             SPDSMessage.header: SPDSMessage,
-            DQKDMessage.header: DQKDMessage
+            DQKDMessage.header: DQKDMessage,
+            NACKMessage.header: NACKMessage
         }
 
-    def create_message(self, header, sender, message_data):
+    def create_message(self, header, sender, message_data, encoding=JSON_ENCODING, signed=False):
         """
         Creates a message of the specified type based on the header
         :param header: bytes
@@ -179,7 +651,11 @@ class MessageFactory:
             The name of the sender
         :param message_data: bytes/str/dict
             The data to store in the message
+        :param encoding: int
+            The encoding of the message data, JSON_ENCODING or BINARY_ENCODING
+        :param signed: bool
+            Whether the message data ends with a signature trailer
         :return: `~qchat.messages.Message`
             A constructed messages
         """
-        return self.message_mapping[header](sender, message_data)
+        return self.message_mapping[header](sender, message_data, encoding=encoding, signed=signed)
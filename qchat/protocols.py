@@ -1,18 +1,22 @@
 import abc
 import random
-import time
+import numpy as np
+from qchat.cryptobox import QChatKeyAgreement
 from qchat.device import LeadDevice, FollowDevice
-from qchat.ecc import ECC_Golay
+from qchat.ecc import create_ecc
 from qchat.log import QChatLogger
-from qchat.messages import PTCLMessage, BB84Message, SPDSMessage, DQKDMessage
+from qchat.messages import PTCLMessage, BB84Message, SPDSMessage, DQKDMessage, BitVector, as_bytes
 
 LEADER_ROLE = 0
 FOLLOW_ROLE = 1
 IDLE_TIMEOUT = 60
 BYTE_LEN = 8
 ROUND_SIZE = 100
+DEFAULT_EPR_WINDOW = 10
+DEFAULT_BATCH_RECONCILIATION = True
+DEFAULT_ECC = "golay"
+BASELINE_OPTIONS = {"window": 1, "batch_reconciliation": False, "ecc": DEFAULT_ECC}
 PCHSH = 0.8535533905932737
-MAX_GOLAY_ERROR = 0.13043478260869565
 
 
 class ProtocolException(Exception):
@@ -20,7 +24,8 @@ class ProtocolException(Exception):
 
 
 class QChatProtocol(metaclass=abc.ABCMeta):
-    def __init__(self, peer_info, connection, ctrl_msg_q, outbound_q, role, relay_info):
+    def __init__(self, peer_info, connection, ctrl_msg_q, outbound_q, role, relay_info, sessions=None,
+                 session_pub=None, session_id=None):
         """
         Initializes a protocol object that is used for executing quantum/classical exchange protocols
         :param peer_info: dict
@@ -29,15 +34,31 @@ class QChatProtocol(metaclass=abc.ABCMeta):
             A QChatConnection object
         :param key_size: int
             The length of the key we wish to derive
-        :param ctrl_msg_q: list
+        :param ctrl_msg_q: `~qchat.channel.MessageChannel`
             Queue containing inbound messages from our peer
         :param outbound_q: list
             Queue containing outbound message to our peer
         :param role: int
             Either LEADER_ROLE or FOLLOW_ROLE for coordinating the protocol
+        :param sessions: dict
+            Table of MAC sessions keyed by peer and protocol session, None to authenticate every control message
+            with a signature
+        :param session_pub: bytes
+            The leader's ephemeral public key when the leader requested a MAC session
+        :param session_id: int
+            Identifier of the protocol session carried on our control messages so that concurrent protocols with
+            the same peer receive their own messages
         """
         self.logger = QChatLogger(__name__)
 
+        # The protocol session and the MAC session authenticating our control messages once the protocol is
+        # initialized
+        self.session_id = session_id
+        self.sessions = sessions
+        self.session_pub = as_bytes(session_pub) if session_pub is not None else None
+        self.key_agreement = None
+        self.session = None
+
         # QChat connection interface
         self.connection = connection
 
@@ -88,24 +109,13 @@ class QChatProtocol(metaclass=abc.ABCMeta):
         :return: `~qchat.messages.Message`
             The message that we received
         """
-        # Wait for a message
-        wait_start = time.time()
-        while True:
-            curr_time = time.time()
-            if curr_time - wait_start > idle_timeout:
-                raise ProtocolException("Timed out waiting for control message")
-
-            if self.ctrl_msg_q:
-                break
-
-            else:
-                time.sleep(0.005)
-
-        # Grab the newest message
-        message = self.ctrl_msg_q.pop(0)
+        # Wait for the next message, we are woken as soon as one is stored
+        message = self.ctrl_msg_q.get(block=True, timeout=idle_timeout)
+        if message is None:
+            raise ProtocolException("Timed out waiting for control message")
 
         # Verify it is routed to the correct place
-        if not isinstance(message, message_type):
+        if message_type and not isinstance(message, message_type):
             raise ProtocolException("Received incorrect control message")
 
         return message
@@ -119,9 +129,87 @@ class QChatProtocol(metaclass=abc.ABCMeta):
             The class of the type of message we want to send
         :return: None
         """
+        if self.session_id is not None:
+            message_data = dict(message_data, session_id=self.session_id)
         message = message_type(sender=self.connection.name, message_data=message_data)
+        message.session = self.session
         self.outbound_q.put((self.peer_info["user"], message))
 
+    def _derive_session(self, peer_pub, leader_pub, follower_pub):
+        """
+        Derives the MAC session shared with our peer from the exchanged ephemeral public keys
+        :param peer_pub: bytes
+            The ephemeral public key of our peer
+        :param leader_pub: bytes
+            The ephemeral public key of the leader
+        :param follower_pub: bytes
+            The ephemeral public key of the follower
+        :return: `~qchat.cryptobox.QChatMACSession`
+            The derived session
+        """
+        if self.role == LEADER_ROLE:
+            leader, follower = self.connection.name, self.peer_info["user"]
+        else:
+            leader, follower = self.peer_info["user"], self.connection.name
+        context = bytes("{}:{}:{}:{}".format(self.name, leader, follower, self.session_id), 'utf-8')
+        return self.key_agreement.derive_session(peer_pub, leader_pub, follower_pub, context,
+                                                 leader=self.role == LEADER_ROLE)
+
+    def _offer_session(self, message_data):
+        """
+        Adds our ephemeral public key to the protocol initialization data if MAC sessions are enabled
+        :param message_data: dict
+            The PTCL message data
+        :return: dict
+            The PTCL message data
+        """
+        if self.sessions is not None:
+            self.key_agreement = QChatKeyAgreement()
+            message_data["session_pub"] = self.key_agreement.get_pub()
+        return message_data
+
+    def _accept_session(self, response):
+        """
+        Opens the MAC session offered in the follower's acknowledgement.  The acknowledgement is signed so the
+        session is authenticated.
+        :param response: `~qchat.messages.Message`
+            The follower's acknowledgement
+        :return: None
+        """
+        if self.key_agreement is None or "session_pub" not in response.data:
+            return
+
+        follower_pub = as_bytes(response.data["session_pub"])
+        self.session = self._derive_session(follower_pub, self.key_agreement.get_pub(), follower_pub)
+        self.sessions[(self.peer_info["user"], self.session_id)] = self.session
+
+    def _acknowledge_protocol(self):
+        """
+        Acknowledges the protocol to the leader, a MAC session is agreed on if the leader offered one.  Our
+        acknowledgement is signed, subsequent control messages are authenticated with the session.
+        :return: None
+        """
+        message_data = {"ACK": "ACK"}
+        session = None
+        if self.sessions is not None and self.session_pub is not None:
+            self.key_agreement = QChatKeyAgreement()
+            message_data["session_pub"] = self.key_agreement.get_pub()
+            session = self._derive_session(self.session_pub, self.session_pub, message_data["session_pub"])
+            self.sessions[(self.peer_info["user"], self.session_id)] = session
+
+        self._send_control_message(message_data=message_data, message_type=self.message_type)
+        self.session = session
+
+    def _close_session(self):
+        """
+        Removes our MAC session from the session table
+        :return: None
+        """
+        key = (self.peer_info["user"], self.session_id)
+        if self.session is not None and self.sessions.get(key) is self.session:
+            self.sessions.pop(key)
+        self.session = None
+
     def exchange_messages(self, message_data, message_type):
         """
         Exchanges messages with our peer
@@ -145,9 +233,21 @@ class QChatKeyProtocol(QChatProtocol):
     """
     Implements basic signalling
     """
-    def __init__(self, key_size, **kwargs):
+    def __init__(self, key_size, window=BASELINE_OPTIONS["window"],
+                 batch_reconciliation=BASELINE_OPTIONS["batch_reconciliation"], ecc=BASELINE_OPTIONS["ecc"], **kwargs):
         # The desired key size in bytes
         self.key_size = key_size
+
+        # The number of EPR pairs distributed per acknowledgement
+        self.window = max(1, window)
+
+        # Whether all codewords are reconciled in a single round trip
+        self.batch_reconciliation = batch_reconciliation
+
+        # The error correcting code used for reconciliation, rate adaptive codes follow the estimated error rates
+        self.ecc_name = ecc
+        self.ecc = create_ecc(ecc)
+        self.error_estimates = []
         super().__init__(**kwargs)
 
     def _lead_protocol(self):
@@ -155,18 +255,33 @@ class QChatKeyProtocol(QChatProtocol):
         Initiates a key generation protocol
         :return: None
         """
-        self._send_control_message(message_data={"name": self.name, "key_size": self.key_size},
-                                   message_type=PTCLMessage)
+        # Options are only sent when they differ from the baseline so that peers without support for them follow
+        options = {"window": self.window, "batch_reconciliation": self.batch_reconciliation, "ecc": self.ecc_name}
+        message_data = {"name": self.name, "key_size": self.key_size}
+        message_data.update({key: value for key, value in options.items() if value != BASELINE_OPTIONS[key]})
+        self._send_control_message(message_data=self._offer_session(message_data), message_type=PTCLMessage)
         response = self._wait_for_control_message(message_type=self.message_type)
         if response.data["ACK"] != "ACK":
             raise ProtocolException("Failed to establish leader/role")
+        self._accept_session(response)
 
     def _follow_protocol(self):
         """
         Initiates the following of a key generation protocol
         :return:
         """
-        self._send_control_message(message_data={"ACK": "ACK"}, message_type=self.message_type)
+        self._acknowledge_protocol()
+
+    def _adapt_ecc(self):
+        """
+        Adapts our error correcting code to the mean of the error rates estimated so far, both peers estimate the
+        same error rates so they adapt to the same code
+        :return: `~qchat.ecc.ECC`
+            The adapted code
+        """
+        if not self.error_estimates:
+            return self.ecc
+        return self.ecc.adapt(sum(self.error_estimates) / len(self.error_estimates))
 
     def _end_protocol(self):
         """
@@ -176,6 +291,7 @@ class QChatKeyProtocol(QChatProtocol):
         m = self.exchange_messages(message_data={"FIN": True}, message_type=self.message_type)
         if not m.data["FIN"]:
             raise ProtocolException("Failed to terminate {} protocol".format(self.name))
+        self._close_session()
 
 
 class BB84_Purified(QChatKeyProtocol):
@@ -196,34 +312,48 @@ class BB84_Purified(QChatKeyProtocol):
         x = []
         theta = []
 
-        # Distribute ROUND_SIZE qubits
-        while len(x) < ROUND_SIZE:
-            # Request our EPR source to distribute the pairs
-            if self.role == LEADER_ROLE:
-                self.logger.debug("Requesting EPR pair with {}".format(self.peer_info["user"]))
-                self.device.requestEPR(self.peer_info["user"])
-
-            # Receive our half of the EPR pair
-            self.logger.debug("Trying to receive EPR pair")
-            q = self.device.receiveEPR()
-            self.logger.debug("Successfully received!")
-
-            # Randomly measure in Hadamard/Standard basis
-            basisflip = random.randint(0, 1)
-            if basisflip:
-                q.H()
-
-            # Store the measurement/basis information
-            theta.append(basisflip)
-            x.append(q.measure())
+        # Request the first window of EPR pairs from our source
+        if self.role == LEADER_ROLE:
+            self._request_epr_window(min(self.window, ROUND_SIZE))
 
-            # Let peer know we are ready for the next qubit
+        # Distribute ROUND_SIZE qubits, measuring pairs as they arrive and acknowledging once per window
+        while len(x) < ROUND_SIZE:
+            for _ in range(min(self.window, ROUND_SIZE - len(x))):
+                # Receive our half of the EPR pair
+                self.logger.debug("Trying to receive EPR pair")
+                q = self.device.receiveEPR()
+                self.logger.debug("Successfully received!")
+
+                # Randomly measure in Hadamard/Standard basis
+                basisflip = random.randint(0, 1)
+                if basisflip:
+                    q.H()
+
+                # Store the measurement/basis information
+                theta.append(basisflip)
+                x.append(q.measure())
+
+            # Keep the source busy with the next window while we synchronize with our peer
+            if self.role == LEADER_ROLE and len(x) < ROUND_SIZE:
+                self._request_epr_window(min(self.window, ROUND_SIZE - len(x)))
+
+            # Let peer know we are ready for the next window
             r = self.exchange_messages(message_data={"ack": True}, message_type=BB84Message)
             if not r.data["ack"]:
                 raise ProtocolException("Error distributing EPR states")
 
         return x, theta
 
+    def _request_epr_window(self, count):
+        """
+        Requests a window of EPR pairs shared with our peer from our EPR source
+        :param count: int
+            The number of EPR pairs to request
+        :return: None
+        """
+        self.logger.debug("Requesting {} EPR pairs with {}".format(count, self.peer_info["user"]))
+        self.device.requestEPR(self.peer_info["user"], count=count)
+
     def _filter_theta(self, x, theta):
         """
         Used to filter our measurements that were done with differing basis between the two peers in the protocol
@@ -235,7 +365,7 @@ class BB84_Purified(QChatKeyProtocol):
             The remaining measurement outcomes with matching basis with our peer
         """
         # Exchange basis information
-        response = self.exchange_messages(message_data={"theta": theta}, message_type=BB84Message)
+        response = self.exchange_messages(message_data={"theta": BitVector(theta)}, message_type=BB84Message)
         theta_hat = response.data["theta"]
 
         x_remain = []
@@ -287,7 +417,7 @@ class BB84_Purified(QChatKeyProtocol):
                 test_bits.append(x.pop(index))
 
         # Exchange test bits with our peer
-        m = self.exchange_messages(message_data={"test_bits": test_bits}, message_type=BB84Message)
+        m = self.exchange_messages(message_data={"test_bits": BitVector(test_bits)}, message_type=BB84Message)
         target_test_bits = m.data["test_bits"]
 
         # Calculate the error rate of same basis bits
@@ -308,14 +438,20 @@ class BB84_Purified(QChatKeyProtocol):
 
         return error
 
-    def _reconcile_information(self, x, ecc=ECC_Golay()):
+    def _reconcile_information(self, x, ecc=None):
         """
         Information Reconciliation based on linear codes
         :param x: list
             Set of codewords
+        :param ecc: `~qchat.ecc.ECC`
+            The error correcting code to reconcile with, defaults to our code adapted to the estimated error rate
         :return: bytes
             Bytestring of reconciled information
         """
+        ecc = ecc or self._adapt_ecc()
+        if self.batch_reconciliation:
+            return self._reconcile_batch(x, ecc)
+
         reconciled = []
 
         # Iterate through the codewords we have available
@@ -328,7 +464,7 @@ class BB84_Purified(QChatKeyProtocol):
             if self.role == LEADER_ROLE:
                 # Encode the codeword and send the information
                 s = ecc.encode(codeword)
-                m = self.exchange_messages(message_data={"s": s}, message_type=BB84Message)
+                m = self.exchange_messages(message_data={"s": BitVector(s)}, message_type=BB84Message)
 
                 if not m.data["ack"]:
                     raise ProtocolException("Failed to reconcile secrets")
@@ -336,7 +472,7 @@ class BB84_Purified(QChatKeyProtocol):
             # As follower we receive the error correcting codes and correct information on our end
             elif self.role == FOLLOW_ROLE:
                 m = self.exchange_messages(message_data={"ack": True}, message_type=BB84Message)
-                s = m.data["s"]
+                s = list(m.data["s"])
 
             # Store the reconciled information
             reconciled += ecc.decode(codeword, s)
@@ -344,6 +480,54 @@ class BB84_Purified(QChatKeyProtocol):
         # Managed to have all valid length codewords, no remaining secret bits
         return [], reconciled
 
+    def _reconcile_batch(self, x, ecc):
+        """
+        Information Reconciliation of all complete codewords in a single round trip, the leader sends the syndromes
+        of every codeword and the follower corrects them all before acknowledging with the codewords it failed to
+        correct, which both sides drop
+        :param x: list
+            Set of codewords
+        :param ecc: `~qchat.ecc.ECC`
+            The error correcting code to reconcile with
+        :return: tuple
+            The remaining codeword bits, the reconciled information
+        """
+        X, remaining = ecc.chunk_batch(x)
+        if not len(X):
+            return remaining, []
+
+        # As leader we send the syndromes of all codewords, our own codewords are the reconciled information
+        if self.role == LEADER_ROLE:
+            S = ecc.encode_batch(X)
+            m = self.exchange_messages(message_data={"s": BitVector(S.ravel().tolist())}, message_type=BB84Message)
+
+            if not m.data["ack"]:
+                raise ProtocolException("Failed to reconcile secrets")
+
+            failed = m.data.get("failed", [])
+            if not all(isinstance(i, int) and 0 <= i < len(X) for i in failed):
+                raise ProtocolException("Received invalid failed codewords {}".format(failed))
+            reconciled = X
+
+        # As follower we correct all codewords with the received syndromes and acknowledge once
+        else:
+            m = self._wait_for_control_message(message_type=BB84Message)
+            s = list(m.data["s"])
+            if len(s) != len(X) * ecc.H.shape[0]:
+                self._send_control_message(message_data={"ack": False}, message_type=BB84Message)
+                raise ProtocolException("Received {} syndrome bits for {} codewords".format(len(s), len(X)))
+
+            reconciled, failures = ecc.decode_batch(X, s, return_failures=True)
+            failed = failures.nonzero()[0].tolist()
+            self._send_control_message(message_data={"ack": True, "failed": failed}, message_type=BB84Message)
+
+        # Codewords that could not be corrected are dropped rather than leaking mismatched bits into the key
+        if failed:
+            self.logger.debug("Dropping {} of {} codewords that failed to reconcile".format(len(failed), len(X)))
+            reconciled = np.delete(reconciled, failed, axis=0)
+
+        return remaining, reconciled.ravel().tolist()
+
     def _amplify_privacy(self, X):
         """
         One-round privacy amplification sourced from https://eprint.iacr.org/2010/456.pdf
@@ -408,8 +592,9 @@ class BB84_Purified(QChatKeyProtocol):
         error_rate = self._estimate_error_rate(x_remain)
 
         # Abort the protocol if we have to high of an error rate to reconcile information with
-        if error_rate >= MAX_GOLAY_ERROR:
+        if error_rate >= self.ecc.max_error_rate:
             return []
+        self.error_estimates.append(error_rate)
 
         # Return the secret data
         return x_remain
@@ -431,8 +616,8 @@ class BB84_Purified(QChatKeyProtocol):
             # Privacy amplification requires two bytes of reconciled data
             while len(reconciled) < 2*BYTE_LEN:
 
-                # Golay Error Correction requires 23 bits of data per code word
-                while len(secret_bits) < ECC_Golay.codeword_length:
+                # Error Correction requires a full codeword of data
+                while len(secret_bits) < self.ecc.codeword_length:
                     secret_bits += self.distill_tested_data()
                     self.logger.debug("Secret bits: {}".format(secret_bits))
 
@@ -564,7 +749,7 @@ class DIQKD(BB84_Purified):
 
         # Now we exchange the actual test measurements for the tests
         x_T = [x[j] for j in T]
-        m = self.exchange_messages(message_data={"x_T": x_T}, message_type=DQKDMessage)
+        m = self.exchange_messages(message_data={"x_T": BitVector(x_T)}, message_type=DQKDMessage)
         x_T_hat = m.data["x_T"]
 
         # Calculate the number of rounds that pass the CHSH game
@@ -587,6 +772,7 @@ class DIQKD(BB84_Purified):
             self.logger.debug("CHSH Winners: {} out of {}".format(len(winning), Tp))
             self.logger.debug("Matching: {} out of {}".format(len(matching), Tpp))
             raise ProtocolException("Failed to pass CHSH test: p_win: {} p_match: {}".format(p_win, p_match))
+        self.error_estimates.append(1 - p_match)
 
         # Return the remaining secret measurement results
         x_remain = [x[r] for r in R]
@@ -629,8 +815,8 @@ class DIQKD(BB84_Purified):
             # Privacy amplification requires two bytes of reconciled data
             while len(reconciled) < 2*BYTE_LEN:
 
-                # Golay Error Correction requires 23 bits of data per code word
-                while len(secret_bits) < ECC_Golay.codeword_length:
+                # Error Correction requires a full codeword of data
+                while len(secret_bits) < self.ecc.codeword_length:
                     secret_bits += self.distill_device_independent_data()
                     self.logger.debug("Secret bits: {}".format(secret_bits))
 
@@ -662,17 +848,18 @@ class QChatMessageProtocol(QChatProtocol):
         Sends the protocol message that initiates the protocol
         :return: None
         """
-        self._send_control_message(message_data={"name": self.name}, message_type=PTCLMessage)
+        self._send_control_message(message_data=self._offer_session({"name": self.name}), message_type=PTCLMessage)
         response = self._wait_for_control_message(message_type=self.message_type)
         if response.data["ACK"] != "ACK":
             raise ProtocolException("Failed to establish leader/role")
+        self._accept_session(response)
 
     def _follow_protocol(self):
         """
         Responds to the protocol message so that peers are in sync
         :return: None
         """
-        self._send_control_message(message_data={"ACK": "ACK"}, message_type=self.message_type)
+        self._acknowledge_protocol()
 
     def _end_protocol(self):
         """
@@ -682,6 +869,7 @@ class QChatMessageProtocol(QChatProtocol):
         m = self.exchange_messages(message_data={"FIN": True}, message_type=self.message_type)
         if not m.data["FIN"]:
             raise ProtocolException("Failed to terminate {} protocol".format(self.name))
+        self._close_session()
 
 
 class SuperDenseCoding(QChatMessageProtocol):
@@ -0,0 +1,469 @@
+import threading
+import time
+from collections import defaultdict, deque
+from qchat.connection import DaemonThread
+from qchat.log import QChatLogger
+
+DEFAULT_MAX_REQUESTS = 1024
+DEFAULT_BURST = 10
+DEFAULT_WEIGHT = 1
+THROUGHPUT_WINDOW = 10
+
+
+class RequestRejected(Exception):
+    pass
+
+
+def pair_key(requester, peer):
+    """
+    Returns the key identifying the pair of users an EPR pair is shared between regardless of who requested it
+    :param requester: str
+        The user that requested the pair
+    :param peer: str
+        The user the pair is shared with
+    :return: str
+        The key of the pair of users
+    """
+    return ":".join(sorted((requester, peer)))
+
+
+class EPRRequest:
+    """
+    A request for a number of EPR pairs shared between the requesting user and a peer
+    """
+    __slots__ = ("requester", "peer", "count", "request_id", "distributed", "error")
+
+    def __init__(self, requester, peer, count, request_id=None):
+        """
+        Initializes an EPR request
+        :param requester: str
+            The user that receives the first half of each pair
+        :param peer: str
+            The user that receives the second half of each pair
+        :param count: int
+            The number of pairs to distribute
+        :param request_id: int
+            Identifier of the request used for completion reporting, None if no report is wanted
+        """
+        self.requester = requester
+        self.peer = peer
+        self.count = count
+        self.request_id = request_id
+        self.distributed = 0
+        self.error = None
+
+
+class TokenBucket:
+    """
+    Limits the rate at which EPR pairs are generated while allowing short bursts
+    """
+    def __init__(self, rate, burst=DEFAULT_BURST):
+        """
+        Initializes a full bucket
+        :param rate: float
+            The number of tokens added per second
+        :param burst: int
+            The maximum number of tokens held by the bucket
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        """
+        Adds the tokens accumulated since the last update
+        :param now: float
+            The current monotonic time
+        :return: None
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        Returns the time until a token is available
+        :param now: float
+            The current monotonic time
+        :return: float
+            The number of seconds to wait, 0 if a token is available
+        """
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        """
+        Takes a token from the bucket
+        :param now: float
+            The current monotonic time
+        :return: None
+        """
+        self._refill(now)
+        self.tokens -= 1
+
+
+class EPRFlow:
+    """
+    The queued requests and distribution metrics of a pair of users
+    """
+    __slots__ = ("requests", "weight", "start", "bucket", "outstanding", "requested", "distributed", "failed",
+                 "rejected", "history")
+
+    def __init__(self, weight, bucket=None):
+        """
+        Initializes an idle flow
+        :param weight: float
+            The share of the source the flow receives relative to other active flows
+        :param bucket: `~qchat.relay.TokenBucket`
+            Rate limit of the flow, None for no limit
+        """
+        self.requests = deque()
+        self.weight = weight
+        self.start = 0.0
+        self.bucket = bucket
+        self.outstanding = 0
+        self.requested = 0
+        self.distributed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.history = deque()
+
+
+class EPRScheduler:
+    """
+    Decides which request the EPR source serves next.  Every pair of users is a flow and flows share the source
+    through start-time weighted fair queuing one EPR pair at a time, so a large key exchange cannot starve other
+    pairs of users.  Requests are admitted subject to per-user and per-pair quotas on outstanding pairs and
+    generation is limited by token buckets for the whole source and for each pair of users.
+    """
+    def __init__(self, user_quota=None, pair_quota=None, max_requests=DEFAULT_MAX_REQUESTS, rate=None,
+                 pair_rate=None, burst=DEFAULT_BURST, weights=None, window=THROUGHPUT_WINDOW):
+        """
+        Initializes an empty scheduler
+        :param user_quota: int
+            The maximum number of outstanding pairs involving a single user, None for no limit
+        :param pair_quota: int
+            The maximum number of outstanding pairs between two users, None for no limit
+        :param max_requests: int
+            The maximum number of queued requests
+        :param rate: float
+            The maximum number of pairs generated per second, None for no limit
+        :param pair_rate: float
+            The maximum number of pairs generated per second between two users, None for no limit
+        :param burst: int
+            The number of pairs that may be generated back to back when under the rate limits
+        :param weights: dict
+            The positive weight of users, a pair of users is weighted by the smaller weight of the two
+        :param window: float
+            The number of seconds the throughput of a pair of users is measured over
+        """
+        for user, weight in (weights or {}).items():
+            if weight <= 0:
+                raise ValueError("Weight of {} must be positive, got {}".format(user, weight))
+
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.user_quota = user_quota
+        self.pair_quota = pair_quota
+        self.max_requests = max_requests
+        self.pair_rate = pair_rate
+        self.burst = burst
+        self.weights = weights or {}
+        self.window = window
+
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.flows = {}
+        self.user_outstanding = defaultdict(int)
+        self.queued = 0
+        self.virtual_time = 0.0
+
+    def _get_flow(self, key, users):
+        """
+        Returns the flow of a pair of users, must be called with the lock held
+        :param key: str
+            The key of the pair of users
+        :param users: set
+            The users of the pair
+        :return: `~qchat.relay.EPRFlow`
+            The flow of the pair
+        """
+        flow = self.flows.get(key)
+        if flow is None:
+            weight = min(self.weights.get(user, DEFAULT_WEIGHT) for user in users)
+            bucket = TokenBucket(self.pair_rate, self.burst) if self.pair_rate else None
+            flow = self.flows[key] = EPRFlow(weight=weight, bucket=bucket)
+        return flow
+
+    def submit(self, request):
+        """
+        Admits a request into the queue of its pair of users
+        :param request: `~qchat.relay.EPRRequest`
+            The request to queue
+        :return: None
+        """
+        users = {request.requester, request.peer}
+        with self.lock:
+            flow = self._get_flow(pair_key(request.requester, request.peer), users)
+            flow.requested += request.count
+
+            reason = None
+            if request.count < 1:
+                reason = "Invalid number of pairs {}".format(request.count)
+            elif self.queued >= self.max_requests:
+                reason = "Too many queued requests"
+            elif self.pair_quota is not None and flow.outstanding + request.count > self.pair_quota:
+                reason = "Pair quota of {} exceeded".format(self.pair_quota)
+            elif self.user_quota is not None and any(self.user_outstanding[user] + request.count > self.user_quota
+                                                     for user in users):
+                reason = "User quota of {} exceeded".format(self.user_quota)
+
+            if reason:
+                flow.rejected += 1
+                raise RequestRejected(reason)
+
+            # A flow becoming active must not claim the service it missed while idle
+            if not flow.requests:
+                flow.start = max(flow.start, self.virtual_time)
+
+            flow.requests.append(request)
+            flow.outstanding += request.count
+            for user in users:
+                self.user_outstanding[user] += request.count
+            self.queued += 1
+            self.ready.notify()
+
+    def _select(self, now):
+        """
+        Selects the active flow with the earliest start tag that is within its rate limit, must be called with the
+        lock held
+        :param now: float
+            The current monotonic time
+        :return: tuple
+            The selected flow or None, the number of seconds until a flow may be served or None if all are idle
+        """
+        active = [flow for flow in self.flows.values() if flow.requests]
+        if not active:
+            return None, None
+
+        wait = self.bucket.delay(now) if self.bucket else 0
+        if wait:
+            return None, wait
+
+        selected, wait = None, None
+        for flow in active:
+            delay = flow.bucket.delay(now) if flow.bucket else 0
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+            elif selected is None or flow.start < selected.start:
+                selected = flow
+        return selected, wait
+
+    def next(self, timeout=None):
+        """
+        Waits for the request to distribute the next EPR pair for
+        :param timeout: float
+            The number of seconds to wait, None waits indefinitely
+        :return: `~qchat.relay.EPRRequest`
+            The request to serve, None if no request could be served before the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                flow, wait = self._select(now)
+                if flow is not None:
+                    self.virtual_time = flow.start
+                    flow.start += 1 / flow.weight
+                    if self.bucket:
+                        self.bucket.consume(now)
+                    if flow.bucket:
+                        flow.bucket.consume(now)
+                    return flow.requests[0]
+
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.ready.wait(wait)
+
+    def record(self, request, error=None):
+        """
+        Records the outcome of distributing a pair for a request, a request ends at its first failure
+        :param request: `~qchat.relay.EPRRequest`
+            The served request
+        :param error: str
+            Description of the failure, None if the pair was distributed
+        :return: bool
+            Whether the request is complete
+        """
+        users = {request.requester, request.peer}
+        now = time.monotonic()
+        with self.lock:
+            flow = self.flows[pair_key(request.requester, request.peer)]
+            if error is None:
+                request.distributed += 1
+                released = 1
+                flow.distributed += 1
+                flow.history.append(now)
+            else:
+                request.error = error
+                released = request.count - request.distributed
+                flow.failed += 1
+
+            flow.outstanding -= released
+            for user in users:
+                self.user_outstanding[user] -= released
+
+            done = error is not None or request.distributed >= request.count
+            if done:
+                flow.requests.remove(request)
+                self.queued -= 1
+            self._prune(flow, now)
+            return done
+
+    def _prune(self, flow, now):
+        """
+        Discards the distribution times of a flow that fall out of the throughput window, must be called with the
+        lock held
+        :param flow: `~qchat.relay.EPRFlow`
+            The flow to prune
+        :param now: float
+            The current monotonic time
+        :return: None
+        """
+        while flow.history and flow.history[0] < now - self.window:
+            flow.history.popleft()
+
+    def get_flow_stats(self):
+        """
+        Returns the distribution metrics of every pair of users
+        :return: dict
+            The number of requested/distributed/failed pairs, rejected requests, queued requests, outstanding pairs
+            and the throughput in pairs per second keyed by pair of users
+        """
+        now = time.monotonic()
+        with self.lock:
+            stats = {}
+            for key, flow in self.flows.items():
+                self._prune(flow, now)
+                stats[key] = {
+                    "weight": flow.weight,
+                    "requested": flow.requested,
+                    "distributed": flow.distributed,
+                    "failed": flow.failed,
+                    "rejected": flow.rejected,
+                    "queued": len(flow.requests),
+                    "outstanding": flow.outstanding,
+                    "throughput": len(flow.history) / self.window
+                }
+            return stats
+
+
+class EPRSource:
+    """
+    Distributes the EPR pairs of queued requests on a dedicated thread.  The scheduler decides which request every
+    pair is generated for so that the quantum backend is driven by a single loop instead of one message handling
+    thread per pair.
+    """
+    def __init__(self, distribute, report=None, scheduler=None):
+        """
+        Initializes the source and starts its distribution thread
+        :param distribute: func
+            Distributes a single pair, called with the requester and the peer
+        :param report: func
+            Called with each completed request that has a request identifier and with each failed or rejected
+            request, so that protocols waiting for the pairs of a request that will not be served can abort
+        :param scheduler: `~qchat.relay.EPRScheduler`
+            Scheduler of the requests, defaults to an unlimited scheduler
+        """
+        self.logger = QChatLogger(__name__)
+        self.distribute = distribute
+        self.report = report
+        self.scheduler = scheduler or EPRScheduler()
+
+        # Distribution metrics
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "completed": 0, "failed": 0, "rejected": 0, "pairs": 0}
+
+        self.worker = DaemonThread(target=self.run)
+
+    def submit(self, request):
+        """
+        Queues a request for distribution, rejected requests are reported immediately
+        :param request: `~qchat.relay.EPRRequest`
+            The request to serve
+        :return: bool
+            Whether the request was admitted
+        """
+        with self.lock:
+            self.stats["requests"] += 1
+
+        try:
+            self.scheduler.submit(request)
+            return True
+        except RequestRejected as e:
+            self.logger.warning("Rejected EPR request from {} for {}: {}".format(request.requester, request.peer, e))
+            request.error = str(e)
+            with self.lock:
+                self.stats["rejected"] += 1
+            self._report(request)
+            return False
+
+    def run(self):
+        """
+        Serves the scheduled requests
+        :return: None
+        """
+        while True:
+            request = self.scheduler.next()
+            self.serve(request)
+
+    def serve(self, request):
+        """
+        Distributes the next pair of a request and reports its completion
+        :param request: `~qchat.relay.EPRRequest`
+            The request to serve
+        :return: None
+        """
+        error = None
+        try:
+            self.distribute(request.requester, request.peer)
+        except Exception as e:
+            self.logger.exception("Failed to distribute EPR pairs between {} and {}".format(
+                request.requester, request.peer))
+            error = str(e)
+
+        if not self.scheduler.record(request, error):
+            return
+
+        with self.lock:
+            self.stats["pairs"] += request.distributed
+            self.stats["failed" if request.error else "completed"] += 1
+        self._report(request)
+
+    def _report(self, request):
+        """
+        Reports the outcome of a request that has a request identifier or did not succeed
+        :param request: `~qchat.relay.EPRRequest`
+            The finished request
+        :return: None
+        """
+        if self.report and (request.request_id is not None or request.error is not None):
+            try:
+                self.report(request)
+            except Exception:
+                self.logger.exception("Failed to report EPR request {}".format(request.request_id))
+
+    def get_stats(self):
+        """
+        Returns the distribution metrics of the source
+        :return: dict
+            The number of submitted, completed, failed and rejected requests, distributed pairs, queued requests and
+            the metrics of every pair of users
+        """
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queued"] = self.scheduler.queued
+        stats["flows"] = self.scheduler.get_flow_stats()
+        return stats
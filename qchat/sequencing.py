@@ -0,0 +1,257 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_REORDER_LIMIT = 1024
+DEFAULT_RETRANSMIT_LIMIT = 256
+RETRANSMIT_TTL = 30
+NACK_DELAY = 0.2
+
+
+class ReorderBuffer:
+    """
+    Restores the order of the sequenced messages of a peer.  Messages are delivered in sequence number order,
+    messages that arrive early are held until the gap before them is filled by a retransmission or skipped.
+    Messages are delivered without holding the lock, so a slow consumer does not block other callers.
+    """
+    def __init__(self, deliver, limit=DEFAULT_REORDER_LIMIT):
+        """
+        Initializes an empty reorder buffer
+        :param deliver: func
+            Called with each message in sequence number order
+        :param limit: int
+            The maximum distance between the next expected sequence number and a held message
+        """
+        self.lock = threading.Lock()
+        self.deliver = deliver
+        self.limit = limit
+        self.epoch = None
+        self.expected = 0
+        self.pending = {}
+        self.gap_since = None
+
+        # Messages released in order that are waiting for delivery, delivered by one caller at a time
+        self.ready = deque()
+        self.delivering = False
+
+        # Delivery statistics
+        self.delivered = 0
+        self.reordered = 0
+        self.duplicates = 0
+        self.skipped = 0
+
+    def _reset(self, epoch, sequence):
+        """
+        Starts tracking a new sequence of the peer, must be called with the lock held.  The sequence starts at zero
+        unless the first message is beyond the reorder window, in which case we restarted while the peer kept
+        numbering its messages and the sequence is picked up from that message.
+        :param epoch: int
+            The epoch of the peer's new sequence
+        :param sequence: int
+            The sequence number of the first message seen in the epoch
+        :return: None
+        """
+        self.epoch = epoch
+        self.expected = sequence if sequence >= self.limit else 0
+        self.pending = {}
+        self.gap_since = None
+
+    def _flush(self):
+        """
+        Releases held messages that are no longer preceded by a gap for delivery, must be called with the lock held
+        :return: None
+        """
+        expected = self.expected
+        while self.expected in self.pending:
+            message = self.pending.pop(self.expected)
+            self.expected += 1
+            if message is not None:
+                self.delivered += 1
+                self.ready.append(message)
+
+        if not self.pending:
+            self.gap_since = None
+        elif self.gap_since is None or self.expected != expected:
+            self.gap_since = time.monotonic()
+
+    def _drain(self):
+        """
+        Delivers the released messages in order outside of the lock, unless another caller is already delivering
+        them
+        :return: None
+        """
+        with self.lock:
+            if self.delivering:
+                return
+            self.delivering = True
+
+        while True:
+            with self.lock:
+                if not self.ready:
+                    self.delivering = False
+                    return
+                message = self.ready.popleft()
+
+            try:
+                self.deliver(message)
+            except Exception:
+                # Remaining messages are delivered by the next caller
+                with self.lock:
+                    self.delivering = False
+                raise
+
+    def push(self, epoch, sequence, message):
+        """
+        Adds a message of the peer and delivers all messages that are now in order
+        :param epoch: int
+            The epoch of the sequence the message belongs to
+        :param sequence: int
+            The sequence number of the message
+        :param message: `~qchat.messages.Message`
+            The message
+        :return: bool
+            Whether the message was accepted, duplicates and messages too far ahead are rejected
+        """
+        with self.lock:
+            if epoch != self.epoch:
+                self._reset(epoch, sequence)
+
+            if sequence < self.expected or sequence in self.pending:
+                self.duplicates += 1
+                return False
+            if sequence - self.expected >= self.limit:
+                return False
+
+            if sequence != self.expected:
+                self.reordered += 1
+            self.pending[sequence] = message
+            self._flush()
+
+        self._drain()
+        return True
+
+    def skip(self, epoch, sequences):
+        """
+        Gives up on messages that the peer can no longer retransmit so that later messages can be delivered
+        :param epoch: int
+            The epoch of the sequence the messages belong to
+        :param sequences: list
+            The sequence numbers of the lost messages
+        :return: None
+        """
+        with self.lock:
+            if epoch != self.epoch:
+                return
+
+            for sequence in sequences:
+                if self.expected <= sequence < self.expected + self.limit and sequence not in self.pending:
+                    self.pending[sequence] = None
+                    self.skipped += 1
+            self._flush()
+        self._drain()
+
+    def get_missing(self, delay=NACK_DELAY):
+        """
+        Returns the sequence numbers missing before held messages once the gap persisted for the delay, so that
+        messages reordered by concurrent processing are not requested again
+        :param delay: float
+            The number of seconds a gap has to persist
+        :return: tuple
+            The epoch of the sequence, the missing sequence numbers
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.gap_since is None or now - self.gap_since < delay:
+                return self.epoch, []
+
+            # Wait another delay before requesting the same messages again
+            self.gap_since = now
+            last = max(self.pending)
+            return self.epoch, [s for s in range(self.expected, last) if s not in self.pending]
+
+    def get_stats(self):
+        """
+        Returns the delivery statistics of the buffer
+        :return: dict
+            The number of delivered/reordered/duplicate/skipped messages along with the number of held messages
+        """
+        with self.lock:
+            return {
+                "delivered": self.delivered,
+                "reordered": self.reordered,
+                "duplicates": self.duplicates,
+                "skipped": self.skipped,
+                "held": len([m for m in self.pending.values() if m is not None])
+            }
+
+
+class RetransmitBuffer:
+    """
+    Numbers the sequenced messages sent to a peer and retains their encoded frames so that messages the peer
+    reports missing can be retransmitted
+    """
+    def __init__(self, limit=DEFAULT_RETRANSMIT_LIMIT, ttl=RETRANSMIT_TTL):
+        """
+        Initializes an empty retransmit buffer
+        :param limit: int
+            The maximum number of retained frames
+        :param ttl: float
+            The number of seconds frames are retained for
+        """
+        self.lock = threading.Lock()
+        self.limit = limit
+        self.ttl = ttl
+        self.next_sequence = 0
+        self.frames = OrderedDict()
+        self.retransmitted = 0
+
+    def assign(self):
+        """
+        Reserves the sequence number of the next message
+        :return: int
+            The sequence number
+        """
+        with self.lock:
+            sequence = self.next_sequence
+            self.next_sequence += 1
+            return sequence
+
+    def store(self, sequence, host, port, frame):
+        """
+        Retains the encoded frame of a sent message
+        :param sequence: int
+            The sequence number of the message
+        :param host: str
+            The host the frame was sent to
+        :param port: int
+            The port the frame was sent to
+        :param frame: bytes
+            The encoded message
+        :return: None
+        """
+        with self.lock:
+            self.frames[sequence] = (time.monotonic(), host, port, frame)
+            while len(self.frames) > self.limit:
+                self.frames.popitem(last=False)
+
+    def lookup(self, sequences):
+        """
+        Looks up the frames of messages to retransmit
+        :param sequences: list
+            The sequence numbers of the messages
+        :return: tuple
+            List of the (host, port, frame) of each retained message in sequence order, list of the sequence
+            numbers that can no longer be retransmitted
+        """
+        expiry = time.monotonic() - self.ttl
+        frames, lost = [], []
+        with self.lock:
+            for sequence in sorted(sequences):
+                entry = self.frames.get(sequence)
+                if entry is None or entry[0] < expiry:
+                    if sequence < self.next_sequence:
+                        lost.append(sequence)
+                    continue
+                frames.append(entry[1:])
+            self.retransmitted += len(frames)
+        return frames, lost
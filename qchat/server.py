@@ -1,8 +1,10 @@
 import random
 from cqc.pythonLib import qubit
 from functools import partial
-from qchat.messages import GETUMessage, PUTUMessage, RGSTMessage, RQQBMessage
+from qchat.cryptobox import RSA_ALGORITHM
+from qchat.messages import EPRDMessage, GETUMessage, PUTUMessage, RGSTMessage, RQBTMessage, RQQBMessage, as_bytes
 from qchat.core import QChatCore
+from qchat.relay import DEFAULT_BURST, DEFAULT_MAX_REQUESTS, EPRRequest, EPRScheduler, EPRSource
 
 
 class QChatServer(QChatCore):
@@ -24,26 +26,51 @@ class QChatServer(QChatCore):
             RGSTMessage.header: partial(self._pass_message_data, handler=self.registerUser),
             GETUMessage.header: partial(self._pass_message_data, handler=self.sendUserInfo),
             PUTUMessage.header: partial(self._pass_message_data, handler=self.addUserInfo),
-            RQQBMessage.header: self._distribute_qubits
+            RQQBMessage.header: self._distribute_qubits,
+            RQBTMessage.header: self._distribute_qubits
         }
 
         super(QChatServer, self).__init__(name=name, cqc_connection=cqc_connection, configFile=configFile,
                                           allow_invalid_signatures=allow_invalid_signatures)
 
+        # Source distributing the requested EPR pairs in a single loop, fairly shared between pairs of users
+        scheduler_config = self.config.get("epr_scheduler", {})
+        scheduler = EPRScheduler(user_quota=scheduler_config.get("user_quota"),
+                                 pair_quota=scheduler_config.get("pair_quota"),
+                                 max_requests=scheduler_config.get("max_requests", DEFAULT_MAX_REQUESTS),
+                                 rate=scheduler_config.get("rate"),
+                                 pair_rate=scheduler_config.get("pair_rate"),
+                                 burst=scheduler_config.get("burst", DEFAULT_BURST),
+                                 weights=scheduler_config.get("weights"))
+        self.epr_source = EPRSource(distribute=self._distribute_pair, report=self._report_epr_request,
+                                    scheduler=scheduler)
+
     def _distribute_qubits(self, message):
         """
         Internal method that allows the server to act as an EPR source.  For use in modeling the Purified BB84
-        protocol
+        protocol.  The request is queued for our EPR source, batch requests are reported back on completion.
         :param message: `~qchat.messages.RQQBMessage`
-            Message containing user information for EPR distribution
+            Message containing user information and optionally the number of EPR pairs to distribute
         :return: None
         """
-        # First send half to the message sender and store the second
         self.logger.debug("Got request for EPR from {}".format(message.sender))
-        q = self.connection.cqc.createEPR(message.sender)
-        self.logger.debug("Sent one half of EPR to {}".format(message.sender))
+        request = EPRRequest(requester=message.sender, peer=message.data["user"],
+                             count=message.data.get("count", 1), request_id=message.data.get("request_id"))
+        self.epr_source.submit(request)
+
+    def _distribute_pair(self, requester, peer):
+        """
+        Internal method for distributing a single EPR pair between two users
+        :param requester: str
+            The user receiving the first half of the pair
+        :param peer: str
+            The user receiving the second half of the pair
+        :return: None
+        """
+        # First send half to the message sender and store the second
+        q = self.connection.cqc.createEPR(requester)
+        self.logger.debug("Sent one half of EPR to {}".format(requester))
         # Optionally attack the distribution, comparison should be change to control influence
-        peer = message.data["user"]
         p = random.random()
         if p < 0:
             # Store our measurement and send a new qubit to the peer
@@ -54,9 +81,39 @@ class QChatServer(QChatCore):
         # Send other half to peer
         self.connection.cqc.sendQubit(q, peer)
         self.logger.debug("Sent other half of EPR to {}".format(peer))
-        self.logger.debug("Shared qubits between {} and {}".format(message.sender, peer))
 
-    def registerUser(self, user, connection, pub):
+    def _report_epr_request(self, request):
+        """
+        Internal method for reporting the outcome of an EPR request to the requester.  The peer is told about
+        failed and rejected requests as well, so that neither user waits for pairs that will not be distributed.
+        :param request: `~qchat.relay.EPRRequest`
+            The finished request
+        :return: None
+        """
+        self.logger.debug("Shared {} qubits between {} and {}".format(request.distributed, request.requester,
+                                                                      request.peer))
+        report_data = {"request_id": request.request_id,
+                       "requester": request.requester,
+                       "user": request.peer,
+                       "requested": request.count,
+                       "distributed": request.distributed,
+                       "error": request.error}
+        self.sendMessage(request.requester, EPRDMessage(sender=self.name, message_data=report_data))
+
+        if request.error is not None:
+            peer_data = dict(report_data, user=request.requester)
+            self.sendMessage(request.peer, EPRDMessage(sender=self.name, message_data=peer_data))
+
+    def getEPRStats(self):
+        """
+        Returns the metrics of our EPR source for planning its capacity
+        :return: dict
+            The number of submitted, completed, failed and rejected requests, distributed pairs, queued requests and
+            the requested/distributed pairs and throughput of every pair of users
+        """
+        return self.epr_source.get_stats()
+
+    def registerUser(self, user, connection, pub, alg=RSA_ALGORITHM):
         """
         Registers a new user to our server
         :param user: str
@@ -64,11 +121,13 @@ class QChatServer(QChatCore):
         :param connection: dict
             Connection (host/port) information of the user
         :param pub: bytes
-            The RSA public key of the user for authentication
+            The public key of the user for authentication
+        :param alg: str
+            The signature algorithm of the public key
         :return: None
         """
         if self.userDB.hasUser(user):
             raise Exception("User {} already registered".format(user))
         else:
-            self.addUserInfo(user, pub=pub.encode("ISO-8859-1"), connection=connection)
+            self.addUserInfo(user, pub=as_bytes(pub), alg=alg, connection=connection)
             self.logger.info("Registered new user {}".format(user))
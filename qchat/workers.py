@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from qchat.log import QChatLogger
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_MAX_PENDING = 1024
+DEFAULT_TYPE_LIMITS = {"PTCL": 4, "GETU": 2, "PUTU": 2}
+
+
+class MessageWorkerPool:
+    """
+    Runs message handling on bounded thread pools.  Message types with a concurrency limit are run on a dedicated
+    pool of that size with its own bound on pending messages, so that long running handlers, such as protocols, cannot
+    starve the handling of other messages and messages waiting on user information cannot hold up the user
+    information messages.
+    """
+    def __init__(self, handler, max_workers=DEFAULT_MAX_WORKERS, max_pending=DEFAULT_MAX_PENDING, type_limits=None):
+        """
+        Initializes the worker pools
+        :param handler: func
+            The function each message is passed to
+        :param max_workers: int
+            The number of threads handling messages without a concurrency limit
+        :param max_pending: int
+            The maximum number of submitted messages of each pool that have not completed, submit blocks beyond it
+        :param type_limits: dict
+            The maximum number of concurrently handled messages keyed by message header
+        """
+        self.logger = QChatLogger(__name__)
+        self.handler = handler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="qchat-worker")
+        self.type_executors = {}
+        for header, limit in (type_limits or {}).items():
+            prefix = "qchat-worker-{}".format(header.decode('utf-8'))
+            self.type_executors[header] = ThreadPoolExecutor(max_workers=limit, thread_name_prefix=prefix)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.type_pending = {header: threading.BoundedSemaphore(max_pending) for header in self.type_executors}
+
+        # Handling metrics keyed by message header
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: {"submitted": 0, "completed": 0, "failed": 0, "active": 0,
+                                          "total_queue_time": 0.0, "max_queue_time": 0.0})
+
+    def submit(self, message, **kwargs):
+        """
+        Queues a message for handling, blocks while the maximum number of pending messages of its pool is reached
+        :param message: `~qchat.messages.Message`
+            The message to handle
+        :param kwargs: dict
+            Additional arguments passed to the handler
+        :return: None
+        """
+        pending = self.type_pending.get(message.header, self.pending)
+        pending.acquire()
+        with self.lock:
+            self.stats[message.header]["submitted"] += 1
+        executor = self.type_executors.get(message.header, self.executor)
+        executor.submit(self._run, message, time.monotonic(), pending, kwargs)
+
+    def _run(self, message, submitted, pending, kwargs):
+        """
+        Handles a message on a worker thread and records its metrics
+        :param message: `~qchat.messages.Message`
+            The message to handle
+        :param submitted: float
+            The monotonic time the message was submitted at
+        :param pending: `~threading.BoundedSemaphore`
+            The pending message bound of the message's pool
+        :param kwargs: dict
+            Additional arguments passed to the handler
+        :return: None
+        """
+        queue_time = time.monotonic() - submitted
+        stats = self.stats[message.header]
+        with self.lock:
+            stats["active"] += 1
+            stats["total_queue_time"] += queue_time
+            stats["max_queue_time"] = max(stats["max_queue_time"], queue_time)
+
+        try:
+            self.handler(message, **kwargs)
+        except Exception:
+            self.logger.exception("Failed to process {} message from {}".format(message.header, message.sender))
+            with self.lock:
+                stats["failed"] += 1
+        finally:
+            with self.lock:
+                stats["active"] -= 1
+                stats["completed"] += 1
+            pending.release()
+
+    def get_stats(self):
+        """
+        Returns the handling metrics of each message type
+        :return: dict
+            Submitted/completed/failed/active message counts along with the mean and maximum time messages
+            waited for a worker, keyed by message header
+        """
+        with self.lock:
+            stats = {}
+            for header, s in self.stats.items():
+                stats[header] = dict(s)
+                started = s["completed"] + s["active"]
+                stats[header]["mean_queue_time"] = s["total_queue_time"] / started if started else 0.0
+            return stats
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker pools
+        :param wait: bool
+            Whether to wait for pending messages to be handled
+        :return: None
+        """
+        self.executor.shutdown(wait=wait)
+        for executor in self.type_executors.values():
+            executor.shutdown(wait=wait)
+
+
+def map_batches(executor, func, items, batches):
+    """
+    Splits items into contiguous batches that are processed by func on the executor
+    :param executor: `~concurrent.futures.Executor`
+        The executor processing the batches
+    :param func: func
+        Function that takes a list of items and returns a list with one result per item
+    :param items: list
+        The items to process
+    :param batches: int
+        The number of batches to split the items into
+    :return: list
+        The results in the order of the items
+    """
+    size = max(1, -(-len(items) // batches))
+    futures = [executor.submit(func, items[i:i + size]) for i in range(0, len(items), size)]
+    return [result for future in futures for result in future.result()]
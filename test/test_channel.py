@@ -0,0 +1,110 @@
+import threading
+import time
+import pytest
+from qchat.channel import ChannelFull, MessageChannel
+from qchat.messages import BB84Message, RGSTMessage
+
+
+class TestMessageChannel:
+    def test_put_get(self):
+        channel = MessageChannel()
+        assert channel.get() is None
+        channel.put("first")
+        channel.put("second")
+        assert len(channel) == 2
+        assert channel.get() == "first"
+        assert channel.get(block=True, timeout=0.01) == "second"
+        assert channel.get(block=True, timeout=0.01) is None
+
+    def test_blocking_get(self):
+        channel = MessageChannel()
+        t = threading.Timer(0.05, channel.put, args=("message",))
+        t.start()
+        start = time.time()
+        assert channel.get(block=True, timeout=5) == "message"
+        assert time.time() - start < 5
+
+    def test_drain(self):
+        channel = MessageChannel()
+        assert channel.drain() == []
+        for i in range(5):
+            channel.put(i)
+        assert channel.drain(max_messages=2) == [0, 1]
+        assert channel.drain(block=True) == [2, 3, 4]
+        assert channel.drain(block=True, timeout=0.01) == []
+
+    def test_stats(self):
+        channel = MessageChannel()
+        for i in range(3):
+            channel.put(i)
+        channel.get()
+        stats = channel.get_stats()
+        assert stats["depth"] == 2
+        assert stats["max_depth"] == 3
+        assert stats["mean_depth"] == 2
+        assert stats["enqueued"] == 3
+        assert stats["dequeued"] == 1
+
+
+class TestBoundedMessageChannel:
+    @classmethod
+    def setup_class(cls):
+        cls.control = BB84Message(sender="Alice", message_data={"ack": True})
+        cls.registration = RGSTMessage(sender="Bob", message_data={"user": "Bob"})
+
+    def test_drop_droppable(self):
+        channel = MessageChannel(type_limits={RGSTMessage.header: 1})
+        assert channel.put(self.registration)
+        assert not channel.put(self.registration)
+        assert channel.get_stats()["dropped"] == {RGSTMessage.header: 1}
+
+    def test_shed_for_control(self):
+        channel = MessageChannel(max_depth=2)
+        assert channel.put(self.registration)
+        assert channel.put(self.control)
+        assert channel.put(self.control, block=False)
+        assert list(channel.messages) == [self.control, self.control]
+        assert channel.get_stats()["dropped"] == {RGSTMessage.header: 1}
+
+    def test_backpressure(self):
+        channel = MessageChannel(sender_limit=1)
+        assert channel.put(self.control)
+        with pytest.raises(ChannelFull):
+            channel.put(self.control, block=False)
+        assert not channel.put(self.control, timeout=0.01)
+
+        t = threading.Timer(0.05, channel.get)
+        t.start()
+        assert channel.put(self.control, timeout=5)
+        stats = channel.get_stats()
+        assert stats["blocked"] == 2
+        assert stats["dropped"] == {BB84Message.header: 1}
+
+    def test_wait_for_room(self):
+        channel = MessageChannel(max_depth=1)
+        channel.put(self.control)
+        assert not channel.wait_for_room(self.control, timeout=0.01)
+
+        t = threading.Timer(0.05, channel.get)
+        t.start()
+        start = time.monotonic()
+        assert channel.wait_for_room(self.control, timeout=5)
+        assert time.monotonic() - start < 1
+        assert len(channel) == 0
+
+    def test_get_matching(self):
+        channel = MessageChannel()
+        channel.put(self.registration)
+        channel.put(self.control)
+        assert channel.get(match=lambda m: isinstance(m, BB84Message)) is self.control
+        assert channel.get(match=lambda m: isinstance(m, BB84Message)) is None
+        assert list(channel.messages) == [self.registration]
+
+    def test_get_wakes_waiter(self):
+        channel = MessageChannel()
+        t = threading.Timer(0.05, channel.put, args=(self.control,))
+        t.start()
+        start = time.monotonic()
+        assert channel.get(block=True, timeout=5, match=lambda m: isinstance(m, BB84Message)) is self.control
+        assert time.monotonic() - start < 1
+        assert channel.get(block=True, timeout=0.01) is None
@@ -1,7 +1,10 @@
+import socket
 import threading
 import pytest
-from qchat.connection import QChatConnection, ConnectionError
-from qchat.messages import Message
+import time
+from qchat.connection import QChatConnection, QChatAsyncConnection, ConnectionError, PeerConnectionPool, \
+                             MIN_EVICTION_INTERVAL, create_connection, eviction_interval
+from qchat.messages import BINARY_ENCODING, Message
 
 
 class mock_qubit:
@@ -35,8 +38,9 @@ class mock_cqc:
 
 
 class mock_connection:
-    def __init__(self, buffer):
-        self.buffer = buffer
+    def __init__(self, buffer, chunk_size=1024):
+        self.buffer = buffer.encode('utf-8') if isinstance(buffer, str) else buffer
+        self.chunk_size = chunk_size
 
     def recv(self, count):
         if self.buffer:
@@ -46,6 +50,11 @@ class mock_connection:
         else:
             return None
 
+    def recv_into(self, buffer):
+        data = self.recv(min(len(buffer), self.chunk_size)) or b''
+        buffer[:len(data)] = data
+        return len(data)
+
     def close(self):
         pass
 
@@ -69,16 +78,18 @@ class TestQChatConnection:
         assert self.connection.port == self.test_config1['port']
         threading_lock = type(threading.Lock())
         assert isinstance(self.connection.lock, threading_lock)
-        assert self.connection.message_queue == []
+        assert len(self.connection.message_queue) == 0
 
     def test_get_message(self):
         self.connection._append_message_to_queue(self.test_message)
         assert self.connection._pop_message_from_queue() == self.test_message
-        assert self.connection.message_queue == []
+        assert len(self.connection.message_queue) == 0
+        assert self.connection.recv_message() is None
+        assert self.connection.recv_message(block=True, timeout=0.01) is None
 
     def test_append_message_to_queue(self):
         self.connection._append_message_to_queue(self.test_message)
-        assert self.connection.message_queue[0] == self.test_message
+        assert self.connection.message_queue.messages[0] == self.test_message
 
     def test_handle_connection(self):
         # Invalid header
@@ -113,14 +124,152 @@ class TestQChatConnection:
             self.connection._handle_connection(mc, self.test_addr)
             assert str(ce) == "Message data too short"
 
-        payload = "testingtesting"
-        mc = mock_connection("MSSG" + "\x00" * 11 + "Alice" + str_size + payload)
+        # Trailing data that is not a message
+        message = Message(self.test_sender, self.test_message_data)
+        mc = mock_connection(message.encode_message() + b"testing")
+        with pytest.raises(ConnectionError) as ce:
+            self.connection._handle_connection(mc, self.test_addr)
+            assert str(ce) == "Incorrect message header"
+
+        # Payload exceeding the maximum frame size
+        mc = mock_connection("MSSG" + "\x00"*11 + "Alice" + "\x00\x7f\x00\x00")
         with pytest.raises(ConnectionError) as ce:
             self.connection._handle_connection(mc, self.test_addr)
             assert str(ce) == "Message data too long"
 
+        # Unknown frame flags
+        mc = mock_connection("MSSG" + "\x00"*11 + "Alice" + "\x01\x00\x00\x00")
+        with pytest.raises(ConnectionError) as ce:
+            self.connection._handle_connection(mc, self.test_addr)
+            assert str(ce) == "Unsupported frame flags"
+
         # Valid message
         message = Message(self.test_sender, self.test_message_data)
         mc = mock_connection(message.encode_message())
         self.connection._handle_connection(mc, self.test_addr)
-        assert self.connection.message_queue[0] is not None
+        assert self.connection.message_queue.messages[0] is not None
+
+    def test_handle_connection_stream(self):
+        messages = [Message(self.test_sender, {"index": i}) for i in range(3)]
+        mc = mock_connection(b''.join(m.encode_message() for m in messages), chunk_size=3)
+        queued = len(self.connection.message_queue)
+        self.connection._handle_connection(mc, self.test_addr)
+        received = list(self.connection.message_queue.messages)[queued:]
+        assert [m.data for m in received] == [m.data for m in messages]
+
+    def test_handle_connection_binary(self):
+        message = Message(self.test_sender, {"sig": b"\x00\xff", "theta": [0, 1, 1]}, encoding=BINARY_ENCODING)
+        mc = mock_connection(message.encode_message())
+        queued = len(self.connection.message_queue)
+        self.connection._handle_connection(mc, self.test_addr)
+        received = self.connection.message_queue.messages[queued]
+        assert received.encoding == BINARY_ENCODING
+        assert received.data == message.data
+
+
+class TestPeerConnectionPool:
+    def test_reuse_and_evict(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("localhost", 0))
+        listener.listen(1)
+        host, port = listener.getsockname()
+
+        pool = PeerConnectionPool(max_connections=1, idle_timeout=60)
+        pool.send(host, port, b"first")
+        pool.send(host, port, b"second")
+        conn, _ = listener.accept()
+        assert len(pool.idle[(host, port)]) == 1
+
+        data = b''
+        while len(data) < len(b"firstsecond"):
+            data += conn.recv(1024)
+        assert data == b"firstsecond"
+
+        pool.idle_timeout = 0
+        pool.evict_idle()
+        assert pool.idle[(host, port)] == []
+        assert conn.recv(1) == b''
+
+        conn.close()
+        listener.close()
+
+    def test_reconnect(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("localhost", 0))
+        listener.listen(2)
+        host, port = listener.getsockname()
+
+        pool = PeerConnectionPool()
+        pool.send(host, port, b"first")
+        conn, _ = listener.accept()
+        assert conn.recv(1024) == b"first"
+        conn.close()
+
+        pool.send(host, port, b"second")
+        conn, _ = listener.accept()
+        assert conn.recv(1024) == b"second"
+
+        pool.close()
+        conn.close()
+        listener.close()
+
+    def test_reaper(self):
+        assert eviction_interval(60) == 30
+        assert eviction_interval(0) == MIN_EVICTION_INTERVAL
+
+        # The reaper of a pool without an idle timeout does not spin and stops once the pool is closed
+        pool = PeerConnectionPool(idle_timeout=0)
+        pool.close()
+        pool.reaper.join(1)
+        assert not pool.reaper.is_alive()
+
+
+class TestQChatAsyncConnection:
+    @classmethod
+    def setup_class(cls):
+        cls.test_config1 = {"host": "localhost", "port": 8010, "transport": "asyncio", "backlog": 16}
+        cls.test_config2 = {"host": "localhost", "port": 8011, "transport": "asyncio"}
+        cls.connection1 = create_connection(name="Alice", config=cls.test_config1, cqc_connection=mock_cqc("Alice"))
+        cls.connection2 = create_connection(name="Bob", config=cls.test_config2, cqc_connection=mock_cqc("Bob"))
+
+    def test_create_connection(self):
+        assert isinstance(self.connection1, QChatAsyncConnection)
+        assert self.connection1.backlog == 16
+        with pytest.raises(ConnectionError):
+            create_connection(name="Alice", config={"host": "localhost", "port": 8012, "transport": "unknown"},
+                              cqc_connection=mock_cqc("Alice"))
+
+    def test_send_recv(self):
+        messages = [Message("Alice", {"index": i}) for i in range(5)]
+        for m in messages:
+            self.connection1.send_message("localhost", self.test_config2["port"], m.encode_message())
+
+        received = []
+        wait_start = time.time()
+        while len(received) < len(messages) and time.time() - wait_start < 5:
+            received += self.connection2.recv_messages(block=True, timeout=1)
+
+        assert [m.data for m in received] == [m.data for m in messages]
+        assert all(m.sender == "Alice" for m in received)
+        assert len(self.connection1.streams) == 1
+
+    def test_backpressure(self):
+        config = {"host": "localhost", "port": 8013, "transport": "asyncio", "queue_limits": {"per_sender": 2}}
+        connection = create_connection(name="Charlie", config=config, cqc_connection=mock_cqc("Charlie"))
+        messages = [Message("Alice", {"index": i}) for i in range(5)]
+        for m in messages:
+            self.connection1.send_message("localhost", config["port"], m.encode_message())
+
+        # The stream is paused while the queue is full and resumes as soon as messages are consumed
+        wait_start = time.time()
+        while len(connection.message_queue) < 2 and time.time() - wait_start < 5:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert len(connection.message_queue) == 2
+
+        received = []
+        wait_start = time.time()
+        while len(received) < len(messages) and time.time() - wait_start < 5:
+            received += connection.recv_messages(block=True, timeout=1)
+        assert [m.data for m in received] == [m.data for m in messages]
+        assert connection.get_queue_stats()["dropped"] == {}
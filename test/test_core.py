@@ -0,0 +1,175 @@
+import json
+import os
+import pytest
+import tempfile
+import time
+from functools import partial
+from qchat import core
+from qchat.core import QChatCore, ResolutionException
+from qchat.messages import HEADER_LENGTH, JSON_ENCODING, MAX_SENDER_LENGTH, BB84Message, MessageFactory, \
+                           PUTUMessage, QCHTMessage, decode_size
+
+
+class mock_core(QChatCore):
+    def __init__(self, name, configFile):
+        self.proc_map = {
+            PUTUMessage.header: partial(self._pass_message_data, handler=self.addUserInfo)
+        }
+        super().__init__(name=name, cqc_connection=None, configFile=configFile)
+
+
+def decode_frame(frame):
+    """
+    Decodes a frame the way the connection does when it is read from a socket
+    """
+    prefix = HEADER_LENGTH + MAX_SENDER_LENGTH
+    _, encoding, signed = decode_size(frame[prefix:prefix + 4])
+    sender = str(frame[HEADER_LENGTH:prefix].replace(b'\x00', b''), 'utf-8')
+    return MessageFactory().create_message(frame[:HEADER_LENGTH], sender, bytearray(frame[prefix + 4:]),
+                                           encoding=encoding, signed=signed)
+
+
+class TestQChatCore:
+    @classmethod
+    def setup_class(cls):
+        config = {name: {"host": "localhost", "port": 0, "root": "Alice"} for name in ["Alice", "Bob", "Charlie"]}
+        fd, cls.config_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(config, f)
+        cls.alice = mock_core("Alice", cls.config_file)
+        cls.bob = mock_core("Bob", cls.config_file)
+
+        # Charlie records the user information requests it sends to the registry
+        cls.charlie = mock_core("Charlie", cls.config_file)
+        cls.requests = []
+        cls.charlie.connection.send_message = lambda host, port, message: cls.requests.append(message)
+
+    @classmethod
+    def teardown_class(cls):
+        os.remove(cls.config_file)
+
+    def test_user_info_verification(self):
+        # Alice's public key arrives as an ISO-8859-1 string in a JSON encoded PUTU
+        putu = PUTUMessage(sender="Alice", message_data=self.alice.getPublicInfo("Alice"), encoding=JSON_ENCODING)
+        self.bob.process_message(decode_frame(self.alice._sign_message(putu).encode_message()))
+        assert self.bob.userDB.getPublicKey("Alice") == self.alice.getPublicKey()
+
+        message = QCHTMessage(sender="Alice", message_data={"message": "Hi Bob"}, encoding=JSON_ENCODING)
+        message = decode_frame(self.alice._sign_message(message).encode_message())
+        message, signature = self.bob._strip_signature(message)
+        self.bob._verify_message(message, signature)
+        assert self.bob.getVerifierStats()["misses"] == 1
+
+    def test_shared_user_request(self):
+        self.requests.clear()
+        message = QCHTMessage(sender="Alice", message_data={"message": "Hi Charlie"}, encoding=JSON_ENCODING)
+        message = decode_frame(self.alice._sign_message(message).encode_message())
+
+        # Messages of unknown senders are deferred and concurrent lookups share a single request
+        self.charlie.process_message(message)
+        future = self.charlie.requestUserInfo("Alice")
+        assert not future.done()
+        assert self.charlie.requestUserInfo("Alice") is future
+        assert len(self.requests) == 1
+
+        # The registry's answer completes the request and resumes the deferred message
+        putu = PUTUMessage(sender="Alice", message_data=self.alice.getPublicInfo("Alice"), encoding=JSON_ENCODING)
+        self.charlie.process_message(decode_frame(self.alice._sign_message(putu).encode_message()))
+        assert future.result(0) is None
+        delivered = self.charlie.control_message_queue[("Alice", None)].get(block=True, timeout=5)
+        assert delivered.data["message"] == "Hi Charlie"
+
+    def test_unknown_user(self):
+        self.requests.clear()
+        self.charlie.unknown_user_ttl = 0.05
+        future = self.charlie.requestUserInfo("Dave")
+        self.charlie.addUserInfo("Dave", unknown=True)
+        assert isinstance(future.exception(0), ResolutionException)
+
+        # The registry is not asked again until the negative cache entry expires
+        with pytest.raises(ResolutionException):
+            self.charlie.resolveUser("Dave")
+        assert len(self.requests) == 1
+
+        time.sleep(0.1)
+        assert not self.charlie.requestUserInfo("Dave").done()
+        assert len(self.requests) == 2
+
+    def test_unanswered_user_request(self, monkeypatch):
+        self.requests.clear()
+        monkeypatch.setattr(core, "USER_REQUEST_TIMEOUT", 0.05)
+        future = self.charlie.requestUserInfo("Eve")
+        assert isinstance(future.exception(5), ResolutionException)
+
+        # Users are only cached as unknown when the registry says so
+        assert "Eve" not in self.charlie.unknown_users
+        assert not self.charlie.requestUserInfo("Eve").done()
+        assert len(self.requests) == 2
+
+    def test_legacy_signatures(self):
+        info = self.alice.getPublicInfo("Alice")
+        self.bob.addUserInfo(info.pop("user"), **info)
+
+        # Peers without signature trailers carry the signature in the message data
+        message = QCHTMessage(sender="Alice", message_data={"message": "Hi Bob"}, encoding=JSON_ENCODING)
+        message = decode_frame(self.alice._sign_message(message, trailer=False).encode_message())
+        assert message.signature is None and "sig" in message.data
+        message, signature = self.bob._strip_signature(message)
+        self.bob._verify_message(message, signature)
+        assert message.data == {"message": "Hi Bob"}
+
+    def test_signature_negotiation(self):
+        assert self.charlie.connection.get_connection_info()["connection"]["signature_trailer"]
+
+        self.requests.clear()
+        self.charlie.sendUserInfo("Charlie", {"host": "localhost", "port": 1})
+        self.charlie.sendUserInfo("Charlie", {"host": "localhost", "port": 1, "signature_trailer": True})
+        legacy, trailer = map(decode_frame, self.requests)
+        assert legacy.signature is None and "sig" in legacy.data
+        assert trailer.signature is not None and "sig" not in trailer.data
+
+    def test_protocol_option_negotiation(self):
+        # Peers that do not advertise protocol options are led through the baseline protocols
+        assert self.charlie.connection.get_connection_info()["connection"]["protocol_options"]
+        assert self.charlie._negotiate_protocol_options(self.charlie.connection.get_connection_info()["connection"])
+        assert not self.charlie._negotiate_protocol_options({"host": "localhost", "port": 1})
+
+    def test_session_demultiplexing(self):
+        info = self.alice.getPublicInfo("Alice")
+        self.bob.addUserInfo(info.pop("user"), **info)
+
+        def receive(message_data):
+            message = BB84Message(sender="Alice", message_data=message_data)
+            self.bob.process_message(decode_frame(self.alice._sign_message(message).encode_message()))
+
+        # Concurrent protocol sessions with the same peer receive their own control messages
+        first, second = self.bob._open_control_queue("Alice", 1), self.bob._open_control_queue("Alice", 2)
+        receive({"ack": True, "session_id": 2})
+        receive({"ack": False, "session_id": 1})
+        assert first.get().data == {"ack": False, "session_id": 1}
+        assert second.get().data == {"ack": True, "session_id": 2}
+
+        # Messages of closed and unknown sessions are dropped instead of creating queues
+        self.bob._close_control_queue("Alice", 1)
+        receive({"ack": True, "session_id": 1})
+        receive({"ack": True, "session_id": 3})
+        assert ("Alice", 1) not in self.bob.control_message_queue
+        assert ("Alice", 3) not in self.bob.control_message_queue
+        assert len(second) == 0
+
+        # Messages without a session are kept for protocols of peers that do not use sessions
+        receive({"ack": True})
+        assert self.bob.control_message_queue[("Alice", None)].get().data == {"ack": True}
+        self.bob._close_control_queue("Alice", 2)
+
+    def test_session_close(self):
+        # Sessions of protocols that failed before concluding are removed with their control queue
+        self.bob.sessions[("Alice", 4)] = self.bob.sessions[("Charlie", 4)] = object()
+        self.bob._open_control_queue("Alice", 4)
+        self.bob._close_control_queue("Alice", 4)
+        self.bob._close_session("Alice", 4)
+        assert ("Alice", 4) not in self.bob.sessions
+        assert ("Alice", 4) not in self.bob.control_message_queue
+        assert ("Charlie", 4) in self.bob.sessions
+        self.bob._close_session("Alice", 4)
+        self.bob._close_session("Charlie", 4)
@@ -1,4 +1,5 @@
-from qchat.cryptobox import QChatCipher, QChatSigner, QChatVerifier
+from qchat.cryptobox import QChatCipher, QChatKeyAgreement, QChatSigner, QChatVerifier, VerifierCache, \
+                            ED25519_ALGORITHM, RSA_ALGORITHM, create_signer, create_verifier, verify_signature
 
 
 class TestCryptoBox:
@@ -25,3 +26,56 @@ class TestCryptoBox:
         test_data = b"Test data"
         sig = signer.sign(test_data)
         assert verifier.verify(test_data, sig)
+        assert verify_signature(pub, test_data, sig)
+        assert not verify_signature(pub, b"Other data", sig)
+
+    def test_ed25519(self):
+        signer = create_signer(ED25519_ALGORITHM)
+        pub = signer.get_pub()
+        verifier = create_verifier(pub, ED25519_ALGORITHM)
+
+        test_data = b"Test data"
+        sig = signer.sign(test_data)
+        assert len(sig) == 64
+        assert verifier.verify(test_data, sig)
+        assert not verifier.verify(b"Other data", sig)
+        assert verify_signature(pub, test_data, sig, ED25519_ALGORITHM)
+        assert not verify_signature(pub, test_data, QChatSigner().sign(test_data), ED25519_ALGORITHM)
+
+    def test_verifier_cache(self):
+        cache = VerifierCache()
+        pub = QChatSigner().get_pub()
+        verifier = cache.get_verifier("Alice", pub)
+        assert cache.get_verifier("Alice", pub) is verifier
+        assert cache.get_verifier("Alice", pub.decode("ISO-8859-1")) is verifier
+
+        other_pub = QChatSigner().get_pub()
+        assert cache.get_verifier("Alice", other_pub) is not verifier
+
+        ed_pub = create_signer(ED25519_ALGORITHM).get_pub()
+        assert cache.get_verifier("Alice", ed_pub, ED25519_ALGORITHM).alg == ED25519_ALGORITHM
+        assert cache.get_verifier("Alice", ed_pub, ED25519_ALGORITHM).alg == ED25519_ALGORITHM
+        assert cache.get_verifier("Bob", other_pub, RSA_ALGORITHM).alg == RSA_ALGORITHM
+
+        cache.invalidate("Alice")
+        assert cache.get_stats() == {"size": 1, "hits": 3, "misses": 4}
+
+    def test_mac_session(self):
+        leader, follower = QChatKeyAgreement(), QChatKeyAgreement()
+        leader_pub, follower_pub = leader.get_pub(), follower.get_pub()
+        leader_session = leader.derive_session(follower_pub, leader_pub, follower_pub, b"context", leader=True)
+        follower_session = follower.derive_session(leader_pub, leader_pub, follower_pub, b"context", leader=False)
+
+        sequences = [leader_session.next_sequence() for _ in range(3)]
+        assert sequences == [0, 1, 2]
+        macs = [leader_session.mac(bytes([s]) + self.test_message) for s in sequences]
+
+        # Out of order delivery is accepted once, replays are rejected
+        assert follower_session.verify(2, bytes([2]) + self.test_message, macs[2])
+        assert follower_session.verify(0, bytes([0]) + self.test_message, macs[0])
+        assert not follower_session.verify(0, bytes([0]) + self.test_message, macs[0])
+        assert not follower_session.verify(1, bytes([1]) + b"Other data", macs[1])
+        assert follower_session.verify(1, bytes([1]) + self.test_message, macs[1])
+
+        # Directions use separate keys so messages cannot be reflected
+        assert not leader_session.verify(3, bytes([2]) + self.test_message, macs[2])
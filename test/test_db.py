@@ -1,3 +1,4 @@
+from qchat.cryptobox import RSA_ALGORITHM
 from qchat.db import UserDB
 
 
@@ -22,6 +23,7 @@ class TestUserDB:
         expected_user_info = {
             'user': self.test_user,
             'pub': self.test_entry["pub"].decode("ISO-8859-1"),
+            'alg': RSA_ALGORITHM,
             'connection': self.test_entry['connection']
         }
         assert self.test_db.getPublicUserInfo(self.test_user) == expected_user_info
@@ -41,3 +43,13 @@ class TestUserDB:
         assert self.test_db.hasUser(self.test_user) is True
         self.test_db.deleteUser(self.test_user)
         assert self.test_db.hasUser(self.test_user) is False
+
+    def test_listeners(self):
+        db = UserDB()
+        changes = []
+        db.addListener(lambda user, fields: changes.append((user, fields)))
+        db.addUser(self.test_user, pub=b"Test Pub")
+        db.changeUserInfo(self.test_user, message_key=b'test')
+        db.deleteUser(self.test_user)
+        assert changes == [(self.test_user, ["pub"]), (self.test_user, ["message_key"]),
+                           (self.test_user, ["pub", "message_key"])]
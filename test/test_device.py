@@ -0,0 +1,29 @@
+import pytest
+import time
+from types import SimpleNamespace
+from qchat.device import FollowDevice, LeadDevice
+
+
+class mock_cqc:
+    def recvEPR(self):
+        raise Exception("No EPR")
+
+    def recvQubit(self):
+        raise Exception("No qubit")
+
+
+class TestMeasurementDevice:
+    def test_abort(self):
+        connection = SimpleNamespace(name="Alice", cqc=mock_cqc())
+        relay_info = {"host": "localhost", "port": 8000}
+        for device_class in [LeadDevice, FollowDevice]:
+            device = device_class(connection, relay_info)
+            with pytest.raises(Exception, match="Timed out"):
+                device.receiveEPR(timeout=0.01)
+
+            # Retrieval fails as soon as the source reports it will not distribute the pairs
+            device.abort("Pair quota of 5 exceeded")
+            start = time.time()
+            with pytest.raises(Exception, match="Pair quota of 5 exceeded"):
+                device.receiveEPR(timeout=60)
+            assert time.time() - start < 1
@@ -1,8 +1,101 @@
+import numpy as np
+from qchat.ecc import ECC_Golay, ECC_LDPC, PACKED_BACKEND, binary_entropy, create_ecc, pack_bits, unpack_bits
+
+
 class TestECC:
     @classmethod
     def setup_class(cls):
-        pass
+        cls.ecc = ECC_Golay()
+        cls.rng = np.random.default_rng(0)
 
     @classmethod
     def teardown_class(cls):
         pass
+
+    def test_golay_batch(self):
+        X = self.rng.integers(0, 2, (64, ECC_Golay.codeword_length), dtype=np.uint8)
+        S = self.ecc.encode_batch(X)
+        assert S.shape == (64, 11)
+        assert [tuple(s) for s in S] == [self.ecc.encode(tuple(x)) for x in X]
+
+        # Flip up to 3 bits of every codeword
+        E = np.zeros_like(X)
+        for e in E:
+            e[self.rng.choice(ECC_Golay.codeword_length, self.rng.integers(0, 4), replace=False)] = 1
+        corrected = self.ecc.decode_batch(X ^ E, S)
+        assert (corrected == X).all()
+        assert [list(c) for c in corrected] == [self.ecc.decode(tuple(x), tuple(s)) for x, s in zip(X ^ E, S)]
+
+    def test_chunk_batch(self):
+        X, remaining = self.ecc.chunk_batch([1] * 50)
+        assert X.shape == (2, ECC_Golay.codeword_length)
+        assert remaining == [1] * 4
+
+    def test_golay_error_table(self):
+        # Every syndrome of the perfect Golay code maps to a unique error string of at most 3 bits
+        table = self.ecc.error_table
+        assert table.shape == (2 ** 11, ECC_Golay.codeword_length)
+        assert np.bincount(table.sum(axis=1)).tolist() == [1, 23, 253, 1771]
+        assert ECC_Golay().error_table is table
+
+    def test_golay_packed(self):
+        ecc = ECC_Golay(backend=PACKED_BACKEND)
+        X = self.rng.integers(0, 2, (64, ECC_Golay.codeword_length), dtype=np.uint8)
+        S = self.ecc.encode_batch(X)
+        assert (unpack_bits(pack_bits(X), ECC_Golay.codeword_length) == X).all()
+        assert (ecc.encode_batch(X) == S).all()
+        assert (ecc.encode_packed(pack_bits(X)) == S @ ecc.syndrome_weights).all()
+
+        E = np.zeros_like(X)
+        E[:, [0, 11, 22]] = 1
+        assert (ecc.decode_batch(X ^ E, S) == X).all()
+        assert ecc.encode(tuple(X[0])) == self.ecc.encode(tuple(X[0]))
+        assert ecc.decode(tuple(X[0] ^ E[0]), tuple(S[0])) == X[0].tolist()
+
+    def test_ldpc(self):
+        ecc = ECC_LDPC(codeword_length=512, error_rate=0.03)
+        assert ECC_LDPC(codeword_length=512, error_rate=0.03).H.tolist() == ecc.H.tolist()
+        assert (ecc.H.sum(axis=0) == ecc.column_weight).all()
+
+        # Higher error rates disclose more syndrome bits
+        adapted = ecc.adapt(0.08)
+        assert adapted.H.shape[0] > ecc.H.shape[0]
+        assert create_ecc("ldpc", codeword_length=512, error_rate=0.08).H.tolist() == adapted.H.tolist()
+
+        X = self.rng.integers(0, 2, (16, 512), dtype=np.uint8)
+        E = (self.rng.random(X.shape) < 0.02).astype(np.uint8)
+        S = ecc.encode_batch(X)
+        assert (ecc.decode_batch(X ^ E, S) == X).all()
+        assert ecc.decode(tuple(X[0] ^ E[0]), ecc.encode(tuple(X[0]))) == X[0].tolist()
+
+    def test_ldpc_failures(self):
+        ecc = ECC_LDPC(codeword_length=512, error_rate=0.02)
+        X = self.rng.integers(0, 2, (8, 512), dtype=np.uint8)
+        E = (self.rng.random(X.shape) < 0.02).astype(np.uint8)
+
+        # Frames with far more errors than the code was chosen for fail their syndrome check and are reported
+        E[[2, 5]] = (self.rng.random((2, 512)) < 0.3)
+        corrected, failed = ecc.decode_batch(X ^ E, ecc.encode_batch(X), return_failures=True)
+        assert failed.tolist() == [i in (2, 5) for i in range(8)]
+        assert (corrected[~failed] == X[~failed]).all()
+
+        # The perfect Golay code corrects every syndrome to some codeword
+        X = self.rng.integers(0, 2, (16, ECC_Golay.codeword_length), dtype=np.uint8)
+        _, failed = self.ecc.decode_batch(X ^ 1, self.ecc.encode_batch(X), return_failures=True)
+        assert not failed.any()
+
+    def test_ldpc_disclosure(self):
+        # At the error rates Golay corrects the LDPC code discloses fewer bits per reconciled bit
+        golay = ECC_Golay()
+        golay_leak = golay.H.shape[0] / golay.codeword_length
+        for error_rate in (0.01, 0.03, 0.05):
+            ecc = ECC_LDPC(error_rate=error_rate)
+            leak = ecc.H.shape[0] / ecc.codeword_length
+            assert binary_entropy(error_rate) < leak < golay_leak
+
+            # Failed frames are dropped, the bits kept per frame bit still beat Golay
+            X = self.rng.integers(0, 2, (32, ecc.codeword_length), dtype=np.uint8)
+            E = (self.rng.random(X.shape) < error_rate).astype(np.uint8)
+            corrected, failed = ecc.decode_batch(X ^ E, ecc.encode_batch(X), return_failures=True)
+            assert (corrected[~failed] == X[~failed]).all()
+            assert (1 - failed.mean()) * (1 - leak) > 1 - golay_leak
@@ -1,6 +1,8 @@
 import pytest
 import json
-from qchat.messages import MalformedMessage, Message, RGSTMessage, AUTHMessage, QCHTMessage, MessageFactory
+from qchat.messages import MalformedMessage, Message, RGSTMessage, AUTHMessage, QCHTMessage, MessageFactory, \
+                           BINARY_ENCODING, JSON_ENCODING, BINARY_FLAG, PAYLOAD_SIZE, decode_size, pack_payload, \
+                           unpack_payload, as_bytes, BitVector, BB84Message, SIGNED_FLAG, MAC_FLAG
 
 
 class TestMessage:
@@ -39,6 +41,124 @@ class TestMessage:
         with pytest.raises(MalformedMessage):
             test_message.encode_message()
 
+    def test_binary_payload(self):
+        data = {"none": None, "flags": [True, False], "small": 7, "large": -2 ** 40, "float": 0.5, "str": "abc",
+                "bytes": b"\x00\xff", "bits": [0, 1, 1, 0], "nested": [{"a": [300, "b"]}], "tuple": (1, 2)}
+        decoded = unpack_payload(pack_payload(data))
+        assert decoded == dict(data, tuple=[1, 2])
+
+        with pytest.raises(MalformedMessage):
+            pack_payload({"set": {1}})
+        with pytest.raises(MalformedMessage):
+            unpack_payload(pack_payload(data) + b"N")
+
+    def test_encodings(self):
+        data = {"sig": b"\x00\xff\x10", "theta": [0, 1]}
+        json_message = Message(self.test_sender, data)
+        binary_message = Message(self.test_sender, data, encoding=BINARY_ENCODING)
+
+        json_bytes = json_message.encode_message()
+        binary_bytes = binary_message.encode_message()
+        assert len(binary_bytes) < len(json_bytes)
+
+        json_size = json_bytes[20:20 + PAYLOAD_SIZE]
+        binary_size = binary_bytes[20:20 + PAYLOAD_SIZE]
+        assert decode_size(json_size) == (len(json_bytes) - 24, JSON_ENCODING, False)
+        assert decode_size(binary_size) == (len(binary_bytes) - 24, BINARY_ENCODING, False)
+        assert int.from_bytes(binary_size, 'big') & BINARY_FLAG
+
+        decoded_json = MessageFactory().create_message(Message.header, self.test_sender, json_bytes[24:])
+        decoded_binary = MessageFactory().create_message(Message.header, self.test_sender, binary_bytes[24:],
+                                                         encoding=BINARY_ENCODING)
+        assert as_bytes(decoded_json.data["sig"]) == data["sig"]
+        assert decoded_binary.data == data
+        assert decoded_json.encode_message() == json_bytes
+        assert decoded_binary.encode_message() == binary_bytes
+
+        with pytest.raises(MalformedMessage):
+            decode_size(b"\x01\x00\x00\x00")
+
+    def test_bit_vector(self):
+        bits = [1, 0, 1, 1, 0, 0, 1, 0, 1]
+        vector = BitVector(bits)
+        assert vector.pack() == b"\x00\x00\x00\x09\xb2\x80"
+        assert BitVector.unpack(vector.pack()) == bits
+        assert BitVector.unpack(BitVector([]).pack()) == []
+        assert list(vector) == bits and len(vector) == len(bits) and vector[2] == 1
+
+        with pytest.raises(MalformedMessage):
+            BitVector([0, 2]).pack()
+        with pytest.raises(MalformedMessage):
+            BitVector.unpack(b"\x00\x00\x00\x09\xb2")
+
+        data = {"theta": BitVector(bits * 20)}
+        for encoding in [JSON_ENCODING, BINARY_ENCODING]:
+            encoded = Message(self.test_sender, data, encoding=encoding).encode_message()
+            decoded = MessageFactory().create_message(Message.header, self.test_sender, encoded[24:], encoding=encoding)
+            assert isinstance(decoded.data["theta"], BitVector)
+            assert decoded.data["theta"] == bits * 20
+            assert decoded.encode_message() == encoded
+
+            unpacked = Message(self.test_sender, {"theta": bits * 20}, encoding=encoding).encode_message()
+            assert len(encoded) < len(unpacked)
+
+    def test_cached_encoding(self):
+        message = QCHTMessage(self.test_sender, {"data": "first"})
+        assert not hasattr(message, "__dict__")
+        encoded = message.encode_message()
+        assert message.encode_message() is not encoded and message._body is not None
+
+        message.data["data"] = "second"
+        assert message._body is None
+        assert json.loads(message.encode_message()[24:]) == {"data": "second"}
+
+        message.data.pop("data")
+        assert message.encode_message()[24:] == b"{}"
+
+        message.data = {"data": "third"}
+        assert json.loads(message.encode_message()[24:]) == {"data": "third"}
+
+        message.encoding = BINARY_ENCODING
+        assert message._body is None
+        assert unpack_payload(message.encode_message()[24:]) == {"data": "third"}
+
+    def test_signature_trailer(self):
+        for encoding in [JSON_ENCODING, BINARY_ENCODING]:
+            message = QCHTMessage(self.test_sender, self.test_message_data, encoding=encoding)
+            signed_data = message.get_signed_data()
+            message.signature = b"\x01" * 64
+            encoded = message.encode_message()
+            assert encoded.startswith(signed_data[:20])
+
+            length, decoded_encoding, signed = decode_size(encoded[20:24])
+            assert (length, decoded_encoding, signed) == (len(encoded) - 24, encoding, SIGNED_FLAG)
+
+            decoded = MessageFactory().create_message(QCHTMessage.header, self.test_sender, bytearray(encoded[24:]),
+                                                      encoding=encoding, signed=True)
+            assert decoded.signature == message.signature
+            assert decoded.data == self.test_message_data
+            assert decoded.get_signed_data() == signed_data
+
+        with pytest.raises(MalformedMessage):
+            MessageFactory().create_message(QCHTMessage.header, self.test_sender, b"\x00\xff", signed=True)
+
+    def test_mac_trailer(self):
+        message = BB84Message(self.test_sender, self.test_message_data)
+        message.sequence = 7
+        message.mac = b"\x02" * 32
+        encoded = message.encode_message()
+        length, encoding, trailer = decode_size(encoded[20:24])
+        assert (length, trailer) == (len(encoded) - 24, MAC_FLAG)
+
+        decoded = MessageFactory().create_message(BB84Message.header, self.test_sender, bytearray(encoded[24:]),
+                                                  encoding=encoding, signed=trailer)
+        assert (decoded.sequence, decoded.mac) == (7, message.mac)
+        assert decoded.signature is None
+        assert decoded.get_mac_data() == message.get_mac_data()
+
+        with pytest.raises(MalformedMessage):
+            decode_size((SIGNED_FLAG | MAC_FLAG).to_bytes(4, 'big'))
+
     def test_RGSTMessage(self):
         test_rgst_message = RGSTMessage(self.test_sender, self.test_message_data)
         assert test_rgst_message.header == RGSTMessage.header
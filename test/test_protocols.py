@@ -0,0 +1,170 @@
+import pytest
+import random
+import threading
+from types import SimpleNamespace
+from qchat.channel import MessageChannel
+from qchat.ecc import ECC_Golay
+from qchat.messages import BB84Message, PTCLMessage
+from qchat.protocols import BB84_Purified, LEADER_ROLE, FOLLOW_ROLE, ROUND_SIZE, ProtocolException
+
+
+class ChannelLink:
+    """
+    Delivers the outbound control messages of a protocol straight into its peer's control queue
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.sent = 0
+
+    def put(self, item):
+        self.sent += 1
+        self.channel.put(item[1])
+
+
+class mock_qubit:
+    def H(self):
+        pass
+
+    def measure(self):
+        return 0
+
+
+class mock_device:
+    """
+    Measurement device that hands out qubits immediately and records the EPR requests of the protocol
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.received = 0
+        self.requests = []
+
+    def requestEPR(self, user, count=1):
+        # Record the requested window with the qubits received and the acks sent so far
+        self.requests.append((count, self.received, self.protocol.outbound_q.sent))
+
+    def receiveEPR(self):
+        self.received += 1
+        return mock_qubit()
+
+
+class TestBB84Purified:
+    @classmethod
+    def setup_class(cls):
+        cls.rng = random.Random(0)
+
+    def make_pair(self, batch_reconciliation=True, ecc="golay", window=1):
+        alice_q, bob_q = MessageChannel(), MessageChannel()
+        protocols = []
+        for name, peer, ctrl_q, outbound_q in [("Alice", "Bob", alice_q, bob_q), ("Bob", "Alice", bob_q, alice_q)]:
+            p = BB84_Purified(key_size=1, window=window, batch_reconciliation=batch_reconciliation, ecc=ecc,
+                              peer_info={"user": peer},
+                              connection=SimpleNamespace(name=name), ctrl_msg_q=ctrl_q,
+                              outbound_q=ChannelLink(outbound_q), role=None, relay_info=None)
+            protocols.append(p)
+        protocols[0].role, protocols[1].role = LEADER_ROLE, FOLLOW_ROLE
+        return protocols
+
+    def reconcile(self, batch_reconciliation):
+        x = [self.rng.randint(0, 1) for _ in range(3 * ECC_Golay.codeword_length + 5)]
+        y = list(x)
+        for i in range(0, 3 * ECC_Golay.codeword_length, ECC_Golay.codeword_length):
+            y[i + self.rng.randrange(ECC_Golay.codeword_length)] ^= 1
+
+        leader, follower = self.make_pair(batch_reconciliation)
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(follower=follower._reconcile_information(y)))
+        thread.start()
+        results["leader"] = leader._reconcile_information(x)
+        thread.join()
+        return x, results, leader.outbound_q.sent + follower.outbound_q.sent
+
+    def test_reconcile(self):
+        for batch_reconciliation, messages in [(False, 6), (True, 2)]:
+            x, results, sent = self.reconcile(batch_reconciliation)
+            assert results["leader"] == results["follower"]
+            assert results["leader"] == (x[-5:], x[:-5])
+            assert sent == messages
+
+    def test_reconcile_ldpc(self):
+        leader, follower = self.make_pair(batch_reconciliation=True, ecc="ldpc")
+        leader.error_estimates = follower.error_estimates = [0.02]
+        ecc = leader._adapt_ecc()
+        assert ecc.error_rate == 0.02
+
+        x = [self.rng.randint(0, 1) for _ in range(ecc.codeword_length + 7)]
+        y = [b ^ (self.rng.random() < 0.02) for b in x[:-7]] + x[-7:]
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(follower=follower._reconcile_information(y)))
+        thread.start()
+        results["leader"] = leader._reconcile_information(x)
+        thread.join()
+        assert results["leader"] == results["follower"] == (x[-7:], x[:-7])
+
+    def test_protocol_options(self):
+        for window, batch_reconciliation, expected in [(1, False, {}), (10, True, {"window": 10,
+                                                                                   "batch_reconciliation": True})]:
+            leader, follower = self.make_pair(batch_reconciliation=batch_reconciliation, window=window)
+            thread = threading.Thread(target=leader._lead_protocol)
+            thread.start()
+
+            # Baseline followers only receive the options that differ from the baseline protocol
+            ptcl = follower._wait_for_control_message(message_type=PTCLMessage)
+            follower._acknowledge_protocol()
+            thread.join()
+            assert ptcl.data == dict(expected, name=leader.name, key_size=leader.key_size)
+
+    def test_incorrect_control_message(self):
+        leader, follower = self.make_pair()
+
+        # A control message of the wrong type aborts the protocol instead of staying at the head of the queue
+        follower.ctrl_msg_q.put(PTCLMessage(sender="Alice", message_data={"name": leader.name}))
+        follower.ctrl_msg_q.put(BB84Message(sender="Alice", message_data={"ack": True}))
+        with pytest.raises(ProtocolException, match="incorrect control message"):
+            follower._wait_for_control_message(message_type=BB84Message)
+        assert follower._wait_for_control_message(message_type=BB84Message).data == {"ack": True}
+
+    def test_reconcile_ldpc_failure(self):
+        leader, follower = self.make_pair(batch_reconciliation=True, ecc="ldpc")
+        leader.error_estimates = follower.error_estimates = [0.02]
+        n = leader._adapt_ecc().codeword_length
+
+        # The second frame has far more errors than the code corrects and is dropped by both sides
+        x = [self.rng.randint(0, 1) for _ in range(3 * n)]
+        y = [b ^ (self.rng.random() < (0.3 if n <= i < 2 * n else 0.01)) for i, b in enumerate(x)]
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(follower=follower._reconcile_information(y)))
+        thread.start()
+        results["leader"] = leader._reconcile_information(x)
+        thread.join()
+        assert results["leader"] == results["follower"] == ([], x[:n] + x[2 * n:])
+
+    def distribute(self, window):
+        leader, follower = self.make_pair(window=window)
+        leader.device, follower.device = mock_device(leader), mock_device(follower)
+        results = {}
+        thread = threading.Thread(target=lambda: results.update(follower=follower._receive_bb84_states()))
+        thread.start()
+        results["leader"] = leader._receive_bb84_states()
+        thread.join()
+        assert len(results["leader"][0]) == len(results["follower"][0]) == ROUND_SIZE
+        return leader, follower
+
+    def test_windowed_distribution(self):
+        leader, follower = self.distribute(window=10)
+
+        # One ack is exchanged per window and only the leader requests pairs from the source
+        assert leader.outbound_q.sent == follower.outbound_q.sent == ROUND_SIZE // 10
+        assert follower.device.requests == []
+
+        # The next window is requested as soon as the pairs of the previous window arrived, before its ack
+        assert [count for count, _, _ in leader.device.requests] == [10] * (ROUND_SIZE // 10)
+        assert leader.device.requests[:3] == [(10, 0, 0), (10, 10, 0), (10, 20, 1)]
+
+    def test_partial_window(self):
+        window = 30
+        leader, follower = self.distribute(window=window)
+
+        # The last window only requests the pairs that are left over
+        windows = [window] * (ROUND_SIZE // window) + [ROUND_SIZE % window]
+        assert [count for count, _, _ in leader.device.requests] == windows
+        assert leader.outbound_q.sent == follower.outbound_q.sent == len(windows)
@@ -0,0 +1,91 @@
+import pytest
+import time
+from qchat.relay import EPRRequest, EPRScheduler, EPRSource, RequestRejected, TokenBucket
+
+
+class TestEPRScheduler:
+    def test_fair_queuing(self):
+        scheduler = EPRScheduler(weights={"Alice": 2, "Bob": 2})
+        scheduler.submit(EPRRequest("Alice", "Bob", 6))
+        scheduler.submit(EPRRequest("Charlie", "Eve", 3))
+
+        served = []
+        for _ in range(9):
+            request = scheduler.next(timeout=0)
+            served.append(request.requester)
+            scheduler.record(request)
+
+        # Alice and Bob receive twice the share of Charlie and Eve while both are active
+        assert served[:6].count("Alice") == 4
+        assert scheduler.next(timeout=0) is None
+
+        stats = scheduler.get_flow_stats()
+        assert stats["Alice:Bob"]["distributed"] == 6
+        assert stats["Charlie:Eve"]["weight"] == 1
+        assert stats["Charlie:Eve"]["throughput"] > 0
+
+    def test_quotas(self):
+        scheduler = EPRScheduler(user_quota=4, pair_quota=3)
+        scheduler.submit(EPRRequest("Alice", "Bob", 3))
+        with pytest.raises(RequestRejected):
+            scheduler.submit(EPRRequest("Bob", "Alice", 1))
+        with pytest.raises(RequestRejected):
+            scheduler.submit(EPRRequest("Alice", "Charlie", 2))
+        scheduler.submit(EPRRequest("Alice", "Charlie", 1))
+
+        # Failed requests release their outstanding pairs
+        request = scheduler.next(timeout=0)
+        assert scheduler.record(request, error="Out of qubits")
+        scheduler.submit(EPRRequest("Alice", "Bob", 3))
+        assert scheduler.get_flow_stats()["Alice:Bob"]["rejected"] == 1
+
+    def test_weights(self):
+        with pytest.raises(ValueError):
+            EPRScheduler(weights={"Alice": 0})
+        with pytest.raises(ValueError):
+            EPRScheduler(weights={"Alice": 2, "Bob": -1})
+
+    def test_rate_limit(self):
+        bucket = TokenBucket(rate=10, burst=1)
+        now = time.monotonic()
+        assert bucket.delay(now) == 0
+        bucket.consume(now)
+        assert bucket.delay(now) == pytest.approx(0.1, abs=0.01)
+
+        scheduler = EPRScheduler(pair_rate=1000, burst=1)
+        scheduler.submit(EPRRequest("Alice", "Bob", 2))
+        scheduler.record(scheduler.next(timeout=0))
+        assert scheduler.next(timeout=0) is None
+        assert scheduler.next(timeout=1) is not None
+
+
+class TestEPRSource:
+    def test_serve(self):
+        pairs = []
+        reports = []
+
+        def distribute(requester, peer):
+            if len(pairs) == 3:
+                raise ValueError("Out of qubits")
+            pairs.append((requester, peer))
+
+        source = EPRSource(distribute=distribute, report=reports.append, scheduler=EPRScheduler(pair_quota=5))
+        assert not source.submit(EPRRequest("Bob", "Alice", 6, request_id=3))
+        assert not source.submit(EPRRequest("Bob", "Alice", 0))
+        source.submit(EPRRequest("Alice", "Bob", 2, request_id=1))
+        source.submit(EPRRequest("Alice", "Bob", 1))
+        source.submit(EPRRequest("Bob", "Alice", 2, request_id=2))
+
+        deadline = time.time() + 5
+        while len(reports) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+
+        # Single pair requests are only reported when they are rejected or fail
+        assert pairs == [("Alice", "Bob")] * 3
+        outcomes = [(r.request_id, r.distributed, r.error) for r in reports]
+        assert outcomes == [(3, 0, "Pair quota of 5 exceeded"), (None, 0, "Invalid number of pairs 0"),
+                            (1, 2, None), (2, 0, "Out of qubits")]
+        stats = source.get_stats()
+        assert {k: stats[k] for k in ["requests", "completed", "failed", "rejected", "pairs", "queued"]} == \
+            {"requests": 5, "completed": 2, "failed": 1, "rejected": 2, "pairs": 3, "queued": 0}
+        assert stats["flows"]["Alice:Bob"]["distributed"] == 3
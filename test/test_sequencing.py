@@ -0,0 +1,97 @@
+import threading
+import time
+from qchat.sequencing import ReorderBuffer, RetransmitBuffer
+
+
+class TestReorderBuffer:
+    def test_reorder(self):
+        delivered = []
+        buffer = ReorderBuffer(deliver=delivered.append)
+        assert buffer.push(1, 1, "b")
+        assert buffer.push(1, 2, "c")
+        assert delivered == []
+        assert buffer.push(1, 0, "a")
+        assert delivered == ["a", "b", "c"]
+
+        # Duplicates such as retransmissions of delivered messages are rejected
+        assert not buffer.push(1, 1, "b")
+        assert buffer.get_stats() == {"delivered": 3, "reordered": 2, "duplicates": 1, "skipped": 0, "held": 0}
+
+        # A new epoch restarts the sequence
+        assert buffer.push(2, 0, "d")
+        assert delivered[-1] == "d"
+
+    def test_missing_and_skip(self):
+        delivered = []
+        buffer = ReorderBuffer(deliver=delivered.append, limit=10)
+        buffer.push(1, 0, "a")
+        buffer.push(1, 3, "d")
+        assert buffer.get_missing(delay=5) == (1, [])
+        time.sleep(0.01)
+        assert buffer.get_missing(delay=0.001) == (1, [1, 2])
+        assert not buffer.push(1, 20, "z")
+
+        buffer.push(1, 2, "c")
+        buffer.skip(1, [1])
+        assert delivered == ["a", "c", "d"]
+        assert buffer.get_missing(delay=0) == (1, [])
+
+    def test_restarted_receiver(self):
+        # A fresh buffer picks up the sequence of a peer that kept numbering while we restarted
+        delivered = []
+        buffer = ReorderBuffer(deliver=delivered.append, limit=10)
+        assert buffer.push(1, 25, "a")
+        assert buffer.push(1, 27, "c")
+        assert buffer.push(1, 26, "b")
+        assert delivered == ["a", "b", "c"]
+        assert not buffer.push(1, 24, "z")
+
+        # Messages of a new epoch that arrive out of order within the window are still delivered in order
+        assert buffer.push(2, 1, "e")
+        assert buffer.push(2, 0, "d")
+        assert delivered[-2:] == ["d", "e"]
+
+    def test_blocked_delivery(self):
+        delivered = []
+        release = threading.Event()
+
+        def deliver(message):
+            if message == "a":
+                release.wait(5)
+            delivered.append(message)
+
+        buffer = ReorderBuffer(deliver=deliver)
+        thread = threading.Thread(target=buffer.push, args=(1, 0, "a"))
+        thread.start()
+        time.sleep(0.05)
+
+        # A consumer blocked on delivery holds up neither other messages of the peer nor retransmission requests
+        start = time.monotonic()
+        assert buffer.push(1, 1, "b")
+        assert buffer.push(1, 3, "d")
+        assert buffer.get_missing(delay=0) == (1, [2])
+        assert time.monotonic() - start < 1
+        assert delivered == []
+
+        # Messages released while the consumer was blocked are delivered in order once it returns
+        release.set()
+        thread.join(5)
+        assert delivered == ["a", "b"]
+        buffer.push(1, 2, "c")
+        assert delivered == ["a", "b", "c", "d"]
+
+
+class TestRetransmitBuffer:
+    def test_lookup(self):
+        buffer = RetransmitBuffer(limit=2)
+        for frame in [b"a", b"b", b"c"]:
+            buffer.store(buffer.assign(), "localhost", 8000, frame)
+
+        frames, lost = buffer.lookup([2, 1, 0, 5])
+        assert frames == [("localhost", 8000, b"b"), ("localhost", 8000, b"c")]
+        assert lost == [0]
+        assert buffer.retransmitted == 2
+
+        buffer.ttl = 0
+        time.sleep(0.01)
+        assert buffer.lookup([1, 2]) == ([], [1, 2])
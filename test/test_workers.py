@@ -0,0 +1,110 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from qchat.cryptobox import QChatSigner, init_process_signer, sign_batch, verify_signatures
+from qchat.messages import BB84Message, PTCLMessage, PUTUMessage
+from qchat.workers import MessageWorkerPool, map_batches
+
+
+class TestMessageWorkerPool:
+    def test_submit(self):
+        handled = []
+        done = threading.Event()
+
+        def handler(message):
+            handled.append(message)
+            if len(handled) == 10:
+                done.set()
+
+        pool = MessageWorkerPool(handler=handler, max_workers=2)
+        messages = [BB84Message(sender="Alice", message_data={"index": i}) for i in range(10)]
+        for m in messages:
+            pool.submit(m)
+        assert done.wait(5)
+        pool.shutdown()
+
+        assert sorted(m.data["index"] for m in handled) == list(range(10))
+        stats = pool.get_stats()[BB84Message.header]
+        assert stats["submitted"] == stats["completed"] == 10
+        assert stats["failed"] == 0 and stats["active"] == 0
+        assert stats["max_queue_time"] >= stats["mean_queue_time"] >= 0
+
+    def test_type_limits(self):
+        release = threading.Event()
+        started = threading.Semaphore(0)
+        handled = threading.Event()
+
+        def handler(message):
+            if message.header == PTCLMessage.header:
+                started.release()
+                release.wait(5)
+            else:
+                handled.set()
+
+        pool = MessageWorkerPool(handler=handler, max_workers=1, type_limits={PTCLMessage.header: 1})
+        pool.submit(PTCLMessage(sender="Alice", message_data={}))
+        pool.submit(PTCLMessage(sender="Alice", message_data={}))
+        assert started.acquire(timeout=5)
+
+        # Long running protocol handlers do not block other message types
+        pool.submit(BB84Message(sender="Alice", message_data={}))
+        assert handled.wait(5)
+        assert pool.get_stats()[PTCLMessage.header]["active"] == 1
+
+        release.set()
+        pool.shutdown()
+        assert pool.get_stats()[PTCLMessage.header]["completed"] == 2
+
+    def test_type_pending(self):
+        release = threading.Event()
+        handled = threading.Event()
+
+        def handler(message):
+            if message.header == BB84Message.header:
+                release.wait(5)
+            else:
+                handled.set()
+
+        # Messages of a type with a dedicated pool are accepted while the other pool's pending bound is reached
+        pool = MessageWorkerPool(handler=handler, max_workers=1, max_pending=2,
+                                 type_limits={PUTUMessage.header: 1})
+        pool.submit(BB84Message(sender="Alice", message_data={}))
+        pool.submit(BB84Message(sender="Alice", message_data={}))
+        pool.submit(PUTUMessage(sender="Alice", message_data={}))
+        assert handled.wait(5)
+
+        release.set()
+        pool.shutdown()
+
+    def test_failures(self):
+        def handler(message):
+            raise Exception("Failure")
+
+        pool = MessageWorkerPool(handler=handler, max_pending=1)
+        pool.submit(BB84Message(sender="Alice", message_data={}))
+        pool.submit(BB84Message(sender="Alice", message_data={}))
+        pool.shutdown()
+        assert pool.get_stats()[BB84Message.header]["failed"] == 2
+
+
+class TestBatches:
+    def test_map_batches(self):
+        with ThreadPoolExecutor(3) as executor:
+            assert map_batches(executor, lambda batch: [i * 2 for i in batch], list(range(10)), 3) == \
+                list(range(0, 20, 2))
+            assert map_batches(executor, lambda batch: batch, [], 3) == []
+
+    def test_signature_batches(self):
+        signer = QChatSigner()
+        data = [bytes([i]) for i in range(6)]
+        with ProcessPoolExecutor(2, initializer=init_process_signer,
+                                 initargs=(signer.alg, signer.export_key())) as executor:
+            signatures = map_batches(executor, sign_batch, data, 2)
+
+        # Failures are reported per message and do not affect the order of results
+        pub = signer.get_pub()
+        tasks = [(pub, d, sig, signer.alg) for d, sig in zip(data, signatures)]
+        tasks[2] = (pub, b"Other data", signatures[2], signer.alg)
+        tasks[4] = (b"Bad key", data[4], signatures[4], signer.alg)
+        with ProcessPoolExecutor(2) as executor:
+            results = map_batches(executor, verify_signatures, tasks, 2)
+        assert results == [True, True, False, True, False, True]